@@ -285,6 +285,43 @@ def synchronization(config=None):
         logging.info(f'\nSynchronization took {time.strftime("%Hh%Mm%Ss", time.gmtime(elapsed))}.\n')
     
     
+def materializeSync(config=None):
+    '''
+    Copy renamed json files to pose-sync from the synchronization offsets manifest,
+    for external tools which do not read sync_offsets.json.
+    
+    config can be a dictionary,
+    or a the directory path of a trial, participant, or session,
+    or the function can be called without an argument, in which case it the config directory is the current one.
+    '''
+
+    from Pose2Sim.synchronization import materialize_sync
+
+    # Determine the level at which the function is called (root:2, trial:1)
+    level, config_dicts = read_config_files(config)
+
+    if type(config)==dict:
+        config_dict = config_dicts[0]
+        if config_dict.get('project').get('project_dir') == None:
+            raise ValueError('Please specify the project directory in config_dict:\n \
+                             config_dict.get("project").update({"project_dir":"<YOUR_TRIAL_DIRECTORY>"})')
+
+    # Set up logging
+    session_dir = os.path.realpath(os.path.join(config_dicts[0].get('project').get('project_dir'), '..'))
+    setup_logging(session_dir)    
+
+    # Batch process all trials
+    for config_dict in config_dicts:
+        project_dir = os.path.realpath(config_dict.get('project').get('project_dir'))
+
+        logging.info("\n---------------------------------------------------------------------")
+        logging.info("Copying synchronized json files from offsets manifest")
+        logging.info(f"Project directory: {project_dir}")
+        logging.info("---------------------------------------------------------------------\n")
+
+        materialize_sync(config_dict)
+
+
 def personAssociation(config=None):
     '''
     Tracking one or several persons of interest.
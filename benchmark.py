@@ -0,0 +1,481 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+'''
+###########################################################################
+## TRIANGULATION BENCHMARK                                               ##
+###########################################################################
+
+Micro- and macro-benchmarks of the triangulation stage on synthetic data.
+
+A synthetic scene is made of a known 3D motion of one or several skeletons
+from skeletons.py, seen by a ring of synthetic cameras. The 3D keypoints are
+projected through a synthetic calibration file, and the 2D coordinates are
+written as OpenPose-like json files, with configurable noise, occlusions
+and outliers.
+
+Timings of weighted_triangulation and triangulation_from_best_cameras
+(per point) and of triangulate_all (end to end) are measured across camera,
+frame, and person counts, and saved as a json file so that they can be
+compared between versions. A last check asserts that constant velocity
+tracking with a re-identification gate never loses a person in view.
+
+Usage:
+    from Pose2Sim import benchmark; benchmark.benchmark_all('benchmark.json')
+    OR python -m Pose2Sim.benchmark benchmark.json
+
+INPUTS:
+- benchmark parameters (camera, frame, and person counts, noise, occlusion, outliers)
+
+OUTPUT:
+- a json file with timings and accuracy
+'''
+
+
+## INIT
+import os
+import sys
+import json
+import time
+import logging
+import platform
+import tempfile
+import shutil
+import numpy as np
+import cv2
+import toml
+from anytree import PreOrderIter
+
+from Pose2Sim.common import computeP, retrieve_calib_params, project_points, weighted_triangulation, \
+    read_trc, peak_memory_mb
+from Pose2Sim.skeletons import *
+from Pose2Sim.triangulation import triangulation_from_best_cameras, triangulate_all
+
+
+## AUTHORSHIP INFORMATION
+__author__ = "David Pagnon"
+__copyright__ = "Copyright 2021, Pose2Sim"
+__credits__ = ["David Pagnon"]
+__license__ = "BSD 3-Clause License"
+__version__ = "0.9.4"
+__maintainer__ = "David Pagnon"
+__email__ = "contact@david-pagnon.com"
+__status__ = "Development"
+
+
+## FUNCTIONS
+def synthetic_calibration(calib_path, n_cams=4, radius=4, height=1.5, image_size=[1920, 1080], focal=1000, distortions=[0., 0., 0., 0.]):
+    '''
+    Write a calibration file with n_cams cameras evenly spread on a circle,
+    all looking at the center of the scene.
+
+    INPUTS:
+    - calib_path: path of the .toml calibration file to write
+    - n_cams: number of cameras
+    - radius: radius of the circle of cameras, in meters
+    - height: height of the cameras, in meters
+    - image_size: [width, height] of the images, in pixels
+    - focal: focal length, in pixels
+    - distortions: [k1, k2, p1, p2] distortion coefficients
+
+    OUTPUT:
+    - a .toml calibration file
+    '''
+
+    target = np.array([0., 0., 1.])
+    calib = {}
+    for c in range(n_cams):
+        angle = 2*np.pi*c/n_cams
+        cam_pos = np.array([radius*np.cos(angle), radius*np.sin(angle), height])
+        # rows of R are the camera axes in world coordinates (x right, y down, z forward)
+        z_axis = (target - cam_pos) / np.linalg.norm(target - cam_pos)
+        x_axis = np.cross(z_axis, [0., 0., -1.])
+        x_axis /= np.linalg.norm(x_axis)
+        y_axis = np.cross(z_axis, x_axis)
+        R_mat = np.array([x_axis, y_axis, z_axis])
+        T = -R_mat @ cam_pos
+        K = [[float(focal), 0., image_size[0]/2], [0., float(focal), image_size[1]/2], [0., 0., 1.]]
+        calib[f'cam_{c+1:02d}'] = {'name': f'cam{c+1:02d}', 'size': [float(s) for s in image_size], 'matrix': K,
+                                   'distortions': [float(d) for d in distortions], 'rotation': cv2.Rodrigues(R_mat)[0].ravel().tolist(),
+                                   'translation': T.tolist(), 'fisheye': False}
+    calib['metadata'] = {'adjusted': False, 'error': 0.0}
+
+    with open(calib_path, 'w') as f:
+        toml.dump(calib, f)
+
+
+def synthetic_motion(model, n_frames=100, n_persons=1, frame_rate=60, seed=0):
+    '''
+    Known 3D motion of skeletons from skeletons.py.
+    Each bone of the tree has a fixed length and swings sinusoidally around its
+    rest direction, while each person walks in a straight line.
+
+    INPUTS:
+    - model: anytree skeleton model, from skeletons.py
+    - n_frames: number of frames
+    - n_persons: number of persons
+    - frame_rate: frame rate, in Hz
+    - seed: seed of the random generator
+
+    OUTPUT:
+    - Q_gt: array of shape (n_frames, n_persons, max keypoint id + 1, 3). Z-up, in meters
+    '''
+
+    rng = np.random.default_rng(seed)
+    nodes = list(PreOrderIter(model))
+    keypoints_nb = max(node.id for node in nodes if node.id is not None) + 1
+    t = np.arange(n_frames) / frame_rate
+
+    # rest direction, length, swing amplitude and frequency of each bone
+    bones = {}
+    for node in nodes[1:]:
+        depth = node.depth
+        rest_dir = rng.normal(size=3) + ([0., 0., 1.5] if depth <= 2 else [0., 0., -1.5])
+        bones[node] = (rest_dir / np.linalg.norm(rest_dir), rng.uniform(0.08, 0.3),
+                       rng.uniform(0.1, 0.4), rng.uniform(0.5, 1.5), rng.uniform(0, 2*np.pi))
+
+    Q_gt = np.full((n_frames, n_persons, keypoints_nb, 3), np.nan)
+    for n in range(n_persons):
+        start = np.array([rng.uniform(-1, 1), rng.uniform(-1, 1), 1.])
+        speed = np.r_[rng.uniform(-1, 1, 2), 0.] * 0.5
+        positions = {model: start + t[:,np.newaxis]*speed}
+        for node in nodes[1:]:
+            rest_dir, length, amplitude, freq, phase = bones[node]
+            swing = amplitude * np.sin(2*np.pi*freq*t + phase)[:,np.newaxis] * np.cross(rest_dir, [0., 0., 1.])
+            direction = rest_dir + swing
+            direction /= np.linalg.norm(direction, axis=1, keepdims=True)
+            positions[node] = positions[node.parent] + length * direction
+        for node, pos in positions.items():
+            if node.id is not None:
+                Q_gt[:, n, node.id] = pos
+
+    return Q_gt
+
+
+def synthetic_observations(Q, calib_params, noise_px=1., occlusion=0.05, outliers=0., seed=0):
+    '''
+    Project 3D points on all cameras, and add noise, occlusions and outliers.
+
+    INPUTS:
+    - Q: array of shape (..., 3)
+    - calib_params: dict, see retrieve_calib_params
+    - noise_px: standard deviation of the gaussian noise, in pixels
+    - occlusion: proportion of occluded points (low likelihood)
+    - outliers: proportion of outliers (displaced by up to 200 px)
+    - seed: seed of the random generator
+
+    OUTPUT:
+    - coords_2D: array of shape (n_cams, ..., 3). x, y, likelihood
+    '''
+
+    rng = np.random.default_rng(seed)
+    coords_xy = project_points(Q, calib_params)
+    coords_xy = coords_xy + rng.normal(0, noise_px, coords_xy.shape)
+    is_outlier = rng.random(coords_xy.shape[:-1]) < outliers
+    coords_xy[is_outlier] += rng.uniform(-200, 200, (is_outlier.sum(), 2))
+    likelihood = rng.uniform(0.5, 1., coords_xy.shape[:-1])
+    likelihood[rng.random(likelihood.shape) < occlusion] = 0.1
+
+    return np.concatenate([coords_xy, likelihood[...,np.newaxis]], axis=-1)
+
+
+def synthetic_scene(session_dir, pose_model='HALPE_26', n_cams=4, n_frames=100, n_persons=1, frame_rate=60, noise_px=1., occlusion=0.05, outliers=0., seed=0):
+    '''
+    Create a session directory with a synthetic calibration file,
+    and a trial with the json files of all cameras.
+
+    INPUTS:
+    - session_dir: path of the session directory. Overwritten if it exists
+    - pose_model: name of a model from skeletons.py
+    - n_cams, n_frames, n_persons: scene size
+    - frame_rate: frame rate, in Hz
+    - noise_px, occlusion, outliers: see synthetic_observations
+    - seed: seed of the random generator
+
+    OUTPUTS:
+    - config_dict: configuration dictionary for triangulate_all
+    - Q_gt: ground truth 3D coordinates, see synthetic_motion
+    '''
+
+    if os.path.exists(session_dir):
+        shutil.rmtree(session_dir)
+    calib_dir = os.path.join(session_dir, 'calibration')
+    project_dir = os.path.join(session_dir, 'Trial')
+    os.makedirs(calib_dir)
+    os.makedirs(project_dir)
+
+    calib_file = os.path.join(calib_dir, 'Calib_synthetic.toml')
+    synthetic_calibration(calib_file, n_cams=n_cams)
+    calib_params = retrieve_calib_params(calib_file)
+
+    Q_gt = synthetic_motion(eval(pose_model), n_frames=n_frames, n_persons=n_persons, frame_rate=frame_rate, seed=seed)
+    coords_2D = synthetic_observations(np.nan_to_num(Q_gt), calib_params, noise_px=noise_px, occlusion=occlusion, outliers=outliers, seed=seed)
+
+    # Persons are listed in a random order in each frame, consistent across cameras
+    rng = np.random.default_rng(seed)
+    persons_order = [rng.permutation(n_persons) for f in range(n_frames)]
+    for c in range(n_cams):
+        json_dir = os.path.join(project_dir, 'pose', f'cam{c+1:02d}_json')
+        os.makedirs(json_dir)
+        for f in range(n_frames):
+            people = [{'person_id': [-1], 'pose_keypoints_2d': coords_2D[c, f, n].ravel().tolist()} for n in persons_order[f]]
+            with open(os.path.join(json_dir, f'cam{c+1:02d}_{f:06d}.json'), 'w') as js_f:
+                json.dump({'version': 1.3, 'people': people}, js_f)
+
+    config_dict = {
+        'project': {'project_dir': project_dir, 'multi_person': n_persons>1, 'frame_range': [], 'frame_rate': frame_rate, 'exclude_from_batch': []},
+        'pose': {'pose_model': pose_model, 'vid_img_extension': '.mp4'},
+        'triangulation': {'reproj_error_threshold_triangulation': 15, 'likelihood_threshold_triangulation': 0.3, 'min_cameras_for_triangulation': 2,
+                          'interpolation': 'cubic', 'interp_if_gap_smaller_than': 10, 'fill_large_gaps_with': 'last_value', 'show_interp_indices': True,
+                          'handle_LR_swap': False, 'undistort_points': False, 'make_c3d': False, 'reorder_trc': False}
+        }
+    with open(os.path.join(session_dir, 'Config.toml'), 'w') as f:
+        toml.dump(config_dict, f)
+
+    return config_dict, Q_gt
+
+
+def time_calls(func, args_list, repeat=3):
+    '''
+    Time a function over a list of arguments.
+
+    INPUTS:
+    - func: function to time
+    - args_list: list of tuples of arguments, one per call
+    - repeat: number of times the whole list is run. The fastest run is kept
+
+    OUTPUT:
+    - time_per_call: best time per call, in seconds
+    '''
+
+    best_time = np.inf
+    for r in range(repeat):
+        start = time.perf_counter()
+        for args in args_list:
+            func(*args)
+        best_time = min(best_time, time.perf_counter() - start)
+
+    return best_time / len(args_list)
+
+
+def benchmark_kernels(cams_list=[2, 4, 6, 8], n_points=500, noise_px=1., occlusion=0.05, outliers=0.1, repeat=3, seed=0):
+    '''
+    Time the per-point triangulation functions, for several camera counts.
+
+    INPUTS:
+    - cams_list: list of camera counts
+    - n_points: number of random 3D points to triangulate
+    - noise_px, occlusion, outliers: see synthetic_observations
+    - repeat: see time_calls
+    - seed: seed of the random generator
+
+    OUTPUT:
+    - results: list of dicts with the camera count and the time per point of each function, in microseconds
+    '''
+
+    config_dict = {'triangulation': {'reproj_error_threshold_triangulation': 15, 'min_cameras_for_triangulation': 2,
+                                     'handle_LR_swap': False, 'undistort_points': False}}
+    rng = np.random.default_rng(seed)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for n_cams in cams_list:
+            calib_file = os.path.join(tmp_dir, f'Calib_{n_cams}.toml')
+            synthetic_calibration(calib_file, n_cams=n_cams)
+            P = computeP(calib_file)
+            calib_params = retrieve_calib_params(calib_file)
+
+            Q = rng.uniform([-1, -1, 0], [1, 1, 2], (n_points, 3))
+            coords_2D = synthetic_observations(Q, calib_params, noise_px=noise_px, occlusion=occlusion, outliers=outliers, seed=seed).swapaxes(0,1) # points * cams * 3
+            coords_2D[coords_2D[...,2] < 0.3] = np.nan
+
+            weighted_args = [(P, c[:,0], c[:,1], c[:,2]) for c in coords_2D]
+            best_cameras_args = [(config_dict, c.T, c.T, P, calib_params) for c in coords_2D]
+            results.append({
+                'n_cams': n_cams,
+                'weighted_triangulation_us': time_calls(weighted_triangulation, weighted_args, repeat=repeat) * 1e6,
+                'triangulation_from_best_cameras_us': time_calls(triangulation_from_best_cameras, best_cameras_args, repeat=repeat) * 1e6
+                })
+
+    return results
+
+
+def trc_error(trc_paths, Q_gt, keypoints_ids):
+    '''
+    Mean distance between triangulated and ground truth 3D coordinates.
+    Each trc file is compared to its closest ground truth person.
+
+    INPUTS:
+    - trc_paths: list of paths of triangulated trc files
+    - Q_gt: ground truth, see synthetic_motion
+    - keypoints_ids: ids of the trc markers, in the order of the trc file
+
+    OUTPUT:
+    - error_mm: mean 3D error, in millimeters
+    '''
+
+    errors = []
+    for trc_path in trc_paths:
+        header, trc_data = read_trc(trc_path)
+        Q_trc = trc_data[:, 2:].reshape(len(trc_data), -1, 3)[..., [2, 0, 1]] # Y-up to Z-up
+        errors_persons = [np.nanmean(np.linalg.norm(Q_trc - Q_gt[:len(Q_trc), n, keypoints_ids], axis=-1)) for n in range(Q_gt.shape[1])]
+        errors.append(np.nanmin(errors_persons))
+
+    return float(np.mean(errors)) * 1000
+
+
+def benchmark_triangulate_all(scenes, pose_model='HALPE_26', noise_px=1., occlusion=0.05, outliers=0.1, triangulation_options={}, seed=0):
+    '''
+    Time the whole triangulation stage on synthetic scenes.
+
+    INPUTS:
+    - scenes: list of (n_cams, n_frames, n_persons) tuples
+    - pose_model: name of a model from skeletons.py
+    - noise_px, occlusion, outliers: see synthetic_observations
+    - triangulation_options: dict of [triangulation] parameters overriding the defaults
+    - seed: seed of the random generator
+
+    OUTPUT:
+    - results: list of dicts with the scene size, the total time in seconds,
+      the time per frame in milliseconds, and the mean 3D error in millimeters
+    '''
+
+    results = []
+    root_logger = logging.getLogger()
+    logging_level = root_logger.level
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for n_cams, n_frames, n_persons in scenes:
+            session_dir = os.path.join(tmp_dir, f'session_{n_cams}_{n_frames}_{n_persons}')
+            config_dict, Q_gt = synthetic_scene(session_dir, pose_model=pose_model, n_cams=n_cams, n_frames=n_frames, n_persons=n_persons,
+                                                noise_px=noise_px, occlusion=occlusion, outliers=outliers, seed=seed)
+            config_dict['triangulation'].update(triangulation_options)
+
+            root_logger.setLevel(logging.WARNING)
+            os.chdir(session_dir)
+            try:
+                start = time.perf_counter()
+                triangulate_all(config_dict)
+                elapsed = time.perf_counter() - start
+            finally:
+                os.chdir(cwd)
+                root_logger.setLevel(logging_level)
+
+            keypoints_ids = [node.id for node in PreOrderIter(eval(pose_model)) if node.id is not None]
+            pose3d_dir = os.path.join(config_dict['project']['project_dir'], 'pose-3d')
+            trc_paths = [os.path.join(pose3d_dir, t) for t in sorted(os.listdir(pose3d_dir)) if t.endswith('.trc')]
+            results.append({
+                'n_cams': n_cams, 'n_frames': n_frames, 'n_persons': n_persons,
+                'time_s': elapsed,
+                'time_per_frame_ms': elapsed / n_frames * 1000,
+                'error_mm': trc_error(trc_paths, Q_gt, keypoints_ids)
+                })
+
+    return results
+
+
+def check_tracking(n_cams=4, n_frames=80, n_persons=3, reid_max_distance=0.3, pose_model='HALPE_26', noise_px=1., occlusion=0.05, outliers=0.1, seed=0):
+    '''
+    Check that no frame is lost when constant velocity tracking and the
+    re-identification gate are used together.
+    All synthetic persons are visible during the whole sequence, so every
+    frame of every trc file should be triangulated. Gaps are neither
+    interpolated nor filled, so that a lost frame stays empty.
+
+    INPUTS:
+    - n_cams, n_frames, n_persons: scene size
+    - reid_max_distance: re-identification gate, in meters
+    - pose_model: name of a model from skeletons.py
+    - noise_px, occlusion, outliers: see synthetic_observations
+    - seed: seed of the random generator
+
+    OUTPUT:
+    - result: dict with the number of lost frames of each person and the mean 3D error in millimeters.
+      Raises an AssertionError if any frame is lost
+    '''
+
+    root_logger = logging.getLogger()
+    logging_level = root_logger.level
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        session_dir = os.path.join(tmp_dir, 'session_tracking')
+        config_dict, Q_gt = synthetic_scene(session_dir, pose_model=pose_model, n_cams=n_cams, n_frames=n_frames, n_persons=n_persons,
+                                            noise_px=noise_px, occlusion=occlusion, outliers=outliers, seed=seed)
+        config_dict['triangulation'].update({'constant_velocity_tracking': True, 'reid_max_distance': reid_max_distance,
+                                             'interpolation': 'none', 'fill_large_gaps_with': 'nan'})
+
+        root_logger.setLevel(logging.WARNING)
+        os.chdir(session_dir)
+        try:
+            triangulate_all(config_dict)
+        finally:
+            os.chdir(cwd)
+            root_logger.setLevel(logging_level)
+
+        keypoints_ids = [node.id for node in PreOrderIter(eval(pose_model)) if node.id is not None]
+        pose3d_dir = os.path.join(config_dict['project']['project_dir'], 'pose-3d')
+        trc_paths = [os.path.join(pose3d_dir, t) for t in sorted(os.listdir(pose3d_dir)) if t.endswith('.trc')]
+        lost_frames = []
+        for trc_path in trc_paths:
+            header, trc_data = read_trc(trc_path)
+            lost_frames.append(int(np.isnan(trc_data[:, 2:]).all(axis=1).sum() + n_frames - len(trc_data)))
+        error_mm = trc_error(trc_paths, Q_gt, keypoints_ids)
+
+    assert len(lost_frames) == n_persons and not any(lost_frames), \
+        f'Tracking lost frames of persons always in view: {lost_frames} frames lost out of {n_frames}, for {len(lost_frames)} trc files and {n_persons} persons.'
+
+    return {'n_cams': n_cams, 'n_frames': n_frames, 'n_persons': n_persons, 'reid_max_distance': reid_max_distance,
+            'lost_frames': lost_frames, 'error_mm': error_mm}
+
+
+def benchmark_all(output_path='benchmark_triangulation.json', cams_list=[2, 4, 6, 8], frames_list=[50, 200], persons_list=[1, 2],
+                  pose_model='HALPE_26', noise_px=1., occlusion=0.05, outliers=0.1, triangulation_options={}, seed=0):
+    '''
+    Run the kernel and end-to-end triangulation benchmarks, and save the results as json.
+
+    INPUTS:
+    - output_path: path of the json file to write
+    - cams_list, frames_list, persons_list: camera, frame and person counts to benchmark.
+      The end-to-end benchmark is run on all their combinations
+    - pose_model: name of a model from skeletons.py
+    - noise_px, occlusion, outliers: see synthetic_observations
+    - triangulation_options: dict of [triangulation] parameters overriding the defaults
+    - seed: seed of the random generator
+
+    OUTPUT:
+    - results: dict of results, also written to output_path
+    '''
+
+    scenes = [(n_cams, n_frames, n_persons) for n_cams in cams_list for n_frames in frames_list for n_persons in persons_list]
+
+    logging.info('Benchmarking per-point triangulation...')
+    kernels = benchmark_kernels(cams_list, noise_px=noise_px, occlusion=occlusion, outliers=outliers, seed=seed)
+    logging.info('Benchmarking triangulate_all...')
+    end_to_end = benchmark_triangulate_all(scenes, pose_model=pose_model, noise_px=noise_px, occlusion=occlusion, outliers=outliers,
+                                           triangulation_options=triangulation_options, seed=seed)
+    logging.info('Checking constant velocity tracking...')
+    tracking = check_tracking(pose_model=pose_model, noise_px=noise_px, occlusion=occlusion, outliers=outliers, seed=seed)
+
+    results = {
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'version': __version__,
+        'platform': {'python': platform.python_version(), 'numpy': np.__version__, 'opencv': cv2.__version__,
+                     'machine': platform.machine(), 'processor': platform.processor(), 'system': platform.system()},
+        'parameters': {'pose_model': pose_model, 'noise_px': noise_px, 'occlusion': occlusion, 'outliers': outliers,
+                       'triangulation_options': triangulation_options, 'seed': seed},
+        'kernels': kernels,
+        'triangulate_all': end_to_end,
+        'tracking': tracking,
+        'peak_memory_mb': peak_memory_mb()
+        }
+    with open(output_path, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    logging.info(f'Benchmark results saved to {output_path}.')
+
+    return results
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+    benchmark_all(*sys.argv[1:2])
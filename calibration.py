@@ -29,7 +29,7 @@ OUTPUTS:
 
 
 ## INIT
-from Pose2Sim.common import world_to_camera_persp, rotate_cam, quat2mat, euclidean_distance, natural_sort_key, zup2yup
+from Pose2Sim.common import world_to_camera_persp, rotate_cam, quat2mat, euclidean_distance, natural_sort_key, zup2yup, trc_header, write_trc
 
 import os
 import logging
@@ -1175,28 +1175,22 @@ def trc_write(object_coords_3d, trc_path):
     '''
 
     #Header
-    DataRate = CameraRate = OrigDataRate = 1
+    DataRate = 1
     NumFrames = 2
     NumMarkers = len(object_coords_3d)
     keypoints_names = np.arange(NumMarkers)
-    header_trc = ['PathFileType\t4\t(X/Y/Z)\t' + os.path.basename(trc_path), 
-            'DataRate\tCameraRate\tNumFrames\tNumMarkers\tUnits\tOrigDataRate\tOrigDataStartFrame\tOrigNumFrames', 
-            '\t'.join(map(str,[DataRate, CameraRate, NumFrames, NumMarkers, 'm', OrigDataRate, NumFrames])),
-            'Frame#\tTime\t' + '\t\t\t'.join(str(k) for k in keypoints_names) + '\t\t',
-            '\t\t'+'\t'.join([f'X{i+1}\tY{i+1}\tZ{i+1}' for i in range(NumMarkers)])]
+    header_trc = trc_header(os.path.basename(trc_path), keypoints_names, DataRate, NumFrames, orig_data_start_frame=1)
     
     # Zup to Yup coordinate system
     object_coords_3d = pd.DataFrame([np.array(object_coords_3d).flatten(), np.array(object_coords_3d).flatten()])
     object_coords_3d = zup2yup(object_coords_3d)
     
-    #Add Frame# and Time columns
-    object_coords_3d.index = np.array(range(0, NumFrames)) + 1
-    object_coords_3d.insert(0, 't', object_coords_3d.index / DataRate)
+    #Frame# and Time columns
+    frames = np.arange(0, NumFrames) + 1
+    times = frames / DataRate
 
     #Write file
-    with open(trc_path, 'w') as trc_o:
-        [trc_o.write(line+'\n') for line in header_trc]
-        object_coords_3d.to_csv(trc_o, sep='\t', index=True, header=None, lineterminator='\n')
+    write_trc(trc_path, header_trc, frames, times, object_coords_3d.to_numpy())
 
     return trc_path
 
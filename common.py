@@ -11,9 +11,12 @@ Functions shared between modules, and other utilities
 '''
 
 ## INIT
+import os
+import glob
 import toml
 import json
 import numpy as np
+import pandas as pd
 import re
 import cv2
 import c3d
@@ -128,6 +131,75 @@ def retrieve_calib_params(calib_file):
     return calib_params
 
 
+def undistortion_lut(calib_params, step=2):
+    '''
+    Precompute, for each camera, the undistorted coordinates of a regular grid 
+    covering the image. Points are then undistorted by bilinear interpolation 
+    in this lookup table instead of by iteratively inverting the distortion model.
+    Only worth it when the calibration stays the same for many frames.
+
+    INPUTS:
+    - calib_params: dict, see retrieve_calib_params
+    - step: grid spacing in pixels
+
+    OUTPUT:
+    - luts: list of arrays (n_rows, n_cols, 2), one per camera, 
+    with the undistorted (x, y) coordinates of the grid points
+    '''
+
+    luts = []
+    for c in range(len(calib_params['K'])):
+        w, h = [int(s) for s in calib_params['S'][c]]
+        grid_x, grid_y = np.meshgrid(np.arange(0, w+step, step), np.arange(0, h+step, step))
+        grid = np.stack((grid_x, grid_y), axis=-1).reshape(-1,1,2).astype(np.float32)
+        undistorted_grid = cv2.undistortPoints(grid, calib_params['K'][c], calib_params['dist'][c], None, calib_params['optim_K'][c])
+        luts.append(undistorted_grid.reshape(grid_x.shape + (2,)))
+
+    return luts
+
+
+def undistort_points_batch(x, y, calib_params, luts=None, lut_step=2):
+    '''
+    Undistort all points of each camera with a single call per camera.
+    Arrays are modified in place.
+    
+    INPUTS:
+    - x, y: arrays of shape (n_cams, ...), any number of points per camera. nan points stay nan
+    - calib_params: dict, see retrieve_calib_params
+    - luts: optional lookup tables from undistortion_lut. Points outside the table 
+    are undistorted with cv2.undistortPoints
+    - lut_step: grid spacing used to build the lookup tables
+
+    OUTPUTS:
+    - x, y: undistorted coordinates (same arrays)
+    '''
+
+    for c in range(len(x)):
+        points = np.stack((x[c].ravel(), y[c].ravel()), axis=-1).astype(np.float32)
+        undistorted_points = np.full(points.shape, np.nan)
+        valid = np.isfinite(points).all(axis=1)
+        
+        if luts is not None:
+            lut = luts[c]
+            grid_coords = points[valid] / lut_step
+            in_lut = (grid_coords >= 0).all(axis=1) & (grid_coords[:,0] < lut.shape[1]-1) & (grid_coords[:,1] < lut.shape[0]-1)
+            cols, rows = grid_coords[in_lut,0], grid_coords[in_lut,1]
+            col0, row0 = cols.astype(int), rows.astype(int)
+            dc, dr = (cols - col0)[:,None], (rows - row0)[:,None]
+            lut_points = (lut[row0,col0] * (1-dc) * (1-dr) + lut[row0,col0+1] * dc * (1-dr) 
+                        + lut[row0+1,col0] * (1-dc) * dr + lut[row0+1,col0+1] * dc * dr)
+            valid_idx = np.flatnonzero(valid)
+            undistorted_points[valid_idx[in_lut]] = lut_points
+            valid[valid_idx[in_lut]] = False # left to undistort with opencv
+        
+        if valid.any():
+            undistorted_points[valid] = cv2.undistortPoints(points[valid].reshape(-1,1,2), calib_params['K'][c], calib_params['dist'][c], None, calib_params['optim_K'][c]).reshape(-1,2)
+        x[c] = undistorted_points[:,0].reshape(np.shape(x[c]))
+        y[c] = undistorted_points[:,1].reshape(np.shape(y[c]))
+    
+    return x, y
+
+
 def computeP(calib_file, undistort=False):
     '''
     Compute projection matrices from toml calibration file.
@@ -213,6 +285,47 @@ def reprojection(P_all, Q):
     return x_calc, y_calc
         
 
+def project_points(Q, calib_params):
+    '''
+    Project 3D points on all cameras, taking lens distortions into account.
+    Vectorized equivalent of cv2.projectPoints (OpenCV distortion model 
+    with up to 8 coefficients k1, k2, p1, p2, k3, k4, k5, k6).
+
+    INPUTS:
+    - Q: array of 3D points (..., 3), or homogeneous (..., 4)
+    - calib_params: dict, see retrieve_calib_params
+
+    OUTPUT:
+    - coords_2D: array (n_cams, ..., 2) of pixel coordinates
+    '''
+
+    Q = np.asarray(Q, dtype=float)[...,:3]
+    R_mat = np.array(calib_params['R_mat'], dtype=float) # cams * 3 * 3
+    T = np.array(calib_params['T'], dtype=float).reshape(-1,3)
+    K = np.array(calib_params['K'], dtype=float)
+    dist = np.zeros((len(K), 8))
+    for c, d in enumerate(calib_params['dist']):
+        d = np.ravel(d)[:8]
+        dist[c,:len(d)] = d
+    k1, k2, p1, p2, k3, k4, k5, k6 = [dist[:,i].reshape((-1,)+(1,)*(Q.ndim-1)) for i in range(8)]
+
+    # World to camera coordinates, then normalized image plane
+    Q_cam = np.einsum('cij,...j->c...i', R_mat, Q) + T.reshape((-1,)+(1,)*(Q.ndim-1)+(3,))
+    x, y = Q_cam[...,0] / Q_cam[...,2], Q_cam[...,1] / Q_cam[...,2]
+
+    # Lens distortions
+    r2 = x**2 + y**2
+    radial = (1 + r2*(k1 + r2*(k2 + r2*k3))) / (1 + r2*(k4 + r2*(k5 + r2*k6)))
+    x_dist = x*radial + 2*p1*x*y + p2*(r2 + 2*x**2)
+    y_dist = y*radial + p1*(r2 + 2*y**2) + 2*p2*x*y
+
+    # Pixel coordinates
+    fx, fy, cx, cy = [K[:,i,j].reshape((-1,)+(1,)*(Q.ndim-1)) for i,j in [(0,0),(1,1),(0,2),(1,2)]]
+    coords_2D = np.stack((fx*x_dist + cx, fy*y_dist + cy), axis=-1)
+
+    return coords_2D
+
+
 def euclidean_distance(q1, q2):
     '''
     Euclidean distance between 2 points (N-dim).
@@ -238,6 +351,28 @@ def euclidean_distance(q1, q2):
     return euc_dist
 
 
+def peak_memory_mb():
+    '''
+    Peak resident memory of the current process, in MB.
+
+    OUTPUT:
+    - peak_memory: float, or None if it cannot be determined on this platform
+    '''
+
+    try:
+        import resource
+        peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak_memory / 1024**2 if sys.platform == 'darwin' else peak_memory / 1024 # bytes on MacOS, kilobytes on Linux
+    except ImportError: # Windows
+        pass
+    try:
+        import psutil
+        mem_info = psutil.Process().memory_info()
+        return getattr(mem_info, 'peak_wset', mem_info.rss) / 1024**2
+    except ImportError:
+        return None
+
+
 def world_to_camera_persp(r, t):
     '''
     Converts rotation R and translation T 
@@ -359,6 +494,110 @@ def sort_stringlist_by_last_number(string_list):
     return sorted(string_list, key=sort_by_last_number)
 
 
+def json_frame_number(json_file_name):
+    '''
+    Frame number of a json file, i.e. the last number in its name.
+    '''
+
+    return int(re.split(r'(\d+)', json_file_name)[-2])
+
+
+def synced_json_name(json_file_name, frame):
+    '''
+    Rename a json file so that its last number is the given (synchronized) frame number.
+
+    Example: synced_json_name('cam01_000012.json', 5) gives 'cam01_000005.json'
+    '''
+
+    j_split = re.split(r'(\d+)', json_file_name)
+    j_split[-2] = f'{frame:06d}'
+    return ''.join(j_split)
+
+
+def frame_json_files(json_files_names, offset=0):
+    '''
+    Map synchronized frame numbers to the json files of a camera.
+    The synchronized frame of a file is its frame number minus the camera offset.
+    Files which would fall before the first synchronized frame are left out.
+
+    INPUTS:
+    - json_files_names: list of json file names of a camera
+    - offset: int. Frame offset of the camera, as computed by synchronization
+
+    OUTPUT:
+    - frame_files: dict {synchronized frame number: json file name}
+    '''
+
+    frame_files = {}
+    for j_file in json_files_names:
+        frame = json_frame_number(j_file) - offset
+        if frame >= 0:
+            frame_files[frame] = j_file
+
+    return frame_files
+
+
+def read_sync_offsets(project_dir):
+    '''
+    Read the frame offset of each camera from the synchronization manifest
+    (sync_offsets.json), if synchronization was run with sync_output = 'manifest'.
+
+    INPUTS:
+    - project_dir: path of the trial directory
+
+    OUTPUT:
+    - offsets: dict {json directory name: frame offset}. Empty if there is no manifest
+    '''
+
+    manifest_path = os.path.join(project_dir, 'sync_offsets.json')
+    if not os.path.isfile(manifest_path):
+        return {}
+    with open(manifest_path) as m_f:
+        manifest = json.load(m_f)
+
+    return {cam: int(cam_sync['offset']) for cam, cam_sync in manifest['cameras'].items()}
+
+
+def read_audio_offsets(project_dir):
+    '''
+    Read the video synchronization manifest (audio_offsets.json) written by
+    pipelineMarkerless.synchronisation.
+
+    INPUTS:
+    - project_dir: path of the trial directory
+
+    OUTPUT:
+    - audio_offsets: dict with the start time of each raw video ('videos': {name: {'start': s, ...}})
+      and the common 'duration', in seconds. Empty if there is no manifest
+    '''
+
+    manifest_path = os.path.join(project_dir, 'audio_offsets.json')
+    if not os.path.isfile(manifest_path):
+        return {}
+    with open(manifest_path) as m_f:
+        return json.load(m_f)
+
+
+def find_video_files(project_dir, vid_img_extension):
+    '''
+    Video files of a trial: synchronized videos if there are any,
+    otherwise raw videos (virtual synchronization, see read_audio_offsets).
+
+    INPUTS:
+    - project_dir: path of the trial directory
+    - vid_img_extension: str. Extension of the video files
+
+    OUTPUT:
+    - video_files: list of video paths
+    '''
+
+    video_files = glob.glob(os.path.join(project_dir, 'videos', '*'+vid_img_extension))
+    if video_files == []:
+        video_files = glob.glob(os.path.join(project_dir, 'videos_raw', '*'+vid_img_extension))
+
+    return video_files
+
+
 def natural_sort_key(s):
     '''
     Sorts list of strings with numbers in natural order (alphabetical and numerical)
@@ -386,6 +625,137 @@ def zup2yup(Q):
     return Q
     
 
+def trc_header(trc_name, marker_names, frame_rate, num_frames, orig_data_start_frame=0, orig_num_frames=None, units='m'):
+    '''
+    Build the 5 header lines of an OpenSim compatible trc file.
+
+    INPUTS:
+    - trc_name: file name written in the first line
+    - marker_names: list of marker names
+    - frame_rate: int or float
+    - num_frames: int
+    - orig_data_start_frame: int
+    - orig_num_frames: int. Defaults to num_frames
+    - units: string
+
+    OUTPUT:
+    - header: list of 5 strings, without line terminators
+    '''
+
+    orig_num_frames = num_frames if orig_num_frames is None else orig_num_frames
+    header = ['PathFileType\t4\t(X/Y/Z)\t' + trc_name, 
+            'DataRate\tCameraRate\tNumFrames\tNumMarkers\tUnits\tOrigDataRate\tOrigDataStartFrame\tOrigNumFrames', 
+            '\t'.join(map(str,[frame_rate, frame_rate, num_frames, len(marker_names), units, frame_rate, orig_data_start_frame, orig_num_frames])),
+            'Frame#\tTime\t' + '\t\t\t'.join(str(m) for m in marker_names) + '\t\t',
+            '\t\t'+'\t'.join([f'X{i+1}\tY{i+1}\tZ{i+1}' for i in range(len(marker_names))])]
+    
+    return header
+
+
+def write_trc(trc_path, header, frames, times, coords, float_format='%.6f'):
+    '''
+    Write a trc file. All rows are formatted at once, 
+    and nan values are written as empty fields.
+
+    INPUTS:
+    - trc_path: output path of the trc file
+    - header: list of 5 header lines (see trc_header)
+    - frames: array of frame numbers (n_frames)
+    - times: array of times (n_frames)
+    - coords: array of marker coordinates (n_frames, 3*n_markers)
+    - float_format: printf-style format of the time and coordinate values
+
+    OUTPUT:
+    - trc file
+    '''
+
+    coords = np.asarray(coords, dtype=float).reshape(len(frames), -1)
+    data = np.column_stack((frames, times, coords))
+    row_format = '\t'.join(['%d'] + [float_format]*(data.shape[1]-1))
+    rows = '\n'.join([row_format % tuple(row) for row in data.tolist()])
+    rows = rows.replace('nan', '')
+
+    with open(trc_path, 'w') as trc_o:
+        trc_o.write('\n'.join(line.rstrip('\n') for line in header) + '\n')
+        trc_o.write(rows + '\n')
+
+    return trc_path
+
+
+def read_trc_header(trc_file):
+    '''
+    Parse the 5 header lines of a trc file.
+
+    INPUT:
+    - trc_file: open file object, positioned at the beginning of the file
+
+    OUTPUT:
+    - header: dict with lines (list of 5 strings), marker_names, frame_rate, 
+    num_frames, units, orig_data_start_frame
+    '''
+
+    lines = [trc_file.readline().rstrip('\r\n') for _ in range(5)]
+    header_keys = lines[1].split('\t')
+    header_values = lines[2].split('\t')
+    header_info = dict(zip(header_keys, header_values))
+    marker_names = [m for m in lines[3].split('\t')[2::3] if m != '']
+    frame_rate = float(header_info.get('DataRate', 'nan'))
+    frame_rate = int(frame_rate) if frame_rate.is_integer() else frame_rate
+
+    header = {'lines': lines,
+              'marker_names': marker_names,
+              'frame_rate': frame_rate,
+              'num_frames': int(float(header_info.get('NumFrames', '0'))),
+              'units': header_info.get('Units', 'm'),
+              'orig_data_start_frame': header_info.get('OrigDataStartFrame')}
+
+    return header
+
+
+def read_trc(trc_path, marker_names=None, chunksize=None):
+    '''
+    Read a trc file in a single pass.
+    Empty fields are read as nan.
+
+    INPUTS:
+    - trc_path: path to the trc file
+    - marker_names: list of markers to read, in this order. Defaults to all markers
+    - chunksize: int or None. If set, data is returned as an iterator of arrays 
+    of at most chunksize frames, which keeps memory low on very long files
+
+    OUTPUTS:
+    - header: dict, see read_trc_header
+    - data: array (n_frames, 2+3*n_markers) with Frame#, Time, and coordinates columns,
+    or iterator of such arrays if chunksize is set
+    '''
+
+    trc_file = open(trc_path, 'r')
+    header = read_trc_header(trc_file)
+    all_marker_names = header['marker_names']
+    if marker_names is None:
+        cols = list(range(2+3*len(all_marker_names)))
+    else:
+        missing_markers = [m for m in marker_names if m not in all_marker_names]
+        if len(missing_markers) > 0:
+            trc_file.close()
+            raise ValueError(f'Markers {missing_markers} are not present in {trc_path}.')
+        cols = [0,1] + [2+3*all_marker_names.index(m)+i for m in marker_names for i in range(3)]
+        header['marker_names'] = list(marker_names)
+
+    reader = pd.read_csv(trc_file, sep='\t', header=None, skip_blank_lines=True, dtype=float, 
+                         usecols=range(2+3*len(all_marker_names)), chunksize=chunksize)
+    if chunksize is None:
+        data = reader.to_numpy()[:,cols]
+        trc_file.close()
+        return header, data
+    else:
+        def chunks():
+            with trc_file, reader:
+                for chunk in reader:
+                    yield chunk.to_numpy()[:,cols]
+        return header, chunks()
+
+
 def extract_trc_data(trc_path):
     '''
     Extract marker names and coordinates from a trc file.
@@ -398,16 +768,10 @@ def extract_trc_data(trc_path):
     - marker_coords: Array of marker coordinates (n_frames, t+3*n_markers)
     '''
 
-    # marker names
-    with open(trc_path, 'r') as file:
-        lines = file.readlines()
-        marker_names_line = lines[3]
-        marker_names = marker_names_line.strip().split('\t')[2::3]
-
-    # time and marker coordinates
-    trc_data_np = np.genfromtxt(trc_path, skip_header=5, delimiter = '\t')[:,1:] 
+    header, trc_data_np = read_trc(trc_path)
+    marker_names = header['marker_names']
 
-    return marker_names, trc_data_np
+    return marker_names, trc_data_np[:,1:]
 
 
 def create_c3d_file(c3d_path, marker_names, trc_data_np):
@@ -24,21 +24,25 @@ OUTPUT:
 ## INIT
 import os
 import glob
+import json
+import math
 import fnmatch
 import numpy as np
 import pandas as pd
 import cv2
 import matplotlib.pyplot as plt
 import logging
+from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor
 
 from scipy import signal
 from scipy.ndimage import gaussian_filter1d
-from statsmodels.nonparametric.smoothers_lowess import lowess
 from filterpy.kalman import KalmanFilter, rts_smoother
 from filterpy.common import Q_discrete_white_noise
 
 from Pose2Sim.common import plotWindow
-from Pose2Sim.common import convert_to_c3d
+from Pose2Sim.common import convert_to_c3d, read_trc, write_trc, find_video_files
+from Pose2Sim.interpolation import find_runs
 
 ## AUTHORSHIP INFORMATION
 __author__ = "David Pagnon"
@@ -92,7 +96,7 @@ def kalman_filter(coords, frame_rate, measurement_noise, process_noise, nb_dimen
     F_per_coord = np.zeros((int(dim_x/nb_dimensions), int(dim_x/nb_dimensions)))
     for i in range(nb_derivatives):
         for j in range(min(i+1, nb_derivatives)):
-            F_per_coord[j,i] = dt**(i-j) / np.math.factorial(i - j)
+            F_per_coord[j,i] = dt**(i-j) / math.factorial(i - j)
     f.F = np.kron(np.eye(nb_dimensions),F_per_coord) 
     # F_per_coord= [[1, dt, dt**2/2], 
                  # [ 0, 1,  dt     ],
@@ -137,6 +141,143 @@ def kalman_filter(coords, frame_rate, measurement_noise, process_noise, nb_dimen
     return coords_filt
 
 
+def kalman_model(frame_rate, measurement_noise, process_noise, nb_derivatives=3):
+    '''
+    Matrices of the 1D Kalman model used by kalman_filter(nb_dimensions=1).
+
+    INPUTS:
+    - frame_rate: integer
+    - measurement_noise: integer
+    - process_noise: integer
+    - nb_derivatives: integer, number of derivatives (3 if constant acceleration model)
+
+    OUTPUTS:
+    - F: state transition matrix
+    - H: measurement vector (only position)
+    - R: measurement noise variance
+    - Q: process noise matrix
+    '''
+
+    dt = 1/frame_rate
+    F = np.zeros((nb_derivatives, nb_derivatives))
+    for i in range(nb_derivatives):
+        for j in range(i+1):
+            F[j,i] = dt**(i-j) / math.factorial(i - j)
+    H = np.zeros(nb_derivatives)
+    H[0] = 1
+    R = measurement_noise**2
+    Q = Q_discrete_white_noise(nb_derivatives, dt=dt, var=process_noise**2)
+
+    return F, H, R, Q
+
+
+def kalman_filter_batch(Z, mask, frame_rate, measurement_noise, process_noise, nb_derivatives=3, smooth=True):
+    '''
+    Kalman filter or Kalman smoother of many 1D signals at once.
+    Same model as kalman_filter(nb_dimensions=1): each sequence of valid values 
+    of each column is filtered independently, and missing values are left untouched.
+
+    The covariances and gains of the filter do not depend on the measurements, 
+    so they are computed once for all sequences, as a function of the number 
+    of frames since the start of the sequence. All sequences are then filtered 
+    in parallel, aligned on their first frame.
+    
+    INPUTS:
+    - Z: array of shape (frames, columns)
+    - mask: boolean array of shape (frames, columns), True where values are missing
+    - frame_rate: integer
+    - measurement_noise: integer
+    - process_noise: integer
+    - nb_derivatives: integer, number of derivatives (3 if constant acceleration model)
+    - smooth: boolean. True if double pass (recommended), False if single pass (if real-time)
+    
+    OUTPUTS:
+    - Z_filt: filtered array
+    '''
+
+    Z_filt = Z.copy()
+    cols, starts, stops = find_runs(~mask)
+    if len(cols) == 0:
+        return Z_filt
+    lengths = stops - starts
+    max_length = lengths.max()
+
+    # sequences aligned on their first frame: max_length * nb_sequences
+    steps = np.arange(max_length)[:,np.newaxis]
+    is_valid = steps < lengths
+    frame_idx = np.where(is_valid, starts + steps, starts)
+    Z_seq = Z[frame_idx, cols]
+
+    F, H, R, Q = kalman_model(frame_rate, measurement_noise, process_noise, nb_derivatives=nb_derivatives)
+    I = np.eye(nb_derivatives)
+
+    # Initial state: position, and derivatives from the first frames (0 if the sequence is too short)
+    x = np.zeros((len(cols), nb_derivatives))
+    for n_der in range(nb_derivatives):
+        if max_length > n_der:
+            x[:,n_der] = np.where(lengths > n_der, np.diff(np.nan_to_num(Z_seq[:n_der+1]), n=n_der, axis=0)[0], 0)
+    P = I * measurement_noise
+
+    # Forward pass: predict and update for each frame
+    xs = np.empty((max_length, len(cols), nb_derivatives))
+    Ps = np.empty((max_length, nb_derivatives, nb_derivatives))
+    for k in range(max_length):
+        x = x @ F.T
+        P = F @ P @ F.T + Q
+        K = P @ H / (H @ P @ H + R)
+        x = x + (Z_seq[k] - x @ H)[:,np.newaxis] * K
+        I_KH = I - np.outer(K, H)
+        P = I_KH @ P @ I_KH.T + np.outer(K, K) * R
+        xs[k], Ps[k] = x, P
+
+    # Backward pass: RTS smoother, starting from the end of each sequence
+    if smooth:
+        for k in range(max_length-2, -1, -1):
+            P_pred = F @ Ps[k] @ F.T + Q
+            C = Ps[k] @ F.T @ np.linalg.inv(P_pred)
+            x_smooth = xs[k] + (xs[k+1] - xs[k] @ F.T) @ C.T
+            xs[k] = np.where((k < lengths-1)[:,np.newaxis], x_smooth, xs[k])
+
+    Z_filt[frame_idx[is_valid], np.broadcast_to(cols, is_valid.shape)[is_valid]] = xs[...,0][is_valid]
+
+    return Z_filt
+
+
+def kalman_filter_2d(config_dict, frame_rate, Q):
+    '''
+    Kalman filter of all columns at once
+    Deals with nans
+
+    If per_marker is true, each marker is filtered with the 3D model of 
+    kalman_filter(nb_dimensions=3): its x, y, z coordinates share the same 
+    sequences of valid frames. Since the 3D model is block-diagonal, it is 
+    then equivalent to filtering the three coordinates with the 1D model.
+    
+    INPUT:
+    - Q: numpy array of shape (frames, columns), with x, y, z columns for each marker
+    - trustratio: int, ratio process_noise/measurement_noise
+    - frame_rate: int
+    - smooth: boolean, True if double pass (recommended), False if single pass (if real-time)
+    - per_marker: boolean, True to use the 3D model of each marker
+
+    OUTPUT:
+    - Q_filt: Filtered numpy array
+    '''
+
+    trustratio = int(config_dict.get('filtering').get('kalman').get('trust_ratio'))
+    smooth = int(config_dict.get('filtering').get('kalman').get('smooth'))
+    per_marker = config_dict.get('filtering').get('kalman').get('per_marker', False)
+    measurement_noise = 20
+    process_noise = measurement_noise * trustratio
+
+    mask = np.isnan(Q) | (Q == 0)
+    if per_marker:
+        mask = np.repeat(mask.reshape(len(Q), -1, 3).any(axis=2), 3, axis=1)
+    Q_filt = kalman_filter_batch(Q, mask, frame_rate, measurement_noise, process_noise, nb_derivatives=3, smooth=smooth)
+
+    return Q_filt
+
+
 def kalman_filter_1d(config_dict, frame_rate, col):
     '''
     1D Kalman filter
@@ -157,96 +298,295 @@ def kalman_filter_1d(config_dict, frame_rate, col):
     measurement_noise = 20
     process_noise = measurement_noise * trustratio
 
-    # split into sequences of not nans
-    col_filtered = col.copy()
-    mask = np.isnan(col_filtered)  | col_filtered.eq(0)
-    falsemask_indices = np.where(~mask)[0]
-    gaps = np.where(np.diff(falsemask_indices) > 1)[0] + 1 
-    idx_sequences = np.split(falsemask_indices, gaps)
-    if idx_sequences[0].size > 0:
-        idx_sequences_to_filter = [seq for seq in idx_sequences]
-    
-        # Filter each of the selected sequences
-        for seq_f in idx_sequences_to_filter:
-            col_filtered[seq_f] = kalman_filter(col_filtered[seq_f], frame_rate, measurement_noise, process_noise, nb_dimensions=1, nb_derivatives=3, smooth=smooth).flatten()
+    col_np = col.to_numpy(dtype=float)[:,np.newaxis]
+    mask = np.isnan(col_np) | (col_np == 0)
+    col_filtered = pd.Series(kalman_filter_batch(col_np, mask, frame_rate, measurement_noise, process_noise, nb_derivatives=3, smooth=smooth)[:,0], index=col.index)
 
     return col_filtered
 
 
+def butterworth_sos(order, cutoff, frame_rate):
+    '''
+    Design a low-pass Butterworth filter in second-order sections form,
+    for a dual pass filtering of total order "order".
+
+    INPUTS:
+    - order: int, total order of the dual pass filter
+    - cutoff: int, cut-off frequency
+    - frame_rate: int
+
+    OUTPUTS:
+    - sos: array of second-order sections
+    - padlen: int, minimum length of a sequence to be filtered
+    '''
+
+    sos = signal.butter(order/2, cutoff/(frame_rate/2), 'low', analog = False, output='sos')
+    padlen = 3 * (int(order/2) + 1) # same as 3 * max(len(a), len(b))
+
+    return sos, padlen
+
+
+def mask_groups(mask):
+    '''
+    Group the columns which share the same mask, and find their sequences of valid values.
+
+    INPUT:
+    - mask: boolean array of shape (frames, columns), True where values are missing
+
+    OUTPUT:
+    - groups: list of (cols, starts, stops) tuples, with the indices of the columns
+    of the group, and the first and last+1 frames of their valid sequences
+    '''
+
+    patterns, pattern_ids = np.unique(mask, axis=1, return_inverse=True)
+    pattern_ids = pattern_ids.ravel()
+    groups = []
+    for p in range(patterns.shape[1]):
+        _, starts, stops = find_runs(~patterns[:,p])
+        groups.append((np.flatnonzero(pattern_ids == p), starts, stops))
+
+    return groups
+
+
+def sosfiltfilt_by_mask(Q, sos, padlen, mask, groups=None):
+    '''
+    Zero-phase filtering of each column of an array, on its sequences of valid values.
+    Columns which share the same mask are filtered together,
+    and each sequence longer than padlen is filtered separately.
+    Shorter sequences are left untouched.
+
+    INPUTS:
+    - Q: array of shape (frames, columns)
+    - sos: array of second-order sections
+    - padlen: int, minimum length of a sequence to be filtered
+    - mask: boolean array of shape (frames, columns), True where values are missing
+    - groups: output of mask_groups(mask), if already computed
+
+    OUTPUT:
+    - Q_filt: filtered array
+    '''
+
+    if groups is None:
+        groups = mask_groups(mask)
+
+    Q_filt = Q.copy()
+    for cols, starts, stops in groups:
+        for start, stop in zip(starts, stops):
+            if stop - start > padlen:
+                Q_filt[start:stop, cols] = signal.sosfiltfilt(sos, Q[start:stop, cols], axis=0, padlen=padlen)
+
+    return Q_filt
+
+
+def butterworth_residuals(Q, order, frame_rate, cutoffs, nb_dimensions=3):
+    '''
+    Residuals between raw and Butterworth filtered coordinates, for a grid of cut-off frequencies.
+    Each filter is designed once and applied to all columns at once.
+
+    INPUTS:
+    - Q: numpy array of shape (frames, nb_dimensions*markers)
+    - order: int
+    - frame_rate: int
+    - cutoffs: array of cut-off frequencies
+    - nb_dimensions: number of coordinates per marker (1 for independent columns)
+
+    OUTPUT:
+    - residuals: array of shape (len(cutoffs), markers). Root mean square of the 
+    differences between raw and filtered valid coordinates of each marker
+    '''
+
+    mask = np.isnan(Q) | (Q == 0)
+    groups = mask_groups(mask)
+    squared_residuals = np.zeros((len(cutoffs), Q.shape[1]))
+    for i, cutoff in enumerate(cutoffs):
+        sos, padlen = butterworth_sos(order, cutoff, frame_rate)
+        Q_filt = sosfiltfilt_by_mask(Q, sos, padlen, mask, groups=groups)
+        squared_residuals[i] = np.sum(np.where(mask, 0, Q - Q_filt)**2, axis=0)
+    
+    # combine x, y, z coordinates of each marker
+    nb_valid = np.count_nonzero(~mask, axis=0).reshape(-1, nb_dimensions).sum(axis=1)
+    residuals = np.sqrt(squared_residuals.reshape(len(cutoffs), -1, nb_dimensions).sum(axis=2) / np.maximum(nb_valid, 1))
+
+    return residuals
+
+
+def residual_analysis(residuals, cutoffs):
+    '''
+    Choose cut-off frequencies by residual analysis (Winter, 2009).
+    At high cut-off frequencies, the residual is mostly noise and decreases 
+    linearly. The line fitted on the upper half of the grid intercepts the 
+    y-axis at the residual of the noise. The chosen cut-off frequency is 
+    the one for which the residual reaches this value.
+
+    INPUTS:
+    - residuals: array of shape (len(cutoffs), markers), see butterworth_residuals
+    - cutoffs: array of cut-off frequencies, in increasing order
+
+    OUTPUT:
+    - chosen_cutoffs: array of cut-off frequencies, one per marker
+    '''
+
+    cutoffs = np.asarray(cutoffs, dtype=float)
+    residuals = np.nan_to_num(residuals)
+    linear_part = cutoffs >= cutoffs[-1]/2
+    _, noise_residual = np.polyfit(cutoffs[linear_part], residuals[linear_part], 1)
+
+    # first cut-off below the noise residual, linearly interpolated with the previous one
+    is_below = residuals <= noise_residual
+    idx = np.argmax(is_below, axis=0)
+    idx_prev = np.maximum(idx-1, 0)
+    markers = np.arange(residuals.shape[1])
+    res_prev, res_next = residuals[idx_prev, markers], residuals[idx, markers]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ratio = np.where(res_prev > res_next, (res_prev - noise_residual) / (res_prev - res_next), 0)
+    chosen_cutoffs = cutoffs[idx_prev] + np.clip(ratio, 0, 1) * (cutoffs[idx] - cutoffs[idx_prev])
+    chosen_cutoffs[~is_below.any(axis=0)] = cutoffs[-1]
+
+    return chosen_cutoffs
+
+
+def butterworth_auto_cutoffs(config_dict, frame_rate, Q, nb_dimensions=3):
+    '''
+    Cut-off frequencies of the Butterworth filter chosen by residual analysis, for each marker.
+    The grid goes from 1 Hz to 90% of the Nyquist frequency, every 1 Hz, unless 
+    auto_cut_off_range = [min, max] is set in [filtering.butterworth].
+
+    INPUT:
+    - Q: numpy array of shape (frames, nb_dimensions*markers)
+    - order, auto_cut_off_range: from Config.toml
+    - frame_rate: int
+    - nb_dimensions: number of coordinates per marker (1 for independent columns)
+
+    OUTPUT:
+    - cutoffs: array of cut-off frequencies, one per marker, rounded to 0.1 Hz
+    '''
+
+    order = int(config_dict.get('filtering').get('butterworth').get('order'))
+    cutoff_range = config_dict.get('filtering').get('butterworth').get('auto_cut_off_range', [1, int(0.9 * frame_rate/2)])
+    cutoffs_grid = np.arange(cutoff_range[0], cutoff_range[1]+1e-6, 1.)
+
+    residuals = butterworth_residuals(Q, order, frame_rate, cutoffs_grid, nb_dimensions=nb_dimensions)
+    cutoffs = np.round(residual_analysis(residuals, cutoffs_grid), 1)
+
+    return cutoffs
+
+
+def butterworth_filter_2d(config_dict, frame_rate, Q):
+    '''
+    Zero-phase Butterworth filter (dual pass) of all columns at once
+    Deals with nans
+
+    The cut-off frequency can be a number, 'auto' to choose it for each marker 
+    by residual analysis, or a list with one value per column. Columns with 
+    the same cut-off frequency are filtered together.
+
+    INPUT:
+    - Q: numpy array of shape (frames, columns)
+    - order: int
+    - cutoff: int, 'auto', or list of one value per column
+    - frame_rate: int
+
+    OUTPUT:
+    - Q_filt: Filtered numpy array
+    '''
+
+    order = int(config_dict.get('filtering').get('butterworth').get('order'))
+    cutoff = config_dict.get('filtering').get('butterworth').get('cut_off_frequency')
+    if cutoff == 'auto':
+        cutoff = np.repeat(butterworth_auto_cutoffs(config_dict, frame_rate, Q), 3)
+    elif np.isscalar(cutoff):
+        cutoff = int(cutoff)
+
+    mask = np.isnan(Q) | (Q == 0)
+    if np.isscalar(cutoff):
+        sos, padlen = butterworth_sos(order, cutoff, frame_rate)
+        Q_filt = sosfiltfilt_by_mask(Q, sos, padlen, mask)
+    else:
+        cutoff = np.asarray(cutoff, dtype=float)
+        Q_filt = Q.copy()
+        for c in np.unique(cutoff):
+            cols = np.flatnonzero(cutoff == c)
+            sos, padlen = butterworth_sos(order, c, frame_rate)
+            Q_filt[:,cols] = sosfiltfilt_by_mask(Q[:,cols], sos, padlen, mask[:,cols])
+
+    return Q_filt
+
+
 def butterworth_filter_1d(config_dict, frame_rate, col):
     '''
     1D Zero-phase Butterworth filter (dual pass)
     Deals with nans
 
+    With cut_off_frequency = 'auto', the cut-off frequency is chosen by 
+    residual analysis on this column alone.
+
     INPUT:
-    - col: numpy array
+    - col: Pandas dataframe column
     - order: int
-    - cutoff: int
+    - cutoff: int or 'auto'
     - frame_rate: int
 
     OUTPUT:
     - col_filtered: Filtered pandas dataframe column
     '''
 
-    type = 'low' #config_dict.get('filtering').get('butterworth').get('type')
-    order = int(config_dict.get('filtering').get('butterworth').get('order'))
-    cutoff = int(config_dict.get('filtering').get('butterworth').get('cut_off_frequency'))    
+    Q = col.to_numpy()[:,np.newaxis]
+    if config_dict.get('filtering').get('butterworth').get('cut_off_frequency') == 'auto':
+        config_dict = deepcopy(config_dict)
+        config_dict['filtering']['butterworth']['cut_off_frequency'] = butterworth_auto_cutoffs(config_dict, frame_rate, Q, nb_dimensions=1).tolist()
 
-    b, a = signal.butter(order/2, cutoff/(frame_rate/2), type, analog = False) 
-    padlen = 3 * max(len(a), len(b))
-    
-    # split into sequences of not nans
-    col_filtered = col.copy()
-    mask = np.isnan(col_filtered)  | col_filtered.eq(0)
-    falsemask_indices = np.where(~mask)[0]
-    gaps = np.where(np.diff(falsemask_indices) > 1)[0] + 1 
-    idx_sequences = np.split(falsemask_indices, gaps)
-    if idx_sequences[0].size > 0:
-        idx_sequences_to_filter = [seq for seq in idx_sequences if len(seq) > padlen]
-    
-        # Filter each of the selected sequences
-        for seq_f in idx_sequences_to_filter:
-            col_filtered[seq_f] = signal.filtfilt(b, a, col_filtered[seq_f])
+    col_filtered = pd.Series(butterworth_filter_2d(config_dict, frame_rate, Q)[:,0], index=col.index)
     
     return col_filtered
     
 
-def butterworth_on_speed_filter_1d(config_dict, frame_rate, col):
+def butterworth_on_speed_filter_2d(config_dict, frame_rate, Q):
     '''
-    1D zero-phase Butterworth filter (dual pass) on derivative
+    Zero-phase Butterworth filter (dual pass) on derivative, of all columns at once
 
     INPUT:
-    - col: Pandas dataframe column
+    - Q: numpy array of shape (frames, columns)
     - frame rate, order, cut-off frequency, type (from Config.toml)
 
     OUTPUT:
-    - col_filtered: Filtered pandas dataframe column
+    - Q_filt: Filtered numpy array
     '''
 
-    type = 'low' # config_dict.get('filtering').get('butterworth_on_speed').get('type')
     order = int(config_dict.get('filtering').get('butterworth_on_speed').get('order'))
     cutoff = int(config_dict.get('filtering').get('butterworth_on_speed').get('cut_off_frequency'))
-
-    b, a = signal.butter(order/2, cutoff/(frame_rate/2), type, analog = False)
-    padlen = 3 * max(len(a), len(b))
+    sos, padlen = butterworth_sos(order, cutoff, frame_rate)
     
     # derivative
-    col_filtered = col.copy()
-    col_filtered_diff = col_filtered.diff()   # derivative
-    col_filtered_diff = col_filtered_diff.fillna(col_filtered_diff.iloc[1]/2) # set first value correctly instead of nan
+    Q_diff = np.full_like(Q, np.nan)
+    Q_diff[1:] = np.diff(Q, axis=0)
+    if len(Q) > 1:
+        Q_diff = np.where(np.isnan(Q_diff), Q_diff[1]/2, Q_diff) # set first value correctly instead of nan
     
-    # split into sequences of not nans
-    mask = np.isnan(col_filtered_diff)  | col_filtered_diff.eq(0)
-    falsemask_indices = np.where(~mask)[0]
-    gaps = np.where(np.diff(falsemask_indices) > 1)[0] + 1 
-    idx_sequences = np.split(falsemask_indices, gaps)
-    if idx_sequences[0].size > 0:
-        idx_sequences_to_filter = [seq for seq in idx_sequences if len(seq) > padlen]
+    # filter sequences of not nans
+    mask = np.isnan(Q_diff) | (Q_diff == 0)
+    Q_diff = sosfiltfilt_by_mask(Q_diff, sos, padlen, mask)
+
+    # integrate filtered derivative
+    Q_filt = np.nancumsum(Q_diff, axis=0)
+    Q_filt[np.isnan(Q_diff)] = np.nan
+    Q_filt += Q[0]
     
-        # Filter each of the selected sequences
-        for seq_f in idx_sequences_to_filter:
-            col_filtered_diff[seq_f] = signal.filtfilt(b, a, col_filtered_diff[seq_f])
-    col_filtered = col_filtered_diff.cumsum() + col.iloc[0] # integrate filtered derivative
+    return Q_filt
+
+
+def butterworth_on_speed_filter_1d(config_dict, frame_rate, col):
+    '''
+    1D zero-phase Butterworth filter (dual pass) on derivative
+
+    INPUT:
+    - col: Pandas dataframe column
+    - frame rate, order, cut-off frequency, type (from Config.toml)
+
+    OUTPUT:
+    - col_filtered: Filtered pandas dataframe column
+    '''
+
+    col_filtered = pd.Series(butterworth_on_speed_filter_2d(config_dict, frame_rate, col.to_numpy()[:,np.newaxis])[:,0], index=col.index)
     
     return col_filtered
 
@@ -270,6 +610,94 @@ def gaussian_filter_1d(config_dict, frame_rate, col):
     return col_filtered
     
 
+def loess_kernels(nb_values):
+    '''
+    Weights of the local linear regressions of LOWESS (statsmodels lowess with it=0),
+    for uniformly spaced samples.
+    Each value is estimated from the nb_values nearest samples, weighted with a 
+    tricube function of their distance. Away from the edges, this is a fixed 
+    convolution kernel. Near the edges, the window stops at the first or last 
+    sample, and the weights depend on the position within the window.
+
+    INPUT:
+    - nb_values: int, number of samples in each local regression
+
+    OUTPUT:
+    - kernels: array of shape (nb_values, nb_values). Row r gives the weights of the 
+    samples of a window, to estimate its r-th sample. Row nb_values//2 is the interior kernel
+    '''
+
+    x = np.arange(nb_values, dtype=float)
+    kernels = np.zeros((nb_values, nb_values))
+    for r in range(nb_values):
+        radius = max(r - x[0], x[-1] - r)
+        weights = (1 - (np.abs(x - r) / radius)**3)**3
+        if np.count_nonzero(weights > 1e-12) < 2:
+            kernels[r,r] = 1 # not enough points for a regression: value kept as is
+            continue
+        weights /= weights.sum()
+        x_mean = weights @ x
+        x_var = max(weights @ (x - x_mean)**2, 1e-12)
+        kernels[r] = weights * (1 + (r - x_mean) * (x - x_mean) / x_var)
+
+    return kernels
+
+
+def loess_apply_kernels(Y, kernels):
+    '''
+    Apply LOWESS kernels to all columns of an array of valid values.
+
+    INPUTS:
+    - Y: array of shape (frames, columns), with at least as many frames as the kernels
+    - kernels: see loess_kernels
+
+    OUTPUT:
+    - Y_filt: filtered array
+    '''
+
+    n, k = len(Y), len(kernels)
+    h = k//2
+    Y_filt = np.empty_like(Y)
+    Y_filt[:h] = np.tensordot(kernels[:h], Y[:k], axes=(1,0))
+    Y_filt[h:n-k+h+1] = np.lib.stride_tricks.sliding_window_view(Y, k, axis=0) @ kernels[h]
+    Y_filt[n-k+h+1:] = np.tensordot(kernels[h+1:], Y[n-k:], axes=(1,0))
+
+    return Y_filt
+
+
+def loess_filter_2d(config_dict, frame_rate, Q):
+    '''
+    LOWESS filter (Locally Weighted Scatterplot Smoothing) of all columns at once
+    Same results as statsmodels lowess with it=0, on each sequence of valid values.
+    The regression kernels are computed once, and the columns which share the 
+    same mask are filtered together.
+
+    INPUT:
+    - Q: numpy array of shape (frames, columns)
+    - loess_filter_nb_values: window used for smoothing from Config.toml
+
+    OUTPUT:
+    - Q_filt: Filtered numpy array
+    '''
+
+    kernel = config_dict.get('filtering').get('LOESS').get('nb_values_used')
+    kernels = loess_kernels(max(int(kernel + 1e-10), 2))
+
+    Q_filt = Q.copy()
+    mask = np.isnan(Q)
+    patterns, pattern_ids = np.unique(mask, axis=1, return_inverse=True)
+    pattern_ids = pattern_ids.ravel()
+    for p in range(patterns.shape[1]):
+        cols = np.flatnonzero(pattern_ids == p)
+        _, starts, stops = find_runs(~patterns[:,p])
+        # Filter each of the sequences longer than kernel
+        for start, stop in zip(starts, stops):
+            if stop - start > kernel:
+                Q_filt[start:stop, cols] = loess_apply_kernels(Q[start:stop, cols], kernels)
+
+    return Q_filt
+
+
 def loess_filter_1d(config_dict, frame_rate, col):
     '''
     1D LOWESS filter (Locally Weighted Scatterplot Smoothing)
@@ -283,19 +711,7 @@ def loess_filter_1d(config_dict, frame_rate, col):
     - col_filtered: Filtered pandas dataframe column
     '''
 
-    kernel = config_dict.get('filtering').get('LOESS').get('nb_values_used')
-
-    col_filtered = col.copy()
-    mask = np.isnan(col_filtered) 
-    falsemask_indices = np.where(~mask)[0]
-    gaps = np.where(np.diff(falsemask_indices) > 1)[0] + 1 
-    idx_sequences = np.split(falsemask_indices, gaps)
-    if idx_sequences[0].size > 0:
-        idx_sequences_to_filter = [seq for seq in idx_sequences if len(seq) > kernel]
-    
-        # Filter each of the selected sequences
-        for seq_f in idx_sequences_to_filter:
-            col_filtered[seq_f] = lowess(col_filtered[seq_f], seq_f, is_sorted=True, frac=kernel/len(seq_f), it=0)[:,1]
+    col_filtered = pd.Series(loess_filter_2d(config_dict, frame_rate, col.to_numpy(dtype=float)[:,np.newaxis])[:,0], index=col.index)
 
     return col_filtered
     
@@ -393,10 +809,327 @@ def filter1d(col, config_dict, filter_type, frame_rate):
     return col_filtered
 
 
-def recap_filter3d(config_dict, trc_path):
+def filter2d(Q, config_dict, filter_type, frame_rate):
+    '''
+    Choose filter type and filter all columns of a dataframe.
+    Filters which can process all columns at once are designed only once,
+    the other ones are applied column by column.
+
+    INPUT:
+    - Q: Pandas dataframe, with coordinates as columns
+    - filter_type: filter type from Config.toml
+    - frame_rate: int
+    
+    OUTPUT:
+    - Q_filt: Filtered pandas dataframe
+    '''
+
+    # Filters working on whole arrays
+    filter_mapping_2d = {
+        'kalman': kalman_filter_2d,
+        'LOESS': loess_filter_2d,
+        'butterworth': butterworth_filter_2d, 
+        'butterworth_on_speed': butterworth_on_speed_filter_2d
+        }
+
+    if filter_type in filter_mapping_2d:
+        filter_fun = filter_mapping_2d[filter_type]
+        Q_filt = pd.DataFrame(filter_fun(config_dict, frame_rate, Q.to_numpy(dtype=float)), index=Q.index, columns=Q.columns)
+    else:
+        Q_filt = Q.apply(filter1d, axis=0, args = [config_dict, filter_type, frame_rate])
+
+    return Q_filt
+
+
+def filter_block(Q, config_dict, filter_type, frame_rate):
+    '''
+    Filter a block of columns. Used by the workers of filter_trc_parallel.
+
+    INPUT:
+    - Q: numpy array of shape (frames, columns)
+    - filter_type: filter type from Config.toml
+    - frame_rate: int
+
+    OUTPUT:
+    - Q_filt: Filtered numpy array
+    '''
+
+    Q_filt = filter2d(pd.DataFrame(Q), config_dict, filter_type, frame_rate).to_numpy()
+
+    return Q_filt
+
+
+def filter_trc_parallel(Q_list, config_list, filter_type, frame_rate, nb_workers):
+    '''
+    Filter the coordinates of several trc files with a pool of processes.
+    Each file is split into contiguous blocks of markers, so that there are
+    at least as many tasks as workers. The blocks are put back together 
+    in their original order.
+
+    INPUT:
+    - Q_list: list of numpy arrays of shape (frames, 3*markers), one per trc file
+    - config_list: list of configuration dictionaries, one per trc file
+    - filter_type: filter type from Config.toml
+    - frame_rate: int
+    - nb_workers: int, number of processes
+
+    OUTPUT:
+    - Q_filt_list: list of filtered numpy arrays, in the same order as Q_list
+    '''
+
+    nb_blocks_per_file = int(np.ceil(nb_workers / len(Q_list)))
+    with ProcessPoolExecutor(max_workers=nb_workers) as executor:
+        futures = []
+        for Q, config_dict in zip(Q_list, config_list):
+            nb_markers = Q.shape[1] // 3
+            marker_blocks = np.array_split(np.arange(nb_markers), max(1, min(nb_blocks_per_file, nb_markers)))
+            col_blocks = [(3*m[:,np.newaxis] + np.arange(3)).ravel() for m in marker_blocks]
+            futures.append([executor.submit(filter_block, Q[:,cols], block_config(config_dict, cols), filter_type, frame_rate) for cols in col_blocks])
+        Q_filt_list = [np.concatenate([f.result() for f in file_futures], axis=1) for file_futures in futures]
+
+    return Q_filt_list
+
+
+def block_config(config_dict, cols):
+    '''
+    Configuration dictionary for a block of columns: 
+    per-column Butterworth cut-off frequencies are restricted to the block.
+
+    INPUT:
+    - config_dict: configuration dictionary
+    - cols: indices of the columns of the block
+
+    OUTPUT:
+    - config_block: configuration dictionary for the block
+    '''
+
+    cutoff = config_dict.get('filtering').get('butterworth', {}).get('cut_off_frequency')
+    if not isinstance(cutoff, list):
+        return config_dict
+
+    config_block = deepcopy(config_dict)
+    config_block['filtering']['butterworth']['cut_off_frequency'] = [cutoff[c] for c in cols]
+
+    return config_block
+
+
+class StreamingFilter():
+    '''
+    Causal filter of streamed coordinates, for live feedback.
+    Frames are given in chunks, and the filter state of each column is 
+    carried from one chunk to the next. A missing value (nan or zero) resets 
+    the state of its column, which restarts from the next valid value.
+
+    Available filters:
+    - 'butterworth': causal low-pass Butterworth filter (single pass of order 
+      "order", with initial conditions set to the first value after a reset). 
+      No latency in frames, but the phase lag of a causal filter.
+      The cut-off frequency cannot be 'auto', since residual analysis needs the 
+      whole sequence: give it explicitly, possibly one value per column.
+    - 'kalman': forward-only Kalman filter, with the constant acceleration 
+      model of kalman_filter. Starts with null velocity and acceleration. 
+      No latency.
+    - 'kalman' with fixed_lag > 0: fixed-lag Kalman smoother. The estimate of 
+      a frame uses the fixed_lag following frames, so results are returned 
+      with a latency of fixed_lag frames (fixed_lag / frame_rate seconds).
+    The latency, in frames, is stored in the "latency" attribute.
+
+    USAGE:
+    stream_filter = StreamingFilter(config_dict, frame_rate, nb_columns)
+    for chunk in chunks: # arrays of shape (frames, nb_columns)
+        chunk_filt = stream_filter.process(chunk) # same shape, delayed by stream_filter.latency frames
+    last_frames_filt = stream_filter.flush() # last frames not returned yet
+    '''
+
+    def __init__(self, config_dict, frame_rate, nb_columns, filter_type=None, fixed_lag=None, cutoff=None):
+        '''
+        INPUTS:
+        - config_dict: dictionary of configuration parameters, for filter parameters
+        - frame_rate: int
+        - nb_columns: int, number of coordinates (3 * number of markers)
+        - filter_type: 'butterworth' or 'kalman'. Default: type from Config.toml
+        - cutoff: Butterworth cut-off frequency, or list of one value per column 
+          (e.g. np.repeat(butterworth_auto_cutoffs(...), 3) on a previous recording). 
+          Default: cut_off_frequency from Config.toml [filtering.butterworth]
+        - fixed_lag: int, number of frames of the Kalman fixed-lag smoother. 
+          Default: fixed_lag from Config.toml [filtering.kalman], or 0 (forward-only)
+        '''
+
+        self.filter_type = filter_type if filter_type is not None else config_dict.get('filtering').get('type')
+        self.nb_columns = nb_columns
+
+        if self.filter_type == 'butterworth':
+            order = int(config_dict.get('filtering').get('butterworth').get('order'))
+            cutoff = cutoff if cutoff is not None else config_dict.get('filtering').get('butterworth').get('cut_off_frequency')
+            if isinstance(cutoff, str):
+                raise ValueError(f'The cut-off frequency of the streaming Butterworth filter cannot be "{cutoff}": residual analysis needs the whole sequence. Set a number in Config.toml, or pass cutoff explicitly.')
+            elif np.isscalar(cutoff):
+                cutoff = int(cutoff)
+            # columns with the same cut-off frequency are filtered together
+            cutoffs = np.broadcast_to(np.asarray(cutoff, dtype=float), (nb_columns,))
+            self.cutoff_groups = []
+            for c in np.unique(cutoffs):
+                sos = signal.butter(order, c/(frame_rate/2), 'low', analog = False, output='sos')
+                self.cutoff_groups.append((np.flatnonzero(cutoffs == c), sos, signal.sosfilt_zi(sos)[:,:,np.newaxis]))
+            self.fixed_lag = 0
+        elif self.filter_type == 'kalman':
+            trustratio = int(config_dict.get('filtering').get('kalman').get('trust_ratio'))
+            measurement_noise = 20
+            process_noise = measurement_noise * trustratio
+            self.F, self.H, self.R, self.Q = kalman_model(frame_rate, measurement_noise, process_noise)
+            self.P_init = np.eye(len(self.F)) * measurement_noise
+            self.fixed_lag = int(fixed_lag if fixed_lag is not None else config_dict.get('filtering').get('kalman').get('fixed_lag', 0))
+        else:
+            raise ValueError(f'Streaming filter type should be "butterworth" or "kalman", not "{self.filter_type}".')
+
+        self.latency = self.fixed_lag
+        self.reset()
+
+    def reset(self):
+        '''
+        Reset the state of all columns.
+        '''
+
+        self.active = np.zeros(self.nb_columns, dtype=bool)
+        self.nb_frames_in, self.nb_frames_out = 0, 0
+        if self.filter_type == 'butterworth':
+            self.zi = np.zeros((len(self.cutoff_groups[0][1]), 2, self.nb_columns))
+        else:
+            self.x = np.zeros((self.nb_columns, len(self.F)))
+            self.P = np.tile(self.P_init, (self.nb_columns, 1, 1))
+            self.window = [] # (x, P, valid, restarted) of the last fixed_lag+1 frames
+
+    def process(self, chunk):
+        '''
+        Filter a chunk of frames.
+
+        INPUT:
+        - chunk: array of shape (frames, nb_columns), or (nb_columns,) for a single frame
+
+        OUTPUT:
+        - chunk_filt: array of shape (frames, nb_columns). Row i is the filtered 
+          estimate of the frame received "latency" frames before the i-th frame of 
+          the chunk (nan for the first "latency" frames of the stream)
+        '''
+
+        chunk = np.atleast_2d(np.asarray(chunk, dtype=float))
+        mask = np.isnan(chunk) | (chunk == 0)
+
+        if self.filter_type == 'butterworth':
+            chunk_filt = self.process_butterworth(chunk, mask)
+        else:
+            chunk_filt = np.array([self.process_kalman_frame(z, missing) for z, missing in zip(chunk, mask)])
+        self.nb_frames_in += len(chunk)
+
+        return chunk_filt
+
+    def process_butterworth(self, chunk, mask):
+        '''
+        Causal Butterworth filtering of a chunk. Columns which share the 
+        same cut-off frequency and the same mask are filtered together, 
+        sequence by sequence.
+        '''
+
+        chunk_filt = np.full_like(chunk, np.nan)
+        for group_cols, sos, zi_steady in self.cutoff_groups:
+            patterns, pattern_ids = np.unique(mask[:,group_cols], axis=1, return_inverse=True)
+            pattern_ids = pattern_ids.ravel()
+            for p in range(patterns.shape[1]):
+                cols = group_cols[pattern_ids == p]
+                _, starts, stops = find_runs(~patterns[:,p])
+                for start, stop in zip(starts, stops):
+                    zi = self.zi[:,:,cols]
+                    restarted = ~self.active[cols] if start == 0 else np.ones(len(cols), dtype=bool)
+                    zi[:,:,restarted] = zi_steady * chunk[start, cols[restarted]]
+                    chunk_filt[start:stop, cols], self.zi[:,:,cols] = signal.sosfilt(sos, chunk[start:stop, cols], axis=0, zi=zi)
+                    self.active[cols] = True
+                if patterns[-1,p]:
+                    self.active[cols] = False
+        self.nb_frames_out += len(chunk)
+
+        return chunk_filt
+
+    def process_kalman_frame(self, z, missing):
+        '''
+        Kalman predict and update of all columns for one frame,
+        and fixed-lag smoothing if required.
+        '''
+
+        F, H, R, Q = self.F, self.H, self.R, self.Q
+        valid = ~missing
+        restarted = valid & ~self.active
+        self.x[restarted] = 0
+        self.x[restarted, 0] = z[restarted]
+        self.P[restarted] = self.P_init
+
+        # predict and update
+        x = self.x[valid] @ F.T
+        P = F @ self.P[valid] @ F.T + Q
+        K = P @ H / (P @ H @ H + R)[:,np.newaxis]
+        x = x + (z[valid] - x @ H)[:,np.newaxis] * K
+        I_KH = np.eye(len(F)) - K[:,:,np.newaxis] * H
+        P = I_KH @ P @ I_KH.transpose(0,2,1) + K[:,:,np.newaxis] * K[:,np.newaxis,:] * R
+        self.x[valid], self.P[valid] = x, P
+        self.active = valid
+
+        if self.fixed_lag == 0:
+            self.nb_frames_out += 1
+            return np.where(valid, self.x[:,0], np.nan)
+
+        self.window.append((self.x.copy(), self.P.copy(), valid, restarted))
+        if len(self.window) <= self.fixed_lag:
+            return np.full(self.nb_columns, np.nan)
+        self.window = self.window[-(self.fixed_lag+1):]
+        self.nb_frames_out += 1
+        return self.smooth_window()[0]
+
+    def smooth_window(self):
+        '''
+        RTS smoothing of the frames of the window, with the data available up to the last one.
+        Smoothing does not go through missing values or resets.
+        '''
+
+        F, Q = self.F, self.Q
+        xs, Ps, valid, restarted = [np.array(w) for w in zip(*self.window)]
+        xs_smooth = xs.copy()
+        for k in range(len(xs)-2, -1, -1):
+            P_pred = F @ Ps[k] @ F.T + Q
+            C = Ps[k] @ F.T @ np.linalg.inv(P_pred)
+            x_smooth = xs[k] + ((xs_smooth[k+1] - xs[k] @ F.T)[:,np.newaxis,:] @ C.transpose(0,2,1))[:,0]
+            linked = valid[k] & valid[k+1] & ~restarted[k+1]
+            xs_smooth[k] = np.where(linked[:,np.newaxis], x_smooth, xs[k])
+
+        return np.where(valid, xs_smooth[...,0], np.nan)
+
+    def flush(self):
+        '''
+        Return the frames which have been received but not returned yet 
+        (the last "latency" frames), smoothed with the available data, 
+        and reset the filter.
+
+        OUTPUT:
+        - last_frames_filt: array of shape (frames, nb_columns)
+        '''
+
+        nb_pending = self.nb_frames_in - self.nb_frames_out
+        if nb_pending > 0:
+            last_frames_filt = self.smooth_window()[-nb_pending:]
+        else:
+            last_frames_filt = np.empty((0, self.nb_columns))
+        self.reset()
+
+        return last_frames_filt
+
+
+def recap_filter3d(config_dict, trc_path, cutoffs=None):
     '''
     Print a log message giving filtering parameters. Also stored in User/logs.txt.
 
+    INPUTS:
+    - config_dict: dictionary of configuration parameters
+    - trc_path: path of the filtered trc file
+    - cutoffs: dict of Butterworth cut-off frequencies per marker, if chosen by residual analysis
+
     OUTPUT:
     - Message in console
     '''
@@ -408,7 +1141,12 @@ def recap_filter3d(config_dict, trc_path):
     kalman_filter_smooth_str = 'smoother' if kalman_filter_smooth else 'filter'
     butterworth_filter_type = 'low' # config_dict.get('filtering').get('butterworth').get('type')
     butterworth_filter_order = int(config_dict.get('filtering').get('butterworth').get('order'))
-    butterworth_filter_cutoff = int(config_dict.get('filtering').get('butterworth').get('cut_off_frequency'))
+    butterworth_filter_cutoff = config_dict.get('filtering').get('butterworth').get('cut_off_frequency')
+    if cutoffs is not None:
+        cutoffs_str = ', '.join([f'{m} {c} Hz' for m, c in cutoffs.items()])
+        butterworth_filter_cutoff_str = f'Cut-off frequencies chosen by residual analysis: {cutoffs_str}. Saved to {trc_path.replace(".trc", "_cutoffs.json")}'
+    else:
+        butterworth_filter_cutoff_str = f'Cut-off frequency {butterworth_filter_cutoff} Hz'
     butter_speed_filter_type = 'low' # config_dict.get('filtering').get('butterworth_on_speed').get('type')
     butter_speed_filter_order = int(config_dict.get('filtering').get('butterworth_on_speed').get('order'))
     butter_speed_filter_cutoff = int(config_dict.get('filtering').get('butterworth_on_speed').get('cut_off_frequency'))
@@ -420,7 +1158,7 @@ def recap_filter3d(config_dict, trc_path):
     # Recap
     filter_mapping_recap = {
         'kalman': f'--> Filter type: Kalman {kalman_filter_smooth_str}. Measurements trusted {kalman_filter_trustratio} times as much as previous data, assuming a constant acceleration process.', 
-        'butterworth': f'--> Filter type: Butterworth {butterworth_filter_type}-pass. Order {butterworth_filter_order}, Cut-off frequency {butterworth_filter_cutoff} Hz.', 
+        'butterworth': f'--> Filter type: Butterworth {butterworth_filter_type}-pass. Order {butterworth_filter_order}, {butterworth_filter_cutoff_str}.', 
         'butterworth_on_speed': f'--> Filter type: Butterworth on speed {butter_speed_filter_type}-pass. Order {butter_speed_filter_order}, Cut-off frequency {butter_speed_filter_cutoff} Hz.', 
         'gaussian': f'--> Filter type: Gaussian. Standard deviation kernel: {gaussian_filter_sigma_kernel}', 
         'LOESS': f'--> Filter type: LOESS. Number of values used: {loess_filter_nb_values}', 
@@ -451,11 +1189,12 @@ def filter_all(config_dict):
     display_figures = config_dict.get('filtering').get('display_figures')
     filter_type = config_dict.get('filtering').get('type')
     make_c3d = config_dict.get('filtering').get('make_c3d')
+    nb_workers = config_dict.get('filtering').get('nb_workers', 1)
+    nb_workers = os.cpu_count() if nb_workers == 'auto' else int(nb_workers)
 
     # Get frame_rate
-    video_dir = os.path.join(project_dir, 'videos')
     vid_img_extension = config_dict['pose']['vid_img_extension']
-    video_files = glob.glob(os.path.join(video_dir, '*'+vid_img_extension))
+    video_files = find_video_files(project_dir, vid_img_extension)
     frame_rate = config_dict.get('project').get('frame_rate')
     if frame_rate == 'auto': 
         try:
@@ -468,42 +1207,54 @@ def filter_all(config_dict):
             frame_rate = 60
     
     # Trc paths
-    trc_path_in = [file for file in glob.glob(os.path.join(pose3d_dir, '*.trc')) if 'filt' not in file]
+    trc_path_in = sorted([file for file in glob.glob(os.path.join(pose3d_dir, '*.trc')) if 'filt' not in file])
     trc_f_out = [f'{os.path.basename(t).split(".")[0]}_filt_{filter_type}.trc' for t in trc_path_in]
     trc_path_out = [os.path.join(pose3d_dir, t) for t in trc_f_out]
     
-    for t_in, t_out in zip(trc_path_in, trc_path_out):
-        # Read trc header
-        with open(t_in, 'r') as trc_file:
-            header = [next(trc_file) for line in range(5)]
-
-        # Read trc coordinates values
-        trc_df = pd.read_csv(t_in, sep="\t", skiprows=4)
-        frames_col, time_col = trc_df.iloc[:,0], trc_df.iloc[:,1]
-        Q_coord = trc_df.drop(trc_df.columns[[0, 1]], axis=1)
-
-        # Filter coordinates
-        Q_filt = Q_coord.apply(filter1d, axis=0, args = [config_dict, filter_type, frame_rate])
+    # Read trc headers and coordinates values
+    trc_contents = [read_trc(t_in) for t_in in trc_path_in]
+
+    # Choose Butterworth cut-off frequencies of each marker by residual analysis
+    config_list = [config_dict] * len(trc_contents)
+    cutoffs_list = [None] * len(trc_contents)
+    if filter_type == 'butterworth' and config_dict.get('filtering').get('butterworth').get('cut_off_frequency') == 'auto':
+        for i, (header, trc_data) in enumerate(trc_contents):
+            cutoffs = butterworth_auto_cutoffs(config_dict, frame_rate, trc_data[:,2:])
+            cutoffs_list[i] = dict(zip(header['marker_names'], cutoffs.tolist()))
+            config_list[i] = deepcopy(config_dict)
+            config_list[i]['filtering']['butterworth']['cut_off_frequency'] = np.repeat(cutoffs, 3).tolist()
+
+    # Filter coordinates, optionally in parallel across files and blocks of markers
+    if nb_workers > 1 and len(trc_contents) > 0:
+        logging.info(f'Filtering {len(trc_contents)} trc file(s) with {nb_workers} parallel workers.')
+        Q_filt_all = filter_trc_parallel([trc_data[:,2:] for _, trc_data in trc_contents], config_list, filter_type, frame_rate, nb_workers)
+    else:
+        Q_filt_all = [filter2d(pd.DataFrame(trc_data[:,2:]), config_trc, filter_type, frame_rate).to_numpy() for (_, trc_data), config_trc in zip(trc_contents, config_list)]
+
+    for (header, trc_data), Q_filt, t_out, cutoffs in zip(trc_contents, Q_filt_all, trc_path_out, cutoffs_list):
+        frames_col, time_col = trc_data[:,0], pd.Series(trc_data[:,1])
+        Q_coord = pd.DataFrame(trc_data[:,2:])
+        Q_filt = pd.DataFrame(Q_filt)
 
         # Display figures
         if display_figures:
             # Retrieve keypoints
-            keypoints_names = pd.read_csv(t_in, sep="\t", skiprows=3, nrows=0).columns[2::3].to_numpy()
+            keypoints_names = header['marker_names']
             display_figures_fun(Q_coord, Q_filt, time_col, keypoints_names)
 
         # Reconstruct trc file with filtered coordinates
-        with open(t_out, 'w') as trc_o:
-            [trc_o.write(line) for line in header]
-            Q_filt.insert(0, 'Frame#', frames_col)
-            Q_filt.insert(1, 'Time', time_col)
-            # Q_filt = Q_filt.fillna(' ')
-            Q_filt.to_csv(trc_o, sep='\t', index=False, header=None, lineterminator='\n')
+        write_trc(t_out, header['lines'], frames_col, time_col.to_numpy(), Q_filt.to_numpy())
 
         # Save c3d
         if make_c3d:
             convert_to_c3d(t_out)
 
+        # Save chosen cut-off frequencies
+        if cutoffs is not None:
+            with open(t_out.replace('.trc', '_cutoffs.json'), 'w') as f:
+                json.dump(cutoffs, f, indent=2)
+
         # Recap
-        recap_filter3d(config_dict, t_out)
+        recap_filter3d(config_dict, t_out, cutoffs=cutoffs)
 
 
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+'''
+###########################################################################
+## INTERPOLATION OF MISSING COORDINATES                                  ##
+###########################################################################
+
+Gap detection and interpolation of missing values (nans or zeros),
+shared by triangulation, synchronization and filtering.
+
+Works on whole frames * columns arrays: gap run-lengths are computed once
+for all columns, and columns which share the same missing-data pattern
+are interpolated together.
+'''
+
+
+## INIT
+import numpy as np
+from scipy import interpolate
+
+
+## AUTHORSHIP INFORMATION
+__author__ = "David Pagnon"
+__copyright__ = "Copyright 2021, Pose2Sim"
+__credits__ = ["David Pagnon"]
+__license__ = "BSD 3-Clause License"
+__version__ = "0.9.4"
+__maintainer__ = "David Pagnon"
+__email__ = "contact@david-pagnon.com"
+__status__ = "Development"
+
+
+## FUNCTIONS
+def find_runs(mask):
+    '''
+    Find runs of contiguous True values in each column of a boolean array.
+
+    INPUTS:
+    - mask: boolean array of shape (frames,) or (frames, columns)
+
+    OUTPUTS:
+    - cols: column index of each run
+    - starts: first frame of each run
+    - stops: last frame + 1 of each run
+    Runs are sorted by column, then by frame
+    '''
+
+    mask = np.asarray(mask, dtype=bool)
+    if mask.ndim == 1:
+        mask = mask[:,np.newaxis]
+
+    padded = np.zeros((mask.shape[1], mask.shape[0]+2), dtype=np.int8)
+    padded[:,1:-1] = mask.T
+    edges = np.diff(padded, axis=1)
+    cols, starts = np.nonzero(edges == 1)
+    _, stops = np.nonzero(edges == -1)
+
+    return cols, starts, stops
+
+
+def runs_to_mask(shape, cols, starts, stops):
+    '''
+    Boolean array which is True within the given runs.
+
+    INPUTS:
+    - shape: (frames, columns)
+    - cols, starts, stops: runs, as returned by find_runs
+
+    OUTPUT:
+    - mask: boolean array of shape (frames, columns)
+    '''
+
+    delta = np.zeros((shape[1], shape[0]+1), dtype=np.int32)
+    delta[cols, starts] += 1
+    delta[cols, stops] -= 1
+    mask = np.cumsum(delta, axis=1)[:,:-1].T > 0
+
+    return mask
+
+
+def interpolate_zeros_nans(arr, max_gap=np.inf, kind='linear', extrapolate=True, errors='raise'):
+    '''
+    Interpolate missing points (nans or zeros) in each column of an array,
+    unless more than max_gap contiguous values are missing.
+
+    INPUTS:
+    - arr: array of shape (frames,) or (frames, columns)
+    - max_gap: max number of contiguous bad values, above which they won't be interpolated
+    - kind: 'linear', 'slinear', 'quadratic', 'cubic'. Default: 'linear'
+    - extrapolate: if True, missing values at the edges are extrapolated. Otherwise they are left to nan
+    - errors: 'raise' if a column without enough valid values should raise an error,
+      'ignore' if it should be left untouched
+
+    OUTPUT:
+    - arr_interp: interpolated array of the same shape
+    '''
+
+    arr_interp = np.array(arr, dtype=float)
+    is_1d = arr_interp.ndim == 1
+    if is_1d:
+        arr_interp = arr_interp[:,np.newaxis]
+
+    missing = np.isnan(arr_interp) | (arr_interp == 0)
+    if not missing.any():
+        return arr_interp[:,0] if is_1d else arr_interp
+
+    # Interpolate columns which share the same missing-data pattern together
+    patterns, pattern_ids = np.unique(missing, axis=1, return_inverse=True)
+    pattern_ids = pattern_ids.ravel()
+    fill_value = 'extrapolate' if extrapolate else np.nan
+    for p in range(patterns.shape[1]):
+        if not patterns[:,p].any():
+            continue
+        cols = np.flatnonzero(pattern_ids == p)
+        idx_good = np.flatnonzero(~patterns[:,p])
+        idx_bad = np.flatnonzero(patterns[:,p])
+        try:
+            f_interp = interpolate.interp1d(idx_good, arr_interp[np.ix_(idx_good, cols)], kind=kind, axis=0, fill_value=fill_value, bounds_error=False)
+        except ValueError:
+            if errors == 'ignore':
+                continue
+            raise
+        arr_interp[np.ix_(idx_bad, cols)] = f_interp(idx_bad)
+
+    # Reintroduce nans if length of gap > max_gap
+    if max_gap < len(arr_interp):
+        cols, starts, stops = find_runs(missing)
+        too_long = stops - starts > max_gap
+        arr_interp[runs_to_mask(missing.shape, cols[too_long], starts[too_long], stops[too_long])] = np.nan
+
+    return arr_interp[:,0] if is_1d else arr_interp
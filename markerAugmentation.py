@@ -28,9 +28,7 @@ import tensorflow as tf
 import glob
 import logging
 
-from Pose2Sim.MarkerAugmenter import utilsDataman
-from Pose2Sim.MarkerAugmenter.utils import TRC2numpy
-from Pose2Sim.common import convert_to_c3d, natural_sort_key
+from Pose2Sim.common import convert_to_c3d, natural_sort_key, read_trc, trc_header, write_trc
 
 
 ## AUTHORSHIP INFORMATION
@@ -45,37 +43,75 @@ __status__ = "Development"
 
 
 ## FUNCTIONS
+def trc_marker(marker_names, coords, marker):
+    '''
+    Coordinates of one marker.
+
+    INPUTS:
+    - marker_names: list of marker names
+    - coords: array of marker coordinates (n_frames, 3*n_markers)
+    - marker: name of the marker
+
+    OUTPUT:
+    - marker_coords: array (n_frames, 3)
+    '''
+
+    idx = marker_names.index(marker)
+    return coords[:, 3*idx:3*idx+3]
+
+
+def add_trc_marker(marker_names, coords, marker, marker_coords):
+    '''
+    Append a marker to the marker names and coordinates.
+
+    OUTPUTS:
+    - marker_names, coords: updated
+    '''
+
+    return marker_names + [marker], np.concatenate((coords, marker_coords), axis=1)
+
+
 # subject_height must be in meters
-def check_midhip_data(trc_file):
+def check_midhip_data(marker_names, coords):
     try:
         # Find MidHip data
-        midhip_data = trc_file.marker("CHip")
+        midhip_data = trc_marker(marker_names, coords, "CHip")
         if midhip_data is None or len(midhip_data) == 0:
             raise ValueError("MidHip data is empty")
-    except (KeyError, ValueError):
+    except ValueError:
         # If MidHip data is not found, calculate it from RHip and LHip
-        rhip_data = trc_file.marker("RHip")
-        lhip_data = trc_file.marker("LHip")
+        rhip_data = trc_marker(marker_names, coords, "RHip")
+        lhip_data = trc_marker(marker_names, coords, "LHip")
         midhip_data = (rhip_data + lhip_data) / 2
-        trc_file.add_marker('CHip', *midhip_data.T)
+        marker_names, coords = add_trc_marker(marker_names, coords, 'CHip', midhip_data)
 
-    return trc_file
+    return marker_names, coords
 
 
-def check_neck_data(trc_file):
+def check_neck_data(marker_names, coords):
     try:
         # Find Neck data
-        neck_data = trc_file.marker("Neck")
+        neck_data = trc_marker(marker_names, coords, "Neck")
         if neck_data is None or len(neck_data) == 0:
             raise ValueError("Neck data is empty")
-    except (KeyError, ValueError):
+    except ValueError:
         # If Neck data is not found, calculate it from RShoulder and LShoulder
-        rshoulder_data = trc_file.marker("RShoulder")
-        lshoulder_data = trc_file.marker("LShoulder")
+        rshoulder_data = trc_marker(marker_names, coords, "RShoulder")
+        lshoulder_data = trc_marker(marker_names, coords, "LShoulder")
         neck_data = (rshoulder_data + lshoulder_data) / 2
-        trc_file.add_marker('Neck', *neck_data.T)
+        marker_names, coords = add_trc_marker(marker_names, coords, 'Neck', neck_data)
+
+    return marker_names, coords
+
+
+def write_augmented_trc(trc_path, header, frames, times, marker_names, coords):
+    '''
+    Write marker coordinates to a trc file, keeping the frame rate and start frame of the original header.
+    '''
 
-    return trc_file
+    header_trc = trc_header(os.path.basename(trc_path), marker_names, header['frame_rate'], len(frames), 
+                            orig_data_start_frame=header['orig_data_start_frame'], units=header['units'])
+    write_trc(trc_path, header_trc, frames, times, coords)
 
 
 def augmentTRC(config_dict):
@@ -91,7 +127,7 @@ def augmentTRC(config_dict):
         subject_height = [subject_height]
         subject_mass = [subject_mass]
     make_c3d = config_dict.get('markerAugmentation').get('make_c3d')
-    augmenterDir = os.path.dirname(utilsDataman.__file__)
+    augmenterDir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'MarkerAugmenter')
     augmenterModelName = 'LSTM'
     augmenter_model = 'v0.3'
     offset = True
@@ -138,18 +174,22 @@ def augmentTRC(config_dict):
         # %% Process data.
         # Import TRC file
         try:
-            trc_file = utilsDataman.TRCFile(pathInputTRCFile)
+            trc_header_in, trc_data_in = read_trc(pathInputTRCFile)
         except:
             raise ValueError('Cannot read TRC file. You may need to enable interpolation in Config.toml while triangulating.')
+        if np.isnan(trc_data_in).any():
+            raise ValueError('TRC file contains missing values. You may need to enable interpolation in Config.toml while triangulating.')
+        frames, times = trc_data_in[:,0], trc_data_in[:,1]
+        marker_names, coords = trc_header_in['marker_names'], trc_data_in[:,2:]
         
         # add neck and midhip data if not in file
-        trc_file = check_midhip_data(trc_file)
-        trc_file = check_neck_data(trc_file)
-        trc_file.write(pathInputTRCFile)
+        marker_names, coords = check_midhip_data(marker_names, coords)
+        marker_names, coords = check_neck_data(marker_names, coords)
+        write_augmented_trc(pathInputTRCFile, trc_header_in, frames, times, marker_names, coords)
         
         # Verify that all feature markers are present in the TRC file.
         feature_markers_joined = set(feature_markers_all[0]+feature_markers_all[1])
-        trc_markers = set(trc_file.marker_names)
+        trc_markers = set(marker_names)
         missing_markers = list(feature_markers_joined - trc_markers)
         if len(missing_markers) > 0:
             raise ValueError(f'Marker augmentation requires {missing_markers} markers and they are not present in the TRC file.')
@@ -168,11 +208,10 @@ def augmentTRC(config_dict):
             
             # %% Pre-process inputs.
             # Step 1: import .trc file with OpenPose marker trajectories.  
-            trc_data = TRC2numpy(pathInputTRCFile, feature_markers)
-            trc_data_data = trc_data[:,1:]
+            trc_data_data = np.concatenate([trc_marker(marker_names, coords, m) for m in feature_markers], axis=1)
 
             # Step 2: Normalize with reference marker position.
-            referenceMarker_data = trc_file.marker("CHip")  # instead of trc_file.marker(referenceMarker) # change by HunMin
+            referenceMarker_data = trc_marker(marker_names, coords, "CHip")  # instead of trc_file.marker(referenceMarker) # change by HunMin
             norm_trc_data_data = np.zeros((trc_data_data.shape[0],
                                         trc_data_data.shape[1]))
             for i in range(0,trc_data_data.shape[1],3):
@@ -236,10 +275,7 @@ def augmentTRC(config_dict):
                 
             # %% Add markers to .trc file.
             for c, marker in enumerate(response_markers):
-                x = unnorm2_outputs[:,c*3]
-                y = unnorm2_outputs[:,c*3+1]
-                z = unnorm2_outputs[:,c*3+2]
-                trc_file.add_marker(marker, x, y, z)
+                marker_names, coords = add_trc_marker(marker_names, coords, marker, unnorm2_outputs[:,c*3:c*3+3])
                 
             # %% Gather data for computing minimum y-position.
             outputs_all[idx_augm]['response_markers'] = response_markers   
@@ -262,10 +298,10 @@ def augmentTRC(config_dict):
             
         # %% If offset
         if offset:
-            trc_file.offset('y', -(min_y_pos-0.01))
+            coords[:,1::3] -= (min_y_pos-0.01)
             
         # %% Return augmented .trc file   
-        trc_file.write(pathOutputTRCFile)
+        write_augmented_trc(pathOutputTRCFile, trc_header_in, frames, times, marker_names, coords)
 
         logging.info(f'Augmented marker coordinates are stored at {pathOutputTRCFile}.')
 
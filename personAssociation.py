@@ -46,7 +46,8 @@ from anytree.importer import DictImporter
 import logging
 
 from Pose2Sim.common import retrieve_calib_params, computeP, weighted_triangulation, \
-    reprojection, euclidean_distance, sort_stringlist_by_last_number
+    reprojection, euclidean_distance, sort_stringlist_by_last_number, undistortion_lut, undistort_points_batch, \
+    project_points, frame_json_files, synced_json_name, read_sync_offsets
 from Pose2Sim.skeletons import *
 
 
@@ -120,11 +121,7 @@ def triangulate_comb(comb, coords, P_all, calib_params, config_dict):
     # Filter coords and projection_matrices containing nans
     coords_filt = [coords[i] for i in range(len(comb)) if not np.isnan(comb[i])]
     projection_matrices_filt = [P_all[i] for i in range(len(comb)) if not np.isnan(comb[i])]
-    if undistort_points:
-        calib_params_R_filt = [calib_params['R'][i] for i in range(len(comb)) if not np.isnan(comb[i])]
-        calib_params_T_filt = [calib_params['T'][i] for i in range(len(comb)) if not np.isnan(comb[i])]
-        calib_params_K_filt = [calib_params['K'][i] for i in range(len(comb)) if not np.isnan(comb[i])]
-        calib_params_dist_filt = [calib_params['dist'][i] for i in range(len(comb)) if not np.isnan(comb[i])]
+    cams_filt = np.flatnonzero(~np.isnan(comb))
 
     # Triangulate 2D points
     try:
@@ -135,9 +132,8 @@ def triangulate_comb(comb, coords, P_all, calib_params, config_dict):
 
     # Reprojection
     if undistort_points:
-        coords_2D_kpt_calc_filt = [cv2.projectPoints(np.array(Q_comb[:-1]), calib_params_R_filt[i], calib_params_T_filt[i], calib_params_K_filt[i], calib_params_dist_filt[i])[0] for i in range(len(Q_comb))]
-        x_calc = [coords_2D_kpt_calc_filt[i][0,0,0] for i in range(len(Q_comb))]
-        y_calc = [coords_2D_kpt_calc_filt[i][0,0,1] for i in range(len(Q_comb))]
+        coords_2D_kpt_calc_filt = project_points(Q_comb, calib_params)[cams_filt] # cams * 2
+        x_calc, y_calc = coords_2D_kpt_calc_filt[:,0], coords_2D_kpt_calc_filt[:,1]
     else:
         x_calc, y_calc = reprojection(projection_matrices_filt, Q_comb)
 
@@ -152,7 +148,7 @@ def triangulate_comb(comb, coords, P_all, calib_params, config_dict):
     return error_comb, comb, Q_comb
 
 
-def best_persons_and_cameras_combination(config_dict, json_files_framef, personsIDs_combinations, projection_matrices, tracked_keypoint_id, calib_params):
+def best_persons_and_cameras_combination(config_dict, json_files_framef, personsIDs_combinations, projection_matrices, tracked_keypoint_id, calib_params, undistortion_luts=None):
     '''
     Chooses the right person among the multiple ones found by
     OpenPose & excludes cameras with wrong 2d-pose estimation.
@@ -169,6 +165,8 @@ def best_persons_and_cameras_combination(config_dict, json_files_framef, persons
     - personsIDs_combinations: array, list of lists of int
     - projection_matrices: list of arrays
     - tracked_keypoint_id: int
+    - calib_params: dict, see retrieve_calib_params
+    - undistortion_luts: optional undistortion lookup tables, see undistortion_lut
 
     OUTPUTS:
     - errors_below_thresh: list of float
@@ -183,25 +181,29 @@ def best_persons_and_cameras_combination(config_dict, json_files_framef, persons
     error_min = np.inf 
     nb_cams_off = 0 # cameras will be taken-off until the reprojection error is under threshold
     Q_kpt = []
+
+    # Get coords of all persons from files, once per frame
+    coords_per_cam = []
+    for index_cam in range(n_cams):
+        try:
+            js = read_json(json_files_framef[index_cam])
+            coords_per_cam.append(np.array([js_person[tracked_keypoint_id*3:tracked_keypoint_id*3+3] for js_person in js], dtype=float).reshape(-1,3))
+        except:
+            coords_per_cam.append(np.empty((0,3)))
+    
+    # undistort points: one call per camera
+    if undistort_points:
+        x_per_cam, y_per_cam = [c[:,0] for c in coords_per_cam], [c[:,1] for c in coords_per_cam]
+        undistort_points_batch(x_per_cam, y_per_cam, calib_params, luts=undistortion_luts)
+        for index_cam in range(n_cams):
+            coords_per_cam[index_cam][:,0], coords_per_cam[index_cam][:,1] = x_per_cam[index_cam], y_per_cam[index_cam]
+
     while error_min > error_threshold_tracking and n_cams - nb_cams_off >= min_cameras_for_triangulation:
         # Try all persons combinations
         for combination in personsIDs_combinations:
-            #  Get coords from files
-            coords = []
-            for index_cam, person_nb in enumerate(combination):
-                try:
-                    js = read_json(json_files_framef[index_cam])
-                    coords.append(js[int(person_nb)][tracked_keypoint_id*3:tracked_keypoint_id*3+3])
-                except:
-                    coords.append([np.nan, np.nan, np.nan])
-            coords = np.array(coords)
-            
-            # undistort points
-            if undistort_points:
-                points = np.array(coords)[:,None,:2]
-                undistorted_points = [cv2.undistortPoints(points[i], calib_params['K'][i], calib_params['dist'][i], None, calib_params['optim_K'][i]) for i in range(n_cams)]
-                coords[:,0] = np.array([[u[i][0][0] for i in range(len(u))] for u in undistorted_points]).squeeze()
-                coords[:,1] = np.array([[u[i][0][1] for i in range(len(u))] for u in undistorted_points]).squeeze()
+            coords = np.array([coords_per_cam[index_cam][int(person_nb)] 
+                               if not np.isnan(person_nb) and int(person_nb) < len(coords_per_cam[index_cam]) else [np.nan, np.nan, np.nan]
+                               for index_cam, person_nb in enumerate(combination)])
 
             # For each persons combination, create subsets with "nb_cams_off" cameras excluded
             id_cams_off = list(it.combinations(range(len(combination)), nb_cams_off))
@@ -654,6 +656,7 @@ def track_2d_all(config_dict):
     # projection matrix from toml calibration file
     P_all = computeP(calib_file, undistort=undistort_points)
     calib_params = retrieve_calib_params(calib_file)
+    undistortion_luts = undistortion_lut(calib_params) if undistort_points and config_dict.get('triangulation').get('undistortion_lut', False) else None
         
     # selection of tracked keypoint id
     try: # from skeletons.py
@@ -677,12 +680,17 @@ def track_2d_all(config_dict):
     json_dirs_names = [k for k in pose_listdirs_names if 'json' in k]
     try: 
         json_files_names = [fnmatch.filter(os.listdir(os.path.join(poseSync_dir, js_dir)), '*.json') for js_dir in json_dirs_names]
+        json_source_dir = poseSync_dir
+        sync_offsets = {}
     except:
         try:
             json_files_names = [fnmatch.filter(os.listdir(os.path.join(pose_dir, js_dir)), '*.json') for js_dir in json_dirs_names]
+            json_source_dir = pose_dir
+            sync_offsets = read_sync_offsets(project_dir) # offsets from the synchronization manifest, if any
         except:
             raise ValueError(f'No json files found in {pose_dir} nor {poseSync_dir} subdirectories. Make sure you run Pose2Sim.poseEstimation() first.')
     json_files_names = [sort_stringlist_by_last_number(j) for j in json_files_names]
+    frame_files = [frame_json_files(json_files_names[c], sync_offsets.get(json_dirs_names[c], 0)) for c in range(len(json_dirs_names))]
     
     # 2d-pose-associated files creation
     if not os.path.exists(poseTracked_dir): os.mkdir(poseTracked_dir)   
@@ -690,7 +698,7 @@ def track_2d_all(config_dict):
     except: pass
     
     error_min_tot, cameras_off_tot = [], []
-    f_range = [[0,max([len(j) for j in json_files_names])] if frame_range==[] else frame_range][0]
+    f_range = [[0,max([len(j) for j in frame_files])] if frame_range==[] else frame_range][0]
     n_cams = len(json_dirs_names)
 
     # Check that camera number is consistent between calibration file and pose folders
@@ -701,21 +709,18 @@ def track_2d_all(config_dict):
     
     for f in tqdm(range(*f_range)):
         # print(f'\nFrame {f}:')
-        json_files_names_f = [[j for j in json_files_names[c] if int(re.split(r'(\d+)',j)[-2])==f] for c in range(n_cams)]
-        json_files_names_f = [j for j_list in json_files_names_f for j in (j_list or ['none'])]
-        try:
-            json_files_f = [os.path.join(poseSync_dir, json_dirs_names[c], json_files_names_f[c]) for c in range(n_cams)]
-            with open(os.path.exist(json_files_f[0])) as json_exist_test: pass
-        except:
-            json_files_f = [os.path.join(pose_dir, json_dirs_names[c], json_files_names_f[c]) for c in range(n_cams)]
-        json_tracked_files_f = [os.path.join(poseTracked_dir, json_dirs_names[c], json_files_names_f[c]) for c in range(n_cams)]
+        json_files_names_f = [frame_files[c].get(f, 'none') for c in range(n_cams)]
+        json_files_f = [os.path.join(json_source_dir, json_dirs_names[c], json_files_names_f[c]) for c in range(n_cams)]
+        # associated files are named after their synchronized frame
+        json_tracked_names_f = [synced_json_name(j, f) if sync_offsets and j != 'none' else j for j in json_files_names_f]
+        json_tracked_files_f = [os.path.join(poseTracked_dir, json_dirs_names[c], json_tracked_names_f[c]) for c in range(n_cams)]
 
         if not multi_person:
             # all possible combinations of persons
             personsIDs_comb = persons_combinations(json_files_f) 
             
             # choose persons of interest and exclude cameras with bad pose estimation
-            error_proposals, proposals, Q_kpt = best_persons_and_cameras_combination(config_dict, json_files_f, personsIDs_comb, P_all, tracked_keypoint_id, calib_params)
+            error_proposals, proposals, Q_kpt = best_persons_and_cameras_combination(config_dict, json_files_f, personsIDs_comb, P_all, tracked_keypoint_id, calib_params, undistortion_luts=undistortion_luts)
 
             if not np.isinf(error_proposals):
                 error_min_tot.append(np.nanmean(error_proposals))
@@ -17,8 +17,11 @@ from datetime import datetime
 import cv2
 from rtmlib import BodyWithFeet, Wholebody, PoseTracker, draw_skeleton
 import logging
-from skelly_synchronize import skelly_synchronize as sync
+import json
+import numpy as np
+import matplotlib.pyplot as plt
 from Pose2Sim import Pose2Sim
+from Pose2Sim.synchronization import lagged_pearson_r
 import ffmpeg
 
 
@@ -313,18 +316,169 @@ def classification() :
 
 
 
-def synchronisation(curTrial=[],mosaicSyncControl=True,plotSyncControl=True) :
+def extractionAudio(videoPath, sampleRate=8000, duree=None):
     
     """
     
     ***
     OBJECTIF DE LA FONCTION
     ***
-    Synchroniser les vidéos à partir de la fonction de synchronisation sonore
-    du module pré-existant skelly_synchronize :
-    https://github.com/freemocap/skelly_synchronize
-    Cette fonction de synchronisation se base sur une cross-correlation du 
-    signal de la bande sonore de l'intégralité de la vidéo.
+    Décoder la bande son d'une vidéo directement en mémoire (pipe ffmpeg), 
+    en mono et à une fréquence d'échantillonnage réduite, sans écrire de 
+    fichier audio intermédiaire.
+    
+    
+    ***
+    ARGUMENTS
+    ***
+    Input :
+        * videoPath (str) : chemin de la vidéo.
+        
+        * sampleRate (optionnel - int) : fréquence d'échantillonnage du signal
+        décodé, en Hz. par défaut -> 8000.
+        
+        * duree (optionnel - float) : durée décodée depuis le début de la 
+        vidéo, en secondes. par défaut -> toute la vidéo.
+        
+    Output :
+        * audio (np.array float32) : signal sonore.
+    """
+    
+    inputArgs = {} if duree is None else {'t': duree}
+    out, _ = (ffmpeg
+              .input(str(videoPath), **inputArgs)
+              .output('pipe:', format='f32le', acodec='pcm_f32le', ac=1, ar=sampleRate)
+              .run(capture_stdout=True, capture_stderr=True))
+    
+    return np.frombuffer(out, np.float32)
+
+
+
+def decalagesAudio(videoPaths, sampleRate=8000, dureeAnalyse=60, decalageMax=10, plotPath=None):
+    
+    """
+    
+    ***
+    OBJECTIF DE LA FONCTION
+    ***
+    Calculer le décalage temporel de chaque vidéo par rapport à la première,
+    par cross-correlation (FFT) de leurs bandes son. Seule une fenêtre 
+    d'analyse bornée au début des vidéos est décodée.
+    
+    
+    ***
+    ARGUMENTS
+    ***
+    Input :
+        * videoPaths (list of str) : chemins des vidéos. La première sert 
+        de référence.
+        
+        * sampleRate (optionnel - int) : fréquence d'échantillonnage de 
+        l'analyse, en Hz. par défaut -> 8000.
+        
+        * dureeAnalyse (optionnel - float) : durée de la fenêtre d'analyse,
+        en secondes. par défaut -> 60.
+        
+        * decalageMax (optionnel - float) : décalage maximal recherché entre
+        deux vidéos, en secondes. par défaut -> 10.
+        
+        * plotPath (optionnel - str) : si renseigné, figure des bandes son 
+        superposées après synchronisation enregistrée à ce chemin.
+        par défaut -> None.
+        
+    Output :
+        * avances (list of float) : avance de démarrage de chaque vidéo par 
+        rapport à la référence, en secondes (positive si la vidéo a démarré 
+        avant la référence).
+        
+        * correlations (list of float) : coefficient de corrélation au pic.
+    """
+    
+    audios = [extractionAudio(v, sampleRate, dureeAnalyse+decalageMax) for v in videoPaths]
+    lagMax = int(decalageMax*sampleRate)
+    lags = np.arange(-lagMax, lagMax+1)
+    
+    avances, correlations = [0.], [1.]
+    for audio in audios[1:]:
+        pearson_r = lagged_pearson_r(audios[0][:int(dureeAnalyse*sampleRate)], audio, lags)
+        if np.isnan(pearson_r).all():
+            avances.append(0.)
+            correlations.append(0.)
+            continue
+        avances.append(float(-lags[np.nanargmax(pearson_r)] / sampleRate))
+        correlations.append(float(np.nanmax(pearson_r)))
+    
+    if plotPath is not None:
+        f, ax = plt.subplots(len(audios), 1, sharex=True, sharey=True)
+        for i, (audio, avance) in enumerate(zip(audios, avances)):
+            temps = np.arange(len(audio))/sampleRate - avance
+            ax[i].plot(temps, audio, linewidth=0.5)
+            ax[i].set(ylabel=Path(videoPaths[i]).stem)
+        ax[-1].set(xlabel='Temps de la vidéo de référence (s)')
+        f.tight_layout()
+        f.savefig(plotPath)
+        plt.close(f)
+    
+    return avances, correlations
+
+
+
+def decoupageVideos(videoPaths, outputFolder, debuts, duree, modeDecoupage='reencode'):
+    
+    """
+    
+    ***
+    OBJECTIF DE LA FONCTION
+    ***
+    Couper le début et la fin des vidéos pour qu'elles soient synchronisées.
+    
+    
+    ***
+    ARGUMENTS
+    ***
+    Input :
+        * videoPaths (list of str) : chemins des vidéos.
+        
+        * outputFolder (str) : dossier des vidéos synchronisées.
+        
+        * debuts (list of float) : temps de début de chaque vidéo, en secondes.
+        
+        * duree (float) : durée commune des vidéos, en secondes.
+        
+        * modeDecoupage (optionnel - str) : 'reencode' pour une coupe précise
+        à l'image près (réencodage), ou 'copy' pour une coupe sans réencodage
+        (rapide, mais la coupe se fait sur l'image clé la plus proche).
+        par défaut -> 'reencode'.
+        
+    Output :
+        * vidéos synchronisées dans outputFolder.
+    """
+    
+    codecs = {'c': 'copy'} if modeDecoupage == 'copy' else {'vcodec': 'libx264', 'acodec': 'aac'}
+    for videoPath, debut in zip(videoPaths, debuts):
+        outputPath = os.path.join(outputFolder, Path(videoPath).stem + '.mp4')
+        (ffmpeg
+         .input(str(videoPath), ss=debut)
+         .output(outputPath, t=duree, **codecs)
+         .overwrite_output()
+         .run(capture_stdout=True, capture_stderr=True))
+
+
+
+def synchronisation(curTrial=[],mosaicSyncControl=True,plotSyncControl=True,sampleRate=8000,dureeAnalyse=60,decalageMax=10,modeDecoupage='reencode') :
+    
+    """
+    
+    ***
+    OBJECTIF DE LA FONCTION
+    ***
+    Synchroniser les vidéos à partir de leur bande sonore.
+    Les bandes son sont décodées en mémoire à fréquence réduite, sur une 
+    fenêtre d'analyse bornée au début des vidéos, et les décalages sont 
+    calculés par cross-correlation (FFT). Ils sont enregistrés dans le 
+    fichier audio_offsets.json de l'essai, sans fichier audio intermédiaire.
+    Les vidéos sont ensuite coupées dans le dossier videos, avec ou sans 
+    réencodage.
     
         conda install -c conda-forge ffmpeg
 
@@ -347,22 +501,37 @@ def synchronisation(curTrial=[],mosaicSyncControl=True,plotSyncControl=True) :
         signal des bandes sonores superposées après la cross-correlation. 
         par défaut sur None.
         
+        * sampleRate (optionnel - int) : fréquence d'échantillonnage de 
+        l'analyse audio, en Hz. par défaut -> 8000.
+        
+        * dureeAnalyse (optionnel - float) : durée de la fenêtre d'analyse,
+        en secondes. par défaut -> 60.
+        
+        * decalageMax (optionnel - float) : décalage maximal recherché entre
+        deux vidéos, en secondes. par défaut -> 10.
+        
+        * modeDecoupage (optionnel - str) : 'reencode' (coupe à l'image près),
+        'copy' (coupe sans réencodage, sur les images clés), ou None (seul 
+        audio_offsets.json est écrit : les vidéos brutes sont alors lues avec 
+        leurs décalages par l'estimation de pose, avec virtual_sync = true 
+        dans la section [pose] du Config.toml). par défaut -> 'reencode'.
+        
     Output :
-        * 
+        * audio_offsets.json et vidéos synchronisées dans le dossier videos
+        de chaque essai.
         
     ***
     WARNING
     ***
     Attention :
-        /1\ 
-        /2\ 
-        /3\ 
+        /1\ Le son doit contenir des événements communs à toutes les 
+        caméras pendant la fenêtre d'analyse (clap, top départ...).
+        /2\ Le décalage entre deux caméras doit être inférieur à decalageMax.
         
     ***
     PISTES D'UPGRADE
     ***
     Mettre le mosaicmaker dans une fonction à part
-    Trouver le moyen de ne pas save les bandes son    
     """
     
     logging.info("====================")
@@ -391,20 +560,43 @@ def synchronisation(curTrial=[],mosaicSyncControl=True,plotSyncControl=True) :
     for trial in range(nbtrials) :
         
         #Récupération des chemins de l'essai à traiter
-        raw_video_folder_path = Path(os.path.join(path,trialname[trial],"videos_raw"))
-        sync_video_folder_path = Path(os.path.join(path,trialname[trial],"videos"))        
+        trial_folder_path = os.path.join(path,trialname[trial])
+        raw_video_folder_path = Path(os.path.join(trial_folder_path,"videos_raw"))
+        sync_video_folder_path = Path(os.path.join(trial_folder_path,"videos"))        
+        offsets_path = os.path.join(trial_folder_path,"audio_offsets.json")
         
         #Si dossier de vidéos synchronisées vide ou inexistant...
-        if not os.path.exists(sync_video_folder_path) or os.listdir(sync_video_folder_path)==[] :
+        if (modeDecoupage is not None and (not os.path.exists(sync_video_folder_path) or os.listdir(sync_video_folder_path)==[])) \
+            or (modeDecoupage is None and not os.path.exists(offsets_path)) :
             
-            #Création du dossier si inexistant
-            if not os.path.exists(os.path.join(path,"Trial_"+str(trial+1),"videos")):os.mkdir(os.path.join(path,"Trial_"+str(trial+1),"videos"))
+            #Vidéos brutes, la première sert de référence
+            videoPaths = sorted([os.path.join(raw_video_folder_path, f) for f in os.listdir(raw_video_folder_path) 
+                                 if os.path.splitext(f)[1].lower() in ['.mp4', '.mov', '.avi']])
             
-            #Fonction de synchronisation
-            sync.synchronize_videos_from_audio(raw_video_folder_path=raw_video_folder_path,
-                                                synchronized_video_folder_path = sync_video_folder_path,
-                                                video_handler="deffcode",
-                                                create_debug_plots_bool=plotSyncControl)
+            #Calcul des décalages
+            plotPath = os.path.join(trial_folder_path,"audio_sync.png") if plotSyncControl else None
+            avances, correlations = decalagesAudio(videoPaths, sampleRate=sampleRate, dureeAnalyse=dureeAnalyse, decalageMax=decalageMax, plotPath=plotPath)
+            
+            #Début de chaque vidéo et durée commune
+            durees = [float(ffmpeg.probe(v)['format']['duration']) for v in videoPaths]
+            debuts = [avance - min(avances) for avance in avances]
+            duree = min([d - avance for d, avance in zip(durees, avances)]) + min(avances)
+            for videoPath, debut, correlation in zip(videoPaths, debuts, correlations):
+                logging.info(f"{Path(videoPath).name} : début à {round(debut, 3)} s, corrélation {round(correlation, 2)}.")
+            
+            #Enregistrement des décalages
+            offsets = {'method': 'audio_cross_correlation', 'reference_video': Path(videoPaths[0]).name, 
+                       'sample_rate': sampleRate, 'duration': duree,
+                       'videos': {Path(v).name: {'start': debut, 'offset': avance, 'correlation': correlation} 
+                                  for v, debut, avance, correlation in zip(videoPaths, debuts, avances, correlations)}}
+            with open(offsets_path, 'w') as f:
+                json.dump(offsets, f, indent=4)
+            logging.info(f"Décalages enregistrés dans {offsets_path}.")
+            
+            #Découpage des vidéos
+            if modeDecoupage is not None :
+                if not os.path.exists(sync_video_folder_path):os.mkdir(sync_video_folder_path)
+                decoupageVideos(videoPaths, sync_video_folder_path, debuts, duree, modeDecoupage=modeDecoupage)
         
             # if mosaicSyncControl ==True :
             #     #Récupération des noms des vidéos
@@ -452,7 +644,6 @@ def synchronisation(curTrial=[],mosaicSyncControl=True,plotSyncControl=True) :
                             
             #     mozaicMaker = mozaicMaker+"-c:v libx264 "+str(sync_video_folder_path)+"\\"+"SyncVideos.mp4"
             #     os.system(mozaicMaker)
-                
 
             logging.info("Vidéos synchronisées avec succès.")
         else : 
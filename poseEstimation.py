@@ -42,7 +42,7 @@ import cv2
 import onnxruntime as ort
 
 from rtmlib import PoseTracker, Body, Wholebody, BodyWithFeet, draw_skeleton
-from Pose2Sim.common import natural_sort_key
+from Pose2Sim.common import natural_sort_key, read_audio_offsets, find_video_files
 
 
 ## AUTHORSHIP INFORMATION
@@ -100,7 +100,7 @@ def save_to_openpose(json_file_path, keypoints, scores):
         json.dump(json_output, json_file)
 
 
-def process_video(video_path, pose_tracker, tracking, output_format, save_video, save_images, display_detection, frame_range):
+def process_video(video_path, pose_tracker, tracking, output_format, save_video, save_images, display_detection, frame_range, start_time=0, duration=None):
     '''
     Estimate pose from a video file
     
@@ -113,6 +113,8 @@ def process_video(video_path, pose_tracker, tracking, output_format, save_video,
     - save_images: bool. Whether to save the output images
     - display_detection: bool. Whether to show real-time visualization
     - frame_range: list. Range of frames to process
+    - start_time: float. Time of the video, in seconds, which is considered as frame 0 (virtual synchronization)
+    - duration: float. Duration of the video to process from start_time, in seconds. Default: until the end
 
     OUTPUTS:
     - JSON files with the detected keypoints and confidence scores in the OpenPose format
@@ -147,10 +149,21 @@ def process_video(video_path, pose_tracker, tracking, output_format, save_video,
     frame_idx = 0
     cap = cv2.VideoCapture(video_path)
     total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+
+    # Virtual synchronization: frames before start_time are skipped without being processed, 
+    # so that frame numbers are aligned across cameras
+    start_frame = int(round(start_time * cap.get(cv2.CAP_PROP_FPS)))
+    nb_frames = int(duration * cap.get(cv2.CAP_PROP_FPS)) if duration is not None else None
+    for _ in range(start_frame):
+        cap.grab()
+    total_frames = max(total_frames - start_frame, 0) if nb_frames is None else min(max(total_frames - start_frame, 0), nb_frames)
+
     f_range = [[total_frames] if frame_range==[] else frame_range][0]
     with tqdm(total=total_frames, desc=f'Processing {os.path.basename(video_path)}') as pbar:
         while cap.isOpened():
             # print('\nFrame ', frame_idx)
+            if nb_frames is not None and frame_idx >= nb_frames:
+                break
             success, frame = cap.read()
             if not success:
                 break
@@ -331,6 +344,7 @@ def rtm_estimator(config_dict):
     frame_range = config_dict.get('project').get('frame_range')
     video_dir = os.path.join(project_dir, 'videos')
     pose_dir = os.path.join(project_dir, 'pose')
+    virtual_sync = config_dict['pose'].get('virtual_sync', False)
 
     pose_model = config_dict['pose']['pose_model']
     mode = config_dict['pose']['mode'] # lightweight, balanced, performance
@@ -345,8 +359,16 @@ def rtm_estimator(config_dict):
     det_frequency = config_dict['pose']['det_frequency']
     tracking = config_dict['pose']['tracking']
 
+    # Virtual synchronization: raw videos are read with their offsets, instead of synchronized copies
+    audio_offsets = read_audio_offsets(project_dir) if virtual_sync else {}
+    if virtual_sync:
+        if audio_offsets == {}:
+            raise FileNotFoundError(f'virtual_sync is true but no audio_offsets.json was found in {project_dir}. Run the audio synchronization first.')
+        video_dir = os.path.join(project_dir, 'videos_raw')
+        logging.info(f'Virtual synchronization: reading raw videos from {video_dir} with the offsets of audio_offsets.json.')
+
     # Determine frame rate
-    video_files = glob.glob(os.path.join(video_dir, '*'+vid_img_extension))
+    video_files = glob.glob(os.path.join(video_dir, '*'+vid_img_extension)) if not virtual_sync else [os.path.join(video_dir, v) for v in audio_offsets['videos']]
     frame_rate = config_dict.get('project').get('frame_rate')
     if frame_rate == 'auto': 
         try:
@@ -423,13 +445,17 @@ def rtm_estimator(config_dict):
             raise
             
     except:
-        video_files = glob.glob(os.path.join(video_dir, '*'+vid_img_extension))
+        video_files = glob.glob(os.path.join(video_dir, '*'+vid_img_extension)) if not virtual_sync else [os.path.join(video_dir, v) for v in audio_offsets['videos']]
         if not len(video_files) == 0: 
             # Process video files
             logging.info(f'Found video files with extension {vid_img_extension}.')
             for video_path in video_files:
                 pose_tracker.reset()
-                process_video(video_path, pose_tracker, tracking, output_format, save_video, save_images, display_detection, frame_range)
+                if virtual_sync:
+                    start_time = audio_offsets['videos'][os.path.basename(video_path)]['start']
+                    process_video(video_path, pose_tracker, tracking, output_format, save_video, save_images, display_detection, frame_range, start_time=start_time, duration=audio_offsets['duration'])
+                else:
+                    process_video(video_path, pose_tracker, tracking, output_format, save_video, save_images, display_detection, frame_range)
 
         else:
             # Process image folders
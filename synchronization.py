@@ -27,7 +27,8 @@
     - a skeleton model
 
     OUTPUTS: 
-    - synchronized json files for each camera
+    - synchronized json files for each camera,
+      or a sync_offsets.json manifest if sync_output = 'manifest'
 '''
 
 
@@ -36,8 +37,7 @@ import numpy as np
 import pandas as pd
 import cv2
 import matplotlib.pyplot as plt
-from scipy import signal
-from scipy import interpolate
+from scipy import signal, optimize
 import json
 import os
 import glob
@@ -46,9 +46,11 @@ import re
 import shutil
 from anytree import RenderTree
 from anytree.importer import DictImporter
+from concurrent.futures import ThreadPoolExecutor
 import logging
 
-from Pose2Sim.common import sort_stringlist_by_last_number
+from Pose2Sim.common import sort_stringlist_by_last_number, json_frame_number, synced_json_name, frame_json_files, read_sync_offsets, find_video_files
+from Pose2Sim.interpolation import interpolate_zeros_nans
 from Pose2Sim.skeletons import *
 
 
@@ -64,138 +66,289 @@ __status__ = "Development"
 
 
 # FUNCTIONS
-def convert_json2pandas(json_files, likelihood_threshold=0.6):
+def read_json_keypoints(json_file, nb_keypoints):
     '''
-    Convert a list of JSON files to a pandas DataFrame.
+    Read the keypoints of the first person detected in a JSON file.
 
     INPUTS:
-    - json_files: list of str. Paths of the the JSON files.
-    - likelihood_threshold: float. Drop values if confidence is below likelihood_threshold.
-    - frame_range: select files within frame_range.
+    - json_file: str. Path of the JSON file
+    - nb_keypoints: int. Number of keypoints of the pose model
 
-    OUTPUTS:
-    - df_json_coords: dataframe. Extracted coordinates in a pandas dataframe.
+    OUTPUT:
+    - keypoints: array of shape (nb_keypoints, 3): x, y, likelihood.
+      Nan if no person is found, or if the person has fewer keypoints than the model
     '''
 
-    nb_coord = 25 # int(len(json_data)/3)
-    json_coords = []
-    for j_p in json_files:
-        with open(j_p) as j_f:
-            try:
-                json_data = json.load(j_f)['people'][0]['pose_keypoints_2d']
-                # remove points with low confidence
-                json_data = np.array([[json_data[3*i],json_data[3*i+1],json_data[3*i+2]] if json_data[3*i+2]>likelihood_threshold else [0.,0.,0.] for i in range(nb_coord)]).ravel().tolist()
-            except:
-                # print(f'No person found in {os.path.basename(json_dir)}, frame {i}')
-                json_data = [np.nan] * 25*3
-        json_coords.append(json_data)
-    df_json_coords = pd.DataFrame(json_coords)
-
-    return df_json_coords
+    try:
+        with open(json_file) as j_f:
+            json_data = json.load(j_f)['people'][0]['pose_keypoints_2d']
+        return np.array(json_data[:nb_keypoints*3], dtype=np.float32).reshape(nb_keypoints, 3)
+    except:
+        return np.full((nb_keypoints, 3), np.nan, dtype=np.float32)
 
 
-def drop_col(df, col_nb):
+def load_json_keypoints(json_files, nb_keypoints, likelihood_threshold=0.6, nb_workers=None):
     '''
-    Drops every nth column from a DataFrame.
+    Load the keypoints of the first person in a list of JSON files.
+    Files are read in parallel threads.
 
     INPUTS:
-    - df: dataframe. The DataFrame from which columns will be dropped.
-    - col_nb: int. The column number to drop.
+    - json_files: list of str. Paths of the JSON files, one per frame
+    - nb_keypoints: int. Number of keypoints of the pose model
+    - likelihood_threshold: float. Points whose likelihood is below this threshold are set to 0
+    - nb_workers: int. Number of threads. Default: chosen by ThreadPoolExecutor
 
-    OUTPUTS:
-    - dataframe: DataFrame with dropped columns.
+    OUTPUT:
+    - keypoints: float32 array of shape (frames, nb_keypoints, 3): x, y, likelihood
     '''
 
-    idx_col = list(range(col_nb-1, df.shape[1], col_nb)) 
-    df_dropped = df.drop(idx_col, axis=1)
-    df_dropped.columns = range(df_dropped.columns.size)
-    return df_dropped
+    keypoints = np.empty((len(json_files), nb_keypoints, 3), dtype=np.float32)
+    with ThreadPoolExecutor(max_workers=nb_workers) as executor:
+        for f, kpts in enumerate(executor.map(lambda j_p: read_json_keypoints(j_p, nb_keypoints), json_files)):
+            keypoints[f] = kpts
+
+    # remove points with low confidence
+    keypoints[keypoints[:,:,2] <= likelihood_threshold] = 0
 
+    return keypoints
 
-def vert_speed(df, axis='y'):
+
+def vert_speed(coords, axis='y'):
     '''
-    Calculate the vertical speed of a DataFrame along a specified axis.
+    Calculate the vertical speed of 2D coordinates along a specified axis.
 
     INPUTS:
-    - df: dataframe. DataFrame of 2D coordinates.
+    - coords: array of shape (frames, keypoints, 2 or 3). 2D coordinates.
     - axis: str. The axis along which to calculate speed. 'x', 'y', or 'z', default is 'y'.
 
     OUTPUTS:
-    - df_vert_speed: DataFrame of vertical speed values.
+    - vert_speed: array of shape (frames, keypoints). Speed of each keypoint.
     '''
 
     axis_dict = {'x':0, 'y':1, 'z':2}
-    df_diff = df.diff()
-    df_diff = df_diff.fillna(df_diff.iloc[1]*2)
-    df_vert_speed = pd.DataFrame([df_diff.loc[:, 2*k + axis_dict[axis]] for k in range(int(df_diff.shape[1] / 2))]).T # modified ( df_diff.shape[1]*2 to df_diff.shape[1] / 2 )
-    df_vert_speed.columns = np.arange(len(df_vert_speed.columns))
-    return df_vert_speed
+    coords_axis = coords[:,:,axis_dict[axis]]
+    vert_speed = np.empty_like(coords_axis)
+    vert_speed[1:] = np.diff(coords_axis, axis=0)
+    vert_speed[0] = vert_speed[1]*2
+    return vert_speed
 
 
-def interpolate_zeros_nans(col, kind):
+def camera_speed(json_files, nb_keypoints, kpt_indices, b, a, likelihood_threshold=0.6):
     '''
-    Interpolate missing points (of value nan)
+    Filtered sum of absolute vertical speeds of the selected keypoints of one camera.
+    Keypoint coordinates are interpolated, filtered, differentiated and summed,
+    and only the resulting 1D signal is kept.
 
     INPUTS:
-    - col: pandas column of coordinates
-    - kind: 'linear', 'slinear', 'quadratic', 'cubic'. Default 'cubic'
+    - json_files: list of str. Paths of the JSON files of the camera, one per frame
+    - nb_keypoints: int. Number of keypoints of the pose model
+    - kpt_indices: array of ints. Keypoints to consider
+    - b, a: Butterworth filter coefficients, applied to coordinates and to the summed speed
+    - likelihood_threshold: float. Points whose likelihood is below this threshold are ignored
+
+    OUTPUT:
+    - sum_speed: 1D array of shape (frames,)
+    '''
 
-    OUTPUTS:
-    - col_interp: interpolated pandas column
+    coords = load_json_keypoints(json_files, nb_keypoints, likelihood_threshold=likelihood_threshold)
+    coords = coords[:,kpt_indices,:2] # drop likelihood
+    frame_nb = len(coords)
+    coords = interpolate_zeros_nans(coords.reshape(frame_nb,-1), kind='linear', extrapolate=False, errors='ignore')
+    coords = pd.DataFrame(coords).bfill().ffill().to_numpy()
+    coords = signal.filtfilt(b, a, coords, axis=0)
+
+    sum_speed = np.nansum(abs(vert_speed(coords.reshape(frame_nb,-1,2))), axis=1)
+    # # Replace 0 by random values, otherwise 0 padding may lead to unreliable correlations
+    # sum_speed[sum_speed < 1] = np.random.normal(0, 1, (sum_speed < 1).sum())
+    sum_speed = signal.filtfilt(b, a, sum_speed, axis=0)
+
+    return sum_speed
+
+
+def lagged_pearson_r(x, y, lags):
     '''
-    
-    mask = ~(np.isnan(col) | col.eq(0)) # true where nans or zeros
-    idx_good = np.where(mask)[0]
-    try: 
-        f_interp = interpolate.interp1d(idx_good, col[idx_good], kind=kind, bounds_error=False)
-        col_interp = np.where(mask, col, f_interp(col.index))
-        return col_interp 
-    except:
-        # print('No good values to interpolate')
-        return col
+    Pearson correlation between x[t] and y[t-lag], for all lags at once.
+
+    Equivalent to pd.Series(x).corr(pd.Series(y).shift(lag)) for each lag:
+    only overlapping pairs where both values are valid (not nan) are taken
+    into account. The sums involved are computed as FFT cross-correlations
+    of the masked series, so that the cost is O(N log N) instead of O(N * lags).
+
+    INPUTS:
+    - x: 1D array. Reference series
+    - y: 1D array. Series to compare
+    - lags: 1D array of ints. Lags for which to compute the correlation
+
+    OUTPUT:
+    - pearson_r: 1D array of the same length as lags. Nan where the correlation is undefined
+    '''
+
+    x = np.asarray(x, dtype=float)[:min(len(x), len(y))] # index alignment, as in pandas
+    y = np.asarray(y, dtype=float)
+    lags = np.asarray(lags, dtype=int)
+
+    # Masked, centered series (centering does not change r but limits round-off errors)
+    mx, my = ~np.isnan(x), ~np.isnan(y)
+    if not mx.any() or not my.any():
+        return np.full(len(lags), np.nan)
+    x = np.where(mx, x - np.nanmean(x), 0)
+    y = np.where(my, y - np.nanmean(y), 0)
+    mx, my = mx.astype(float), my.astype(float)
+
+    # sum_t a[t]*b[t-lag] for each lag, through FFT
+    def xcorr(a, b):
+        full = signal.fftconvolve(a, b[::-1], mode='full') # lags -(len(b)-1) .. len(a)-1
+        out = np.zeros(len(lags))
+        idx = lags + len(b) - 1
+        in_range = (idx >= 0) & (idx < len(full))
+        out[in_range] = full[idx[in_range]]
+        return out
+
+    n = np.round(xcorr(mx, my))
+    sx, sy = xcorr(x, my), xcorr(mx, y)
+    sxx, syy = xcorr(x**2, my), xcorr(mx, y**2)
+    sxy = xcorr(x, y)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        var_x = n*sxx - sx**2
+        var_y = n*syy - sy**2
+        pearson_r = (n*sxy - sx*sy) / np.sqrt(var_x * var_y)
+    # Undefined correlations: fewer than 2 pairs, or constant series on the overlap
+    eps = 1e-10
+    undefined = (n < 2) | (var_x <= eps * n*sxx) | (var_y <= eps * n*syy)
+    pearson_r[undefined] = np.nan
+    pearson_r = np.clip(pearson_r, -1, 1)
+
+    return pearson_r
+
+
+def lagged_pearson_r_direct(x, y, lags):
+    '''
+    Same as lagged_pearson_r, computed lag by lag.
+    Faster when correlations are only needed for a few lags.
+
+    INPUTS:
+    - x: 1D array. Reference series
+    - y: 1D array. Series to compare
+    - lags: 1D array of ints. Lags for which to compute the correlation
+
+    OUTPUT:
+    - pearson_r: 1D array of the same length as lags. Nan where the correlation is undefined
+    '''
+
+    x = np.asarray(x, dtype=float)[:min(len(x), len(y))] # index alignment, as in pandas
+    y = np.asarray(y, dtype=float)
 
+    pearson_r = np.full(len(lags), np.nan)
+    for l, lag in enumerate(lags):
+        t_start, t_stop = max(0, lag), min(len(x), len(y)+lag)
+        if t_stop - t_start < 2:
+            continue
+        x_l, y_l = x[t_start:t_stop], y[t_start-lag:t_stop-lag]
+        valid = ~np.isnan(x_l) & ~np.isnan(y_l)
+        if np.count_nonzero(valid) < 2:
+            continue
+        x_l = x_l[valid] - x_l[valid].mean()
+        y_l = y_l[valid] - y_l[valid].mean()
+        norm = np.sqrt((x_l**2).sum() * (y_l**2).sum())
+        if norm > 0:
+            pearson_r[l] = np.clip((x_l*y_l).sum() / norm, -1, 1)
 
-def time_lagged_cross_corr(camx, camy, lag_range, show=True, ref_cam_id=0, cam_id=1):
+    return pearson_r
+
+
+def cross_corr_peaks(pearson_r, nb_peaks):
+    '''
+    Indices of the highest local maxima of a cross-correlation curve.
+    Maxima at both ends of the curve are taken into account.
+
+    INPUTS:
+    - pearson_r: 1D array. Cross-correlation for each lag (can contain nans)
+    - nb_peaks: int. Maximum number of peaks to return
+
+    OUTPUT:
+    - peaks: array of indices, sorted by decreasing correlation
+    '''
+
+    r_padded = np.concatenate([[-np.inf], np.nan_to_num(pearson_r, nan=-np.inf), [-np.inf]])
+    peaks, _ = signal.find_peaks(np.nan_to_num(r_padded, neginf=-2))
+    peaks = peaks[np.isfinite(r_padded[peaks])] - 1
+    peaks = peaks[np.argsort(-pearson_r[peaks], kind='stable')]
+
+    return peaks[:nb_peaks]
+
+
+def time_lagged_cross_corr(camx, camy, lag_range, show=True, ref_cam_id=0, cam_id=1, decimation=1, nb_candidates=3):
     '''
-    Compute the time-lagged cross-correlation between two pandas series.
+    Compute the time-lagged cross-correlation between two series.
+
+    The search is coarse-to-fine: the correlation is first computed over the 
+    whole lag range on series decimated by block averaging, and is then 
+    refined at full rate around its nb_candidates highest peaks only.
+    With decimation=1, all lags are computed at full rate.
 
     INPUTS:
-    - camx: pandas series. Coordinates of reference camera.
-    - camy: pandas series. Coordinates of camera to compare.
+    - camx: 1D array. Coordinates of reference camera.
+    - camy: 1D array. Coordinates of camera to compare.
     - lag_range: int or list. Range of frames for which to compute cross-correlation.
     - show: bool. If True, display the cross-correlation plot.
     - ref_cam_id: int. The reference camera id.
     - cam_id: int. The camera id to compare.
+    - decimation: int. Decimation factor of the coarse search.
+    - nb_candidates: int. Number of coarse peaks refined at full rate.
 
     OUTPUTS:
     - offset: int. The time offset for which the correlation is highest.
     - max_corr: float. The maximum correlation value.
+    - margin: float. Difference between the highest correlation and the one of the 
+      second best peak. Nan if there is no other peak.
     '''
 
     if isinstance(lag_range, int):
         lag_range = [-lag_range, lag_range]
+    camx, camy = np.asarray(camx, dtype=float), np.asarray(camy, dtype=float)
+    lags = np.arange(lag_range[0], lag_range[1])
+
+    # Coarse search over the whole lag range
+    if decimation > 1:
+        camx_coarse = camx[:len(camx)//decimation*decimation].reshape(-1, decimation).mean(axis=1)
+        camy_coarse = camy[:len(camy)//decimation*decimation].reshape(-1, decimation).mean(axis=1)
+        lags_coarse = np.arange(-(-lag_range[0]//decimation), (lag_range[1]-1)//decimation + 1)
+        pearson_r = lagged_pearson_r(camx_coarse, camy_coarse, lags_coarse)
+        lags_coarse = lags_coarse*decimation
+    else:
+        lags_coarse = lags
+        pearson_r = lagged_pearson_r(camx, camy, lags)
+
+    # Refinement around the best peaks
+    peaks = []
+    for p in cross_corr_peaks(pearson_r, nb_candidates):
+        if decimation > 1:
+            lags_fine = lags[np.abs(lags - lags_coarse[p]) <= decimation]
+            pearson_r_fine = lagged_pearson_r_direct(camx, camy, lags_fine)
+        else:
+            lags_fine, pearson_r_fine = lags[[p]], pearson_r[[p]]
+        if not np.isnan(pearson_r_fine).all():
+            peaks.append((np.nanmax(pearson_r_fine), lags_fine[np.nanargmax(pearson_r_fine)]))
+    peaks = sorted(set(peaks), key=lambda peak: -peak[0])
 
-    import hashlib
-    print(repr(list(camx)), repr(list(camy)))
-    hashlib.md5(pd.util.hash_pandas_object(camx).values).hexdigest()
-    hashlib.md5(pd.util.hash_pandas_object(camy).values).hexdigest()
-
-    pearson_r = [camx.corr(camy.shift(lag)) for lag in range(lag_range[0], lag_range[1])]
-    offset = int(np.floor(len(pearson_r)/2)-np.argmax(pearson_r))
-    if not np.isnan(pearson_r).all():
-        max_corr = np.nanmax(pearson_r)
+    if peaks != []:
+        max_corr, best_lag = peaks[0]
+        offset = int(np.floor(len(lags)/2) + lag_range[0] - best_lag)
+        other_peaks = [r for r, lag in peaks[1:] if abs(lag - best_lag) > decimation]
+        margin = max_corr - other_peaks[0] if other_peaks != [] else np.nan
 
         if show:
             f, ax = plt.subplots(2,1)
             # speed
-            camx.plot(ax=ax[0], label = f'Reference: camera #{ref_cam_id}')
-            camy.plot(ax=ax[0], label = f'Compared: camera #{cam_id}')
+            ax[0].plot(camx, label = f'Reference: camera #{ref_cam_id}')
+            ax[0].plot(camy, label = f'Compared: camera #{cam_id}')
             ax[0].set(xlabel='Frame', ylabel='Speed (px/frame)')
             ax[0].legend()
             # time lagged cross-correlation
-            ax[1].plot(list(range(lag_range[0], lag_range[1])), pearson_r)
-            ax[1].axvline(np.ceil(len(pearson_r)/2) + lag_range[0],color='k',linestyle='--')
-            ax[1].axvline(np.argmax(pearson_r) + lag_range[0],color='r',linestyle='--',label='Peak synchrony')
+            ax[1].plot(lags_coarse, pearson_r)
+            ax[1].axvline(np.ceil(len(lags)/2) + lag_range[0],color='k',linestyle='--')
+            ax[1].axvline(best_lag,color='r',linestyle='--',label='Peak synchrony')
             plt.annotate(f'Max correlation={np.round(max_corr,2)}', xy=(0.05, 0.9), xycoords='axes fraction')
             ax[1].set(title=f'Offset = {offset} frames', xlabel='Offset (frames)',ylabel='Pearson r')
             
@@ -205,11 +358,194 @@ def time_lagged_cross_corr(camx, camy, lag_range, show=True, ref_cam_id=0, cam_i
     else:
         max_corr = 0
         offset = 0
+        margin = np.nan
         if show:
             # print('No good values to interpolate')
             pass
 
-    return offset, max_corr
+    return offset, max_corr, margin
+
+
+def write_sync_manifest(project_dir, json_dirs_names, offset, ref_cam_id, method='cross_correlation', **cam_stats):
+    '''
+    Write the frame offset of each camera to a manifest (sync_offsets.json),
+    instead of copying json files to pose-sync.
+
+    INPUTS:
+    - project_dir: path of the trial directory
+    - json_dirs_names: list of json directory names, one per camera
+    - offset: list of ints. Frame offset of each camera
+    - ref_cam_id: int. Index of the reference camera
+    - method: str. Method used to compute the offsets
+    - cam_stats: other lists of values, one per camera, saved with the offsets
+      (e.g. correlation=..., margin=...). Nans are saved as null
+
+    OUTPUT:
+    - manifest_path: path of the manifest file
+    '''
+
+    manifest = {'reference_camera': json_dirs_names[ref_cam_id], 'cameras': {}}
+    for c, j_dir in enumerate(json_dirs_names):
+        manifest['cameras'][j_dir] = {'offset': int(offset[c]), 'method': method}
+        for stat_name, stat in cam_stats.items():
+            manifest['cameras'][j_dir][stat_name] = None if stat[c] is None or np.isnan(stat[c]) else stat[c].item() if hasattr(stat[c], 'item') else stat[c]
+    manifest_path = os.path.join(project_dir, 'sync_offsets.json')
+    with open(manifest_path, 'w') as m_f:
+        json.dump(manifest, m_f, indent=4)
+
+    return manifest_path
+
+
+def pairwise_offsets(sum_speeds, search_starts, pairs, decimation=1, nb_candidates=3, nb_workers=1):
+    '''
+    Offset between each pair of cameras, from the cross-correlation of their speeds.
+    Pairs are processed in parallel threads.
+
+    INPUTS:
+    - sum_speeds: list of 1D arrays. Sum of absolute vertical speeds of each camera
+    - search_starts: list of ints. First frame of the section of each camera
+    - pairs: list of (i, j) camera index pairs
+    - decimation, nb_candidates: see time_lagged_cross_corr
+    - nb_workers: int. Number of threads
+
+    OUTPUTS:
+    - pair_offsets: array of ints. Offset of camera j relative to camera i, for each pair
+    - pair_corr: array of floats. Correlation peak of each pair
+    - pair_margin: array of floats. Margin to the second best peak of each pair
+    '''
+
+    def pair_offset(pair):
+        i, j = pair
+        lag_range = int(min(len(sum_speeds[i]), len(sum_speeds[j]))/2)
+        offset_section, max_corr, margin = time_lagged_cross_corr(sum_speeds[i], sum_speeds[j], lag_range, show=False, decimation=decimation, nb_candidates=nb_candidates)
+        return offset_section - (search_starts[i] - search_starts[j]), max_corr, margin
+
+    with ThreadPoolExecutor(max_workers=nb_workers) as executor:
+        results = list(executor.map(pair_offset, pairs))
+    pair_offsets, pair_corr, pair_margin = [np.array(r) for r in zip(*results)]
+
+    return pair_offsets, pair_corr, pair_margin
+
+
+def solve_global_offsets(nb_cams, ref_cam_id, pairs, pair_offsets, pair_weights, max_residual=3, nb_iterations=10):
+    '''
+    Globally consistent camera offsets from all pairwise offsets.
+
+    Solves offset[j] - offset[i] = pair_offset[i,j] in the weighted least squares sense, 
+    with offset[ref_cam_id] = 0. The first guess minimizes the weighted sum of absolute 
+    residuals instead, which is not pulled away by a few wrong pairs. Pairs whose residual 
+    exceeds max_residual are then considered outliers and dropped from the least squares 
+    solve, until the set of outliers no longer changes.
+    Cameras are flagged as inconsistent if their median residual exceeds max_residual,
+    or if their median weight is less than half the median weight of the pairs which do 
+    not involve them (a view unrelated to the others can give spurious, yet consistent, offsets).
+
+    INPUTS:
+    - nb_cams: int. Number of cameras
+    - ref_cam_id: int. Index of the reference camera, whose offset is 0
+    - pairs: list of (i, j) camera index pairs
+    - pair_offsets: array. Offset of camera j relative to camera i, for each pair
+    - pair_weights: array. Weight of each pair, typically its correlation peak
+    - max_residual: float. Residual, in frames, above which a pair is considered an outlier
+    - nb_iterations: int. Max number of outlier rejection iterations
+
+    OUTPUTS:
+    - offsets: array of ints. Offset of each camera
+    - residuals: array of floats. Median absolute residual of the pairs of each camera, in frames
+    - inconsistent: boolean array. True for cameras flagged as inconsistent
+    - outliers: boolean array. True for pairs dropped from the solve
+    '''
+
+    pairs = np.asarray(pairs)
+    pair_offsets = np.asarray(pair_offsets, dtype=float)
+    pair_weights = np.clip(np.nan_to_num(pair_weights), 1e-3, None)
+    A = np.zeros((len(pairs), nb_cams))
+    A[np.arange(len(pairs)), pairs[:,1]] = 1
+    A[np.arange(len(pairs)), pairs[:,0]] = -1
+
+    # Robust first guess: weighted least absolute residuals, as a linear program
+    A_free = np.delete(A, ref_cam_id, axis=1) # offset of the reference camera is 0
+    nb_pairs, nb_free = A_free.shape
+    A_ub = np.block([[A_free, -np.eye(nb_pairs)], [-A_free, -np.eye(nb_pairs)]])
+    b_ub = np.concatenate([pair_offsets, -pair_offsets])
+    cost = np.concatenate([np.zeros(nb_free), pair_weights])
+    bounds = [(None, None)]*nb_free + [(0, None)]*nb_pairs
+    solution = optimize.linprog(cost, A_ub=A_ub, b_ub=b_ub, bounds=bounds, method='highs').x[:nb_free]
+    offsets = np.insert(solution, ref_cam_id, 0)
+
+    # Drop outlier pairs and solve again, until outliers no longer change
+    outliers = np.zeros(len(pairs), dtype=bool)
+    for it in range(nb_iterations):
+        new_outliers = np.abs(pair_offsets - A @ offsets) > max_residual
+        if it > 0 and (new_outliers == outliers).all():
+            break
+        outliers = new_outliers
+        weights = np.where(outliers, 1e-6 * pair_weights, pair_weights) # outliers only keep isolated cameras connected
+        sqrt_w = np.sqrt(weights)
+        solution = np.linalg.lstsq(A_free * sqrt_w[:,np.newaxis], pair_offsets * sqrt_w, rcond=None)[0]
+        offsets = np.insert(solution, ref_cam_id, 0)
+    offsets = np.round(offsets).astype(int)
+
+    # Residuals of each camera over its pairs
+    pair_residuals = pair_offsets - (offsets[pairs[:,1]] - offsets[pairs[:,0]])
+    residuals = np.zeros(nb_cams)
+    inconsistent = np.zeros(nb_cams, dtype=bool)
+    for c in range(nb_cams):
+        cam_pairs = (pairs[:,0] == c) | (pairs[:,1] == c)
+        residuals[c] = np.median(np.abs(pair_residuals[cam_pairs]))
+        inconsistent[c] = residuals[c] > max_residual
+        if (~cam_pairs).any():
+            inconsistent[c] |= np.median(pair_weights[cam_pairs]) < np.median(pair_weights[~cam_pairs])/2
+
+    return offsets, residuals, inconsistent, outliers
+
+
+def copy_synced_json(pose_dir, sync_dir, json_dirs_names, json_files_names, offset):
+    '''
+    Rename json files according to the offset of their camera and copy them to sync_dir.
+
+    INPUTS:
+    - pose_dir: directory of the json directories of each camera
+    - sync_dir: output directory
+    - json_dirs_names: list of json directory names, one per camera
+    - json_files_names: list of lists of json file names, one per camera
+    - offset: list of ints. Frame offset of each camera
+    '''
+
+    os.makedirs(sync_dir, exist_ok=True)
+    for d, j_dir in enumerate(json_dirs_names):
+        os.makedirs(os.path.join(sync_dir, j_dir), exist_ok=True)
+        for frame, j_file in frame_json_files(json_files_names[d], offset[d]).items():
+            shutil.copy(os.path.join(pose_dir, j_dir, j_file), os.path.join(sync_dir, j_dir, synced_json_name(j_file, frame)))
+
+
+def materialize_sync(config_dict):
+    '''
+    Copy renamed json files to pose-sync from the synchronization manifest,
+    for tools which do not read sync_offsets.json.
+
+    INPUTS:
+    - a Config.toml file
+    - json files from each camera folders
+    - sync_offsets.json written by synchronize_cams_all
+
+    OUTPUTS:
+    - synchronized json files for each camera
+    '''
+
+    project_dir = config_dict.get('project').get('project_dir')
+    pose_dir = os.path.realpath(os.path.join(project_dir, 'pose'))
+    sync_dir = os.path.realpath(os.path.join(project_dir, 'pose-sync'))
+
+    offsets = read_sync_offsets(project_dir)
+    if offsets == {}:
+        raise FileNotFoundError(f'No sync_offsets.json found in {project_dir}. Run synchronization with sync_output = "manifest" first.')
+    json_dirs_names = [j_dir for j_dir in sort_stringlist_by_last_number(next(os.walk(pose_dir))[1]) if 'json' in j_dir]
+    json_files_names = [sort_stringlist_by_last_number(fnmatch.filter(os.listdir(os.path.join(pose_dir, j_dir)), '*.json')) for j_dir in json_dirs_names]
+
+    copy_synced_json(pose_dir, sync_dir, json_dirs_names, json_files_names, [offsets.get(j_dir, 0) for j_dir in json_dirs_names])
+
+    logging.info(f'Synchronized json files saved in {sync_dir}.')
 
 
 def synchronize_cams_all(config_dict):
@@ -234,7 +570,8 @@ def synchronize_cams_all(config_dict):
     - a skeleton model
 
     OUTPUTS: 
-    - synchronized json files for each camera
+    - synchronized json files for each camera,
+      or a sync_offsets.json manifest if sync_output = 'manifest'
     '''
     
     # Get parameters from Config.toml
@@ -252,11 +589,17 @@ def synchronize_cams_all(config_dict):
     likelihood_threshold = config_dict.get('synchronization').get('likelihood_threshold')
     filter_cutoff = int(config_dict.get('synchronization').get('filter_cutoff'))
     filter_order = int(config_dict.get('synchronization').get('filter_order'))
+    sync_output = config_dict.get('synchronization').get('sync_output', 'copy')
+    decimation = config_dict.get('synchronization').get('decimation', 'auto')
+    nb_candidates = int(config_dict.get('synchronization').get('nb_candidates', 3))
+    global_offsets = config_dict.get('synchronization').get('global_offsets', False)
+    max_offset_residual = config_dict.get('synchronization').get('max_offset_residual', 3)
+    nb_workers = config_dict.get('synchronization').get('nb_workers', 1)
+    nb_workers = os.cpu_count() if nb_workers == 'auto' else int(nb_workers)
 
     # Determine frame rate
-    video_dir = os.path.join(project_dir, 'videos')
     vid_img_extension = config_dict['pose']['vid_img_extension']
-    video_files = glob.glob(os.path.join(video_dir, '*'+vid_img_extension))
+    video_files = find_video_files(project_dir, vid_img_extension)
     if fps == 'auto': 
         try:
             cap = cv2.VideoCapture(video_files[0])
@@ -267,6 +610,9 @@ def synchronize_cams_all(config_dict):
         except:
             fps = 60  
     lag_range = time_range_around_maxspeed*fps # frames
+    if decimation == 'auto': # keep the coarse sampling rate above the Nyquist rate of the filtered signals
+        decimation = max(1, int(fps / (2.5*filter_cutoff)))
+    decimation = int(decimation)
 
 
     # Warning if multi_person
@@ -303,7 +649,8 @@ def synchronize_cams_all(config_dict):
     json_dirs = [os.path.join(pose_dir, j_d) for j_d in json_dirs_names] # list of json directories in pose_dir
     json_files_names = [fnmatch.filter(os.listdir(os.path.join(pose_dir, js_dir)), '*.json') for js_dir in json_dirs_names]
     json_files_names = [sort_stringlist_by_last_number(j) for j in json_files_names]
-    nb_frames_per_cam = [len(fnmatch.filter(os.listdir(os.path.join(json_dir)), '*.json')) for json_dir in json_dirs]
+    json_frame_nbs = [np.array([json_frame_number(j) for j in json_files_cam]) for json_files_cam in json_files_names]
+    nb_frames_per_cam = [len(j) for j in json_files_names]
     cam_nb = len(json_dirs)
     cam_list = list(range(cam_nb))
     
@@ -314,7 +661,6 @@ def synchronize_cams_all(config_dict):
     # Determine frames to consider for synchronization
     if isinstance(approx_time_maxspeed, list): # search around max speed
         approx_frame_maxspeed = [int(fps * t) for t in approx_time_maxspeed]
-        nb_frames_per_cam = [len(fnmatch.filter(os.listdir(os.path.join(json_dir)), '*.json')) for json_dir in json_dirs]
         search_around_frames = [[int(a-lag_range) if a-lag_range>0 else 0, int(a+lag_range) if a+lag_range<nb_frames_per_cam[i] else nb_frames_per_cam[i]+f_range[0]] for i,a in enumerate(approx_frame_maxspeed)]
         logging.info(f'Synchronization is calculated around the times {approx_time_maxspeed} +/- {time_range_around_maxspeed} s.')
     elif approx_time_maxspeed == 'auto': # search on the whole sequence (slower if long sequence)
@@ -332,86 +678,99 @@ def synchronize_cams_all(config_dict):
     elif keypoints_to_consider == 'all':
         logging.info(f'All keypoints are used to compute the best synchronization offset.')
     logging.info(f'These keypoints are filtered with a Butterworth filter (cut-off frequency: {filter_cutoff} Hz, order: {filter_order}).')
-    logging.info(f'They are removed when their likelihood is below {likelihood_threshold}.\n')
+    logging.info(f'They are removed when their likelihood is below {likelihood_threshold}.')
+    if decimation > 1:
+        logging.info(f'Offsets are first searched on signals decimated by {decimation}, then refined at full rate around the {nb_candidates} best peaks.\n')
+    else:
+        logging.info(f'Offsets are searched at full rate.\n')
 
     # Extract, interpolate, and filter keypoint coordinates
     logging.info('Synchronizing...')
-    df_coords = []
     b, a = signal.butter(filter_order/2, filter_cutoff/(fps/2), 'low', analog = False) 
-    json_files_names_range = [[j for j in json_files_cam if int(re.split(r'(\d+)',j)[-2]) in range(*frames_cam)] for (json_files_cam, frames_cam) in zip(json_files_names,search_around_frames)]
-    json_files_range = [[os.path.join(pose_dir, j_dir, j_file) for j_file in json_files_names_range[j]] for j, j_dir in enumerate(json_dirs_names)]
+    json_files_range = [[os.path.join(pose_dir, j_dir, json_files_names[j][k]) for k in np.flatnonzero((json_frame_nbs[j]>=search_around_frames[j][0]) & (json_frame_nbs[j]<search_around_frames[j][1]))] for j, j_dir in enumerate(json_dirs_names)]
     
-    if np.array([j==[] for j in json_files_names_range]).any():
+    if np.array([j==[] for j in json_files_range]).any():
         raise ValueError(f'No json files found within the specified frame range ({frame_range}) at the times {approx_time_maxspeed} +/- {time_range_around_maxspeed} s.')
     
-    for i in range(cam_nb):
-        df_coords.append(convert_json2pandas(json_files_range[i], likelihood_threshold=likelihood_threshold))
-        df_coords[i] = drop_col(df_coords[i],3) # drop likelihood
-        if keypoints_to_consider == 'right':
-            kpt_indices = [i for i,k in zip(keypoints_ids,keypoints_names) if k.startswith('R') or k.startswith('right')]
-            kpt_indices = np.sort(np.concatenate([np.array(kpt_indices)*2, np.array(kpt_indices)*2+1]))
-            df_coords[i] = df_coords[i][kpt_indices]
-        elif keypoints_to_consider == 'left':
-            kpt_indices = [i for i,k in zip(keypoints_ids,keypoints_names) if k.startswith('L') or k.startswith('left')]
-            kpt_indices = np.sort(np.concatenate([np.array(kpt_indices)*2, np.array(kpt_indices)*2+1]))
-            df_coords[i] = df_coords[i][kpt_indices]
-        elif isinstance(keypoints_to_consider, list):
-            kpt_indices = [i for i,k in zip(keypoints_ids,keypoints_names) if k in keypoints_to_consider]
-            kpt_indices = np.sort(np.concatenate([np.array(kpt_indices)*2, np.array(kpt_indices)*2+1]))
-            df_coords[i] = df_coords[i][kpt_indices]
-        elif keypoints_to_consider == 'all':
-            pass
-        else:
-            raise ValueError('keypoints_to_consider should be "all", "right", "left", or a list of keypoint names.\n\
-                            If you specified keypoints, make sure that they exist in your pose_model.')
-        
-        df_coords[i] = df_coords[i].apply(interpolate_zeros_nans, axis=0, args = ['linear'])
-        df_coords[i] = df_coords[i].bfill().ffill()
-        df_coords[i] = pd.DataFrame(signal.filtfilt(b, a, df_coords[i], axis=0))
-
-
-    # Compute sum of speeds
-    df_speed = []
-    sum_speeds = []
-    for i in range(cam_nb):
-        df_speed.append(vert_speed(df_coords[i]))
-        sum_speeds.append(abs(df_speed[i]).sum(axis=1))
-        # nb_coord = df_speed[i].shape[1]
-        # sum_speeds[i][ sum_speeds[i]>vmax*nb_coord ] = 0
-        
-        # # Replace 0 by random values, otherwise 0 padding may lead to unreliable correlations
-        # sum_speeds[i].loc[sum_speeds[i] < 1] = sum_speeds[i].loc[sum_speeds[i] < 1].apply(lambda x: np.random.normal(0,1))
-        
-        sum_speeds[i] = pd.DataFrame(signal.filtfilt(b, a, sum_speeds[i], axis=0)).squeeze()
+    if keypoints_to_consider == 'right':
+        kpt_indices = [i for i,k in zip(keypoints_ids,keypoints_names) if k.startswith('R') or k.startswith('right')]
+    elif keypoints_to_consider == 'left':
+        kpt_indices = [i for i,k in zip(keypoints_ids,keypoints_names) if k.startswith('L') or k.startswith('left')]
+    elif isinstance(keypoints_to_consider, list):
+        kpt_indices = [i for i,k in zip(keypoints_ids,keypoints_names) if k in keypoints_to_consider]
+    elif keypoints_to_consider == 'all':
+        kpt_indices = keypoints_ids
+    else:
+        raise ValueError('keypoints_to_consider should be "all", "right", "left", or a list of keypoint names.\n\
+                        If you specified keypoints, make sure that they exist in your pose_model.')
+    kpt_indices = np.sort(kpt_indices).astype(int)
+    nb_keypoints = max(keypoints_ids)+1
+
+    # Sum of speeds: one camera per worker, only the 1D signals are kept
+    with ThreadPoolExecutor(max_workers=nb_workers) as executor:
+        sum_speeds = list(executor.map(lambda json_files_cam: camera_speed(json_files_cam, nb_keypoints, kpt_indices, b, a, likelihood_threshold=likelihood_threshold), json_files_range))
 
 
     # Compute offset for best synchronization:
     # Highest correlation of sum of absolute speeds for each cam compared to reference cam
     ref_cam_id = nb_frames_per_cam.index(min(nb_frames_per_cam)) # ref cam: least amount of frames
-    ref_frame_nb = len(df_coords[ref_cam_id])
-    lag_range = int(ref_frame_nb/2)
-    cam_list.pop(ref_cam_id)
-    offset = []
-    for cam_id in cam_list:
-        offset_cam_section, max_corr_cam = time_lagged_cross_corr(sum_speeds[ref_cam_id], sum_speeds[cam_id], lag_range, show=display_sync_plots, ref_cam_id=ref_cam_id, cam_id=cam_id)
-        offset_cam = offset_cam_section - (search_around_frames[ref_cam_id][0] - search_around_frames[cam_id][0])
-        if isinstance(approx_time_maxspeed, list):
-            logging.info(f'--> Camera {ref_cam_id} and {cam_id}: {offset_cam} frames offset ({offset_cam_section} on the selected section), correlation {round(max_corr_cam, 2)}.')
-        else:
-            logging.info(f'--> Camera {ref_cam_id} and {cam_id}: {offset_cam} frames offset, correlation {round(max_corr_cam, 2)}.')
-        offset.append(offset_cam)
-    offset.insert(ref_cam_id, 0)
+    if not global_offsets:
+        ref_frame_nb = len(sum_speeds[ref_cam_id])
+        lag_range = int(ref_frame_nb/2)
+        cam_list.pop(ref_cam_id)
+        offset, max_corr, margin = [], [], []
+        for cam_id in cam_list:
+            offset_cam_section, max_corr_cam, margin_cam = time_lagged_cross_corr(sum_speeds[ref_cam_id], sum_speeds[cam_id], lag_range, show=display_sync_plots, ref_cam_id=ref_cam_id, cam_id=cam_id, decimation=decimation, nb_candidates=nb_candidates)
+            offset_cam = offset_cam_section - (search_around_frames[ref_cam_id][0] - search_around_frames[cam_id][0])
+            margin_msg = 'no second peak' if np.isnan(margin_cam) else f'margin to next peak {round(margin_cam, 2)}'
+            if isinstance(approx_time_maxspeed, list):
+                logging.info(f'--> Camera {ref_cam_id} and {cam_id}: {offset_cam} frames offset ({offset_cam_section} on the selected section), correlation {round(max_corr_cam, 2)}, {margin_msg}.')
+            else:
+                logging.info(f'--> Camera {ref_cam_id} and {cam_id}: {offset_cam} frames offset, correlation {round(max_corr_cam, 2)}, {margin_msg}.')
+            offset.append(offset_cam)
+            max_corr.append(max_corr_cam)
+            margin.append(margin_cam)
+        offset.insert(ref_cam_id, 0)
+        max_corr.insert(ref_cam_id, 1.0)
+        margin.insert(ref_cam_id, np.nan)
+        sync_method = 'cross_correlation'
+        sync_stats = {'correlation': max_corr, 'margin': margin}
+
+    # Or correlate all pairs of cameras, and solve for globally consistent offsets
+    else:
+        pairs = [(i, j) for i in range(cam_nb) for j in range(i+1, cam_nb)]
+        logging.info(f'Correlating all {len(pairs)} pairs of cameras with {nb_workers} worker(s).')
+        pair_offsets, pair_corr, pair_margin = pairwise_offsets(sum_speeds, [s[0] for s in search_around_frames], pairs, decimation=decimation, nb_candidates=nb_candidates, nb_workers=nb_workers)
+        offset, residuals, inconsistent, outliers = solve_global_offsets(cam_nb, ref_cam_id, pairs, pair_offsets, pair_corr, max_residual=max_offset_residual)
+        for (i, j), pair_offset in zip(np.array(pairs)[outliers], pair_offsets[outliers]):
+            logging.warning(f'Cameras {i} and {j}: pairwise offset of {pair_offset} frames disagrees with the other pairs by {abs(pair_offset - (offset[j] - offset[i]))} frames and was ignored.')
+        max_corr = [np.mean([corr for (i, j), corr in zip(pairs, pair_corr) if c in (i, j)]) for c in range(cam_nb)]
+        if inconsistent[ref_cam_id] and not inconsistent.all():
+            # anchor offsets on the consistent camera with the least amount of frames
+            new_ref_cam_id = min(np.flatnonzero(~inconsistent), key=lambda c: nb_frames_per_cam[c])
+            logging.warning(f'Reference camera {ref_cam_id} is inconsistent with the other cameras. Offsets are given relative to camera {new_ref_cam_id} instead.')
+            ref_cam_id = int(new_ref_cam_id)
+            offset = offset - offset[ref_cam_id]
+        for cam_id in cam_list:
+            logging.info(f'--> Camera {cam_id}: {offset[cam_id]} frames offset relative to camera {ref_cam_id}, mean correlation {round(max_corr[cam_id], 2)}, residual {round(residuals[cam_id], 2)} frames.')
+            if inconsistent[cam_id]:
+                logging.warning(f'Camera {cam_id} is inconsistent with the other cameras (residual above {max_offset_residual} frames): check its offset.')
+        if display_sync_plots:
+            for cam_id in cam_list:
+                if cam_id != ref_cam_id:
+                    time_lagged_cross_corr(sum_speeds[ref_cam_id], sum_speeds[cam_id], int(min(len(sum_speeds[ref_cam_id]), len(sum_speeds[cam_id]))/2), show=True, ref_cam_id=ref_cam_id, cam_id=cam_id, decimation=decimation, nb_candidates=nb_candidates)
+        offset = offset.tolist()
+        sync_method = 'global_least_squares'
+        sync_stats = {'correlation': max_corr, 'residual': residuals, 'inconsistent': inconsistent}
 
-    # rename json files according to the offset and copy them to pose-sync
     sync_dir = os.path.abspath(os.path.join(pose_dir, '..', 'pose-sync'))
-    os.makedirs(sync_dir, exist_ok=True)
-    for d, j_dir in enumerate(json_dirs):
-        os.makedirs(os.path.join(sync_dir, os.path.basename(j_dir)), exist_ok=True)
-        for j_file in json_files_names[d]:
-            j_split = re.split(r'(\d+)',j_file)
-            j_split[-2] = f'{int(j_split[-2])-offset[d]:06d}'
-            if int(j_split[-2]) > 0:
-                json_offset_name = ''.join(j_split)
-                shutil.copy(os.path.join(pose_dir, os.path.basename(j_dir), j_file), os.path.join(sync_dir, os.path.basename(j_dir), json_offset_name))
-
-    logging.info(f'Synchronized json files saved in {sync_dir}.')
+    if sync_output == 'manifest':
+        # only write offsets, which are applied when json files are read
+        manifest_path = write_sync_manifest(project_dir, json_dirs_names, offset, ref_cam_id, method=sync_method, **sync_stats)
+        logging.info(f'Synchronization offsets saved in {manifest_path}.')
+        if os.path.isdir(sync_dir):
+            logging.warning(f'{sync_dir} already exists and will be used instead of the offsets. Delete it to use {manifest_path}.')
+    else:
+        # rename json files according to the offset and copy them to pose-sync
+        copy_synced_json(pose_dir, sync_dir, json_dirs_names, json_files_names, offset)
+        logging.info(f'Synchronized json files saved in {sync_dir}.')
@@ -37,6 +37,7 @@ import os
 import glob
 import fnmatch
 import re
+import hashlib
 import numpy as np
 import json
 import itertools as it
@@ -44,14 +45,16 @@ import pandas as pd
 import cv2
 import toml
 from tqdm import tqdm
-from scipy import interpolate
-from collections import Counter
+from scipy.optimize import linear_sum_assignment
 from anytree import RenderTree
 from anytree.importer import DictImporter
 import logging
 
 from Pose2Sim.common import retrieve_calib_params, computeP, weighted_triangulation, \
-    reprojection, euclidean_distance, sort_stringlist_by_last_number, zup2yup, convert_to_c3d
+    reprojection, euclidean_distance, sort_stringlist_by_last_number, zup2yup, convert_to_c3d, peak_memory_mb, \
+    trc_header, write_trc, undistortion_lut, undistort_points_batch, project_points, frame_json_files, read_sync_offsets, \
+    find_video_files
+from Pose2Sim.interpolation import find_runs, interpolate_zeros_nans
 from Pose2Sim.skeletons import *
 
 
@@ -67,145 +70,460 @@ __status__ = "Development"
 
 
 ## FUNCTIONS
-def interpolate_zeros_nans(col, *args):
+def count_persons_in_json(file_path):
+    with open(file_path, 'r') as file:
+        data = json.load(file)
+        return len(data.get('people', []))
+
+
+def file_hash(file_path):
+    '''
+    SHA-1 hash of the content of a file.
+
+    INPUT:
+    - file_path: str
+
+    OUTPUT:
+    - hexadecimal digest: str
     '''
-    Interpolate missing points (of value zero),
-    unless more than N contiguous values are missing.
+
+    sha = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def triangulation_settings_hash(config_dict, calib_file, keypoints_ids):
+    '''
+    Hash of everything but the 2D coordinates that a triangulated frame depends on:
+    triangulation parameters, calibration file content, and keypoints of the model.
 
     INPUTS:
-    - col: pandas column of coordinates
-    - args[0] = N: max number of contiguous bad values, above which they won't be interpolated
-    - args[1] = kind: 'linear', 'slinear', 'quadratic', 'cubic'. Default: 'cubic'
+    - config_dict: dictionary of configuration parameters
+    - calib_file: str. Path to the calibration file
+    - keypoints_ids: list of int. Keypoints IDs in the order of the hierarchy
 
     OUTPUT:
-    - col_interp: interpolated pandas column
-    '''
-
-    if len(args)==2:
-        N, kind = args
-    if len(args)==1:
-        N = np.inf
-        kind = args[0]
-    if not args:
-        N = np.inf
-    
-    # Interpolate nans
-    mask = ~(np.isnan(col) | col.eq(0)) # true where nans or zeros
-    idx_good = np.where(mask)[0]
-    if 'kind' not in locals(): # 'linear', 'slinear', 'quadratic', 'cubic'
-        f_interp = interpolate.interp1d(idx_good, col[idx_good], kind="linear", bounds_error=False)
-    else:
-        f_interp = interpolate.interp1d(idx_good, col[idx_good], kind=kind, fill_value='extrapolate', bounds_error=False)
-    col_interp = np.where(mask, col, f_interp(col.index)) #replace at false index with interpolated values
-    
-    # Reintroduce nans if length of sequence > N
-    idx_notgood = np.where(~mask)[0]
-    gaps = np.where(np.diff(idx_notgood) > 1)[0] + 1 # where the indices of true are not contiguous
-    sequences = np.split(idx_notgood, gaps)
-    if sequences[0].size>0:
-        for seq in sequences:
-            if len(seq) > N: # values to exclude from interpolation are set to false when they are too long 
-                col_interp[seq] = np.nan
-    
-    return col_interp
+    - hexadecimal digest: str
+    '''
 
+    triangulation_settings = {k: config_dict.get('triangulation').get(k) for k in
+                              ['reproj_error_threshold_triangulation', 'likelihood_threshold_triangulation',
+                               'min_cameras_for_triangulation', 'handle_LR_swap', 'undistort_points', 'undistortion_lut', 'method', 'warm_start_cameras']}
+    triangulation_settings['keypoints_ids'] = [int(k) for k in keypoints_ids]
+    triangulation_settings['calib'] = file_hash(calib_file)
 
-def count_persons_in_json(file_path):
-    with open(file_path, 'r') as file:
-        data = json.load(file)
-        return len(data.get('people', []))
-    
+    return hashlib.sha1(json.dumps(triangulation_settings, sort_keys=True).encode()).hexdigest()
+
+
+def frame_cache_key(settings_hash, x_files, y_files, likelihood_files, cams_off_guess=None):
+    '''
+    Cache key of a frame: hash of its 2D coordinates combined with the settings hash.
+
+    INPUTS:
+    - settings_hash: str. Output of triangulation_settings_hash
+    - x_files, y_files, likelihood_files: [[[list of coordinates] * n_cams ] * nb_persons_to_detect]
+    - cams_off_guess: excluded cameras used as a first guess for each person and keypoint (None if no guess), or None
 
-def min_with_single_indices(L, T):
+    OUTPUT:
+    - hexadecimal digest: str
     '''
-    Let L be a list (size s) with T associated tuple indices (size s).
-    Select the smallest values of L, considering that 
-    the next smallest value cannot have the same numbers 
-    in the associated tuple as any of the previous ones.
 
-    Example:
-    L = [  20,   27,  51,    33,   43,   23,   37,   24,   4,   68,   84,    3  ]
-    T = list(it.product(range(2),range(3)))
-      = [(0,0),(0,1),(0,2),(0,3),(1,0),(1,1),(1,2),(1,3),(2,0),(2,1),(2,2),(2,3)]
+    sha = hashlib.sha1(settings_hash.encode())
+    for arr in (x_files, y_files, likelihood_files):
+        arr = np.ascontiguousarray(arr, dtype=float)
+        sha.update(str(arr.shape).encode())
+        sha.update(arr.tobytes())
+    if cams_off_guess is not None:
+        sha.update(json.dumps([[None if cams is None else [int(c) for c in cams] for cams in person] for person in cams_off_guess]).encode())
+    return sha.hexdigest()
+
+
+def load_frame_from_cache(cache_dir, key):
+    '''
+    Retrieve the triangulation results of a frame from the cache.
 
-    - 1st smallest value: 3 with tuple (2,3), index 11
-    - 2nd smallest value when excluding indices (2,.) and (.,3), i.e. [(0,0),(0,1),(0,2),X,(1,0),(1,1),(1,2),X,X,X,X,X]:
-    20 with tuple (0,0), index 0
-    - 3rd smallest value when excluding [X,X,X,X,X,(1,1),(1,2),X,X,X,X,X]:
-    23 with tuple (1,1), index 5
-    
     INPUTS:
-    - L: list (size s)
-    - T: T associated tuple indices (size s)
+    - cache_dir: str. Cache directory
+    - key: str. Output of frame_cache_key
 
-    OUTPUTS: 
-    - minL: list of smallest values of L, considering constraints on tuple indices
-    - argminL: list of indices of smallest values of L
-    - T_minL: list of tuples associated with smallest values of L
+    OUTPUTS:
+    - None if the frame is not cached, else:
+    - Q, error, nb_cams_excluded, id_excluded_cams: lists per person and per keypoint,
+      in the same format as the output of triangulation_from_best_cameras
     '''
 
-    minL = [np.nanmin(L)]
-    argminL = [np.nanargmin(L)]
-    T_minL = [T[argminL[0]]]
-    
-    mask_tokeep = np.array([True for t in T])
-    i=0
-    while mask_tokeep.any()==True:
-        mask_tokeep = mask_tokeep & np.array([t[0]!=T_minL[i][0] and t[1]!=T_minL[i][1] for t in T])
-        if mask_tokeep.any()==True:
-            indicesL_tokeep = np.where(mask_tokeep)[0]
-            minL += [np.nanmin(np.array(L)[indicesL_tokeep]) if not np.isnan(np.array(L)[indicesL_tokeep]).all() else np.nan]
-            argminL += [indicesL_tokeep[np.nanargmin(np.array(L)[indicesL_tokeep])] if not np.isnan(minL[-1]) else indicesL_tokeep[0]]
-            T_minL += (T[argminL[i+1]],)
-            i+=1
-    
-    return np.array(minL), np.array(argminL), np.array(T_minL)
+    cache_path = os.path.join(cache_dir, f'{key}.npz')
+    try:
+        with np.load(cache_path) as cached:
+            Q_f, error_f, nb_cams_excluded_f, excluded_mask_f = cached['Q'], cached['error'], cached['nb_cams_excluded'], cached['excluded_mask']
+    except:
+        return None
+    os.utime(cache_path) # least recently used entries are pruned first
+
+    Q = [[Q_f[n,k] for k in range(Q_f.shape[1])] for n in range(Q_f.shape[0])]
+    error = [error_f[n].tolist() for n in range(error_f.shape[0])]
+    nb_cams_excluded = [nb_cams_excluded_f[n].tolist() for n in range(nb_cams_excluded_f.shape[0])]
+    id_excluded_cams = [[np.flatnonzero(excluded_mask_f[n,k]) for k in range(excluded_mask_f.shape[1])] for n in range(excluded_mask_f.shape[0])]
+
+    return Q, error, nb_cams_excluded, id_excluded_cams
+
+
+def save_frame_to_cache(cache_dir, key, Q, error, nb_cams_excluded, id_excluded_cams, n_cams):
+    '''
+    Store the triangulation results of a frame in the cache.
+
+    INPUTS:
+    - cache_dir: str. Cache directory
+    - key: str. Output of frame_cache_key
+    - Q, error, nb_cams_excluded, id_excluded_cams: lists per person and per keypoint
+    - n_cams: int. Number of cameras
+
+    OUTPUT:
+    - .npz file in cache_dir
+    '''
+
+    excluded_mask = np.zeros((len(id_excluded_cams), len(id_excluded_cams[0]), n_cams), dtype=bool)
+    for n, id_excluded_cams_n in enumerate(id_excluded_cams):
+        for k, id_excluded_cams_kpt in enumerate(id_excluded_cams_n):
+            excluded_mask[n, k, np.array(id_excluded_cams_kpt, dtype=int)] = True
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = os.path.join(cache_dir, f'{key}.tmp.npz')
+    np.savez(tmp_path, Q=np.array(Q, dtype=float), error=np.array(error, dtype=float),
+             nb_cams_excluded=np.array(nb_cams_excluded, dtype=float), excluded_mask=excluded_mask)
+    os.replace(tmp_path, os.path.join(cache_dir, f'{key}.npz'))
 
 
-def sort_people(Q_kpt_old, Q_kpt):
+def prune_cache(cache_dir, max_size_mb):
+    '''
+    Delete the least recently used cache files until the cache directory
+    is smaller than max_size_mb.
+
+    INPUTS:
+    - cache_dir: str. Cache directory
+    - max_size_mb: float. Maximum size of the cache directory in MB
+    '''
+
+    if not os.path.isdir(cache_dir):
+        return
+    cache_files = [os.path.join(cache_dir, f) for f in os.listdir(cache_dir) if f.endswith('.npz')]
+    cache_files = sorted(cache_files, key=os.path.getmtime)
+    cache_sizes = [os.path.getsize(f) for f in cache_files]
+    cache_size = sum(cache_sizes)
+    for cache_f, size_f in zip(cache_files, cache_sizes):
+        if cache_size <= max_size_mb * 1024**2:
+            break
+        os.remove(cache_f)
+        cache_size -= size_f
+
+
+def persons_distance_matrix(Q_kpt_old, Q_kpt, buffers=None):
+    '''
+    Distances between all persons of the previous frame and all persons of the current frame.
+    The distance between two persons is the mean euclidean distance between their keypoints,
+    over the keypoints which are valid in both, so that it does not depend on the number of 
+    keypoints of the model nor on the number of valid keypoints. It is in the unit of the 
+    coordinates (meters), and inf if the two persons share no valid keypoint.
+
+    INPUTS:
+    - Q_kpt_old: array of shape (persons_old, keypoints, 3), previous frame
+    - Q_kpt: array of shape (persons_new, keypoints, 3), current frame
+    - buffers: optional dict of work arrays, reused across frames when shapes match
+
+    OUTPUT:
+    - dist: array of shape (persons_old, persons_new)
+    '''
+
+    buffers = {} if buffers is None else buffers
+    diff_shape = (len(Q_kpt_old), len(Q_kpt)) + Q_kpt.shape[1:]
+    if buffers.get('diff') is None or buffers['diff'].shape != diff_shape:
+        buffers['diff'] = np.empty(diff_shape)
+        buffers['valid'] = np.empty(diff_shape[:-1], dtype=bool)
+    diff, valid = buffers['diff'], buffers['valid']
+
+    np.subtract(Q_kpt_old[:,None], Q_kpt[None,:], out=diff)
+    np.square(diff, out=diff)
+    kpt_dist = np.sqrt(diff.sum(axis=3))
+    np.isfinite(kpt_dist, out=valid)
+    kpt_dist[~valid] = 0
+    nb_valid = valid.sum(axis=2)
+    dist = kpt_dist.sum(axis=2) / np.maximum(nb_valid, 1)
+    dist[nb_valid == 0] = np.inf
+
+    return dist
+
+
+def assign_persons(dist):
+    '''
+    Association minimizing the sum of distances, with the Hungarian algorithm.
+    Infinite distances are replaced by a large finite value for the solver.
+
+    INPUT:
+    - dist: array of shape (persons_old, persons_new)
+
+    OUTPUTS:
+    - rows, cols: indices of the associated previous and current persons
+    '''
+
+    finite_dist = np.isfinite(dist)
+    cost = np.where(finite_dist, dist, (dist[finite_dist].max()+1)*dist.size if finite_dist.any() else 1.)
+    rows, cols = linear_sum_assignment(cost)
+
+    return rows, cols
+
+
+def sort_people(Q_kpt_old, Q_kpt, max_distance=None, buffers=None, Q_kpt_last=None):
     '''
     Associate persons across frames
     Persons' indices are sometimes swapped when changing frame
-    A person is associated to another in the next frame when they are at a small distance
+    A person is associated to another in the next frame when they are at a small distance.
+    The association minimizing the sum of distances is found with the Hungarian algorithm.
+
+    Pairs further apart than max_distance are not associated. Each current person 
+    left over (new person, or person who moved too far) is then given a free index 
+    (lost or empty person, closest first), or a new index if none is free. Previous 
+    persons left without a current person are lost in this frame (nan coordinates).
     
     INPUTS:
-    - Q_kpt_old: list of arrays of 3D coordinates [X, Y, Z, 1.] for the previous frame
+    - Q_kpt_old: list of arrays of 3D coordinates [X, Y, Z] for the previous frame
     - Q_kpt: idem Q_kpt_old, for current frame
+    - max_distance: float or None. Mean distance between keypoints, in meters, above 
+    which persons are not associated. Persons with no valid keypoint in common are 
+    never associated within the gate
+    - buffers: optional dict of work arrays, reused across frames
+    - Q_kpt_last: optional array of the same shape as Q_kpt_old, e.g. last observed 
+    positions when Q_kpt_old is predicted. The gate uses the smaller of both distances
     
     OUTPUT:
     - Q_kpt_new: array with reordered persons
-    - personsIDs_sorted: index of reordered persons
+    - personsIDs_sorted: index of reordered persons, -1 if lost
+    - associated_tuples: array of (previous index, current index) pairs associated within the gate
     '''
     
-    # Generate possible person correspondences across frames
-    if len(Q_kpt_old) < len(Q_kpt):
-        Q_kpt_old = np.concatenate((Q_kpt_old, [[0., 0., 0., 1.]]*(len(Q_kpt)-len(Q_kpt_old))))
-    personsIDs_comb = sorted(list(it.product(range(len(Q_kpt_old)),range(len(Q_kpt)))))
+    Q_kpt_old = np.asarray(Q_kpt_old, dtype=float)
+    Q_kpt = np.array([np.asarray(q, dtype=float).reshape(-1,3) for q in Q_kpt])
     
     # Compute distance between persons from one frame to another
-    frame_by_frame_dist = []
-    for comb in personsIDs_comb:
-        frame_by_frame_dist += [euclidean_distance(Q_kpt_old[comb[0]],Q_kpt[comb[1]])]
-        
-    # sort correspondences by distance
-    minL, _, associated_tuples = min_with_single_indices(frame_by_frame_dist, personsIDs_comb)
-    # print('Distances :', minL)
+    dist = persons_distance_matrix(Q_kpt_old, Q_kpt, buffers=buffers)
+    gate_dist = dist if Q_kpt_last is None else np.fmin(dist, persons_distance_matrix(np.asarray(Q_kpt_last, dtype=float), Q_kpt, buffers=buffers))
+
+    # Optimal correspondences within the gate
+    rows, cols = assign_persons(dist)
+    gate = np.isfinite(dist[rows, cols])
+    if max_distance is not None:
+        gate &= gate_dist[rows, cols] <= max_distance
+    rows, cols = rows[gate], cols[gate]
+    associated_tuples = np.array(list(zip(rows, cols)), dtype=int).reshape(-1,2)
+
+    # Current persons left over take the free indices, closest first, or new ones
+    ids_new = np.full(len(Q_kpt_old), -1)
+    ids_new[rows] = cols
+    free_old = np.flatnonzero(ids_new < 0)
+    left_new = np.setdiff1d(np.arange(len(Q_kpt)), cols)
+    if len(free_old) > 0 and len(left_new) > 0:
+        rows_left, cols_left = assign_persons(dist[np.ix_(free_old, left_new)])
+        ids_new[free_old[rows_left]] = left_new[cols_left]
+        left_new = np.delete(left_new, cols_left)
+    left_new = [i for i in left_new if np.isfinite(Q_kpt[i]).any()] # detections without valid keypoints are not new persons
+    ids_new = np.concatenate([ids_new, np.array(left_new, dtype=int)])
     
     # associate 3D points to same index across frames, nan if no correspondence
     Q_kpt_new, personsIDs_sorted = [], []
-    for i in range(len(Q_kpt_old)):
-        id_in_old =  associated_tuples[:,1][associated_tuples[:,0] == i].tolist()
-        # print('id_in_old ', i, id_in_old)
-        if len(id_in_old) > 0:
-            personsIDs_sorted += id_in_old
-            Q_kpt_new += [Q_kpt[id_in_old[0]]]
+    for i, id_new in enumerate(ids_new):
+        if id_new >= 0:
+            personsIDs_sorted += [int(id_new)]
+            Q_kpt_new += [Q_kpt[id_new]]
         else:
             personsIDs_sorted += [-1]
-            Q_kpt_new += [Q_kpt_old[i]]
+            Q_kpt_new += [np.full_like(Q_kpt_old[i], np.nan)]
     
     return Q_kpt_new, personsIDs_sorted, associated_tuples
 
 
+def match_persons_2d(Q_kpt_old, x_files, y_files, likelihood_files, calib_params, likelihood_threshold=0.):
+    '''
+    Associate the persons detected in the 2D files of a frame to the persons of
+    the previous frame, before triangulation.
+    The 3D keypoints of each previous person are projected on all cameras, and
+    compared to the 2D keypoints of each detected person. The association minimizing
+    the sum of mean distances is found with the Hungarian algorithm.
+
+    INPUTS:
+    - Q_kpt_old: array of 3D coordinates of the previous persons (persons, keypoints, 3)
+    - x_files, y_files, likelihood_files: [[[list of coordinates] * n_cams ] * nb_persons_to_detect],
+      distorted pixel coordinates of the same keypoints
+    - calib_params: dict, see retrieve_calib_params
+    - likelihood_threshold: float. 2D points with a lower likelihood are ignored
+
+    OUTPUT:
+    - personsIDs_old: array of ints. Index of the previous person of each detected person, -1 if none
+    '''
+
+    coords_proj = project_points(np.asarray(Q_kpt_old, dtype=float), calib_params) # cams * persons_old * keypoints * 2
+    x_files, y_files, likelihood_files = [np.asarray(a, dtype=float) for a in (x_files, y_files, likelihood_files)] # persons * cams * keypoints
+
+    # Mean distance between each previous and each detected person, over valid cameras and keypoints
+    with np.errstate(invalid='ignore'):
+        dist = np.hypot(coords_proj[None,...,0].swapaxes(1,2) - x_files[:,None], coords_proj[None,...,1].swapaxes(1,2) - y_files[:,None]) # detected * old * cams * keypoints
+        dist[~(likelihood_files >= likelihood_threshold)[:,None].repeat(dist.shape[1], axis=1)] = np.nan
+    valid = ~np.isnan(dist)
+    nb_valid = valid.sum(axis=(2,3))
+    dist = np.where(nb_valid > 0, np.nansum(dist, axis=(2,3)) / np.maximum(nb_valid, 1), np.inf)
+
+    personsIDs_old = np.full(len(x_files), -1, dtype=int)
+    finite_dist = np.isfinite(dist)
+    if finite_dist.any():
+        cost = np.where(finite_dist, dist, (dist[finite_dist].max()+1)*dist.size)
+        rows, cols = linear_sum_assignment(cost)
+        matched = finite_dist[rows, cols]
+        personsIDs_old[rows[matched]] = cols[matched]
+
+    return personsIDs_old
+
+
+def init_tracks(nb_persons, keypoints_nb):
+    '''
+    Initialize constant-velocity tracks, one per person.
+
+    INPUTS:
+    - nb_persons: int
+    - keypoints_nb: int
+
+    OUTPUT:
+    - tracks: dict of arrays. position (persons, keypoints, 3) last observed coordinates, 
+    velocity (persons, 3) one smoothed velocity per person, nan until it is measured, 
+    last_seen (persons, keypoints) frame of last valid coordinate, 
+    and per-person metrics: matched, lost, gaps, longest_gap, current_gap, distance_sum
+    '''
+
+    tracks = {'position': np.full((nb_persons, keypoints_nb, 3), np.nan),
+              'velocity': np.full((nb_persons, 3), np.nan),
+              'last_seen': np.full((nb_persons, keypoints_nb), np.nan),
+              'matched': np.zeros(nb_persons, dtype=int),
+              'lost': np.zeros(nb_persons, dtype=int),
+              'gaps': np.zeros(nb_persons, dtype=int),
+              'longest_gap': np.zeros(nb_persons, dtype=int),
+              'current_gap': np.zeros(nb_persons, dtype=int),
+              'distance_sum': np.zeros(nb_persons)}
+    
+    return tracks
+
+
+def predict_tracks(tracks, frame, max_gap):
+    '''
+    Predict the position of each person at a given frame, assuming constant velocity.
+    Tracks lost for more than max_gap frames are not extrapolated any more: 
+    their last known position is used instead.
+
+    INPUTS:
+    - tracks: dict, see init_tracks
+    - frame: int, frame to predict
+    - max_gap: int, maximum number of lost frames over which the motion is extrapolated
+
+    OUTPUT:
+    - Q_pred: array of predicted coordinates (persons, keypoints, 3)
+    '''
+
+    elapsed = np.nan_to_num(frame - tracks['last_seen'])
+    elapsed[tracks['current_gap'] > max_gap] = 0
+    Q_pred = tracks['position'] + np.nan_to_num(tracks['velocity'])[:,np.newaxis] * elapsed[...,np.newaxis]
+
+    return Q_pred
+
+
+def update_tracks(tracks, Q, Q_pred, personsIDs_sorted, frame, associated_tuples=None, smoothing=0.5):
+    '''
+    Update positions, velocities and quality metrics of the tracks with the 
+    sorted 3D coordinates of the current frame.
+
+    The velocity of a person is the median of the velocities of its keypoints, 
+    so that a few noisy keypoints are not extrapolated, and it is smoothed 
+    over frames (exponential smoothing). A track given a detection outside of 
+    the gate (see sort_people) is re-seeded: it restarts from this detection, 
+    without velocity.
+
+    INPUTS:
+    - tracks: dict, see init_tracks
+    - Q: list of arrays of 3D coordinates (keypoints, 3), sorted by person
+    - Q_pred: array of predicted coordinates (persons, keypoints, 3)
+    - personsIDs_sorted: index of reordered persons, -1 if lost
+    - frame: int, current frame
+    - associated_tuples: (previous index, current index) pairs associated within the gate, 
+    see sort_people. Default: all persons found are considered associated
+    - smoothing: float between 0 and 1. Weight of the new velocity measurement
+
+    OUTPUT:
+    - tracks: updated dict
+    '''
+
+    Q = np.array([np.asarray(q, dtype=float).reshape(-1,3) for q in Q])[:len(tracks['position'])]
+    valid = np.isfinite(Q).all(axis=-1)
+    found = (np.array(personsIDs_sorted[:len(Q)]) >= 0) & valid.any(axis=1)
+
+    # Re-seeded tracks forget their previous position and velocity
+    if associated_tuples is not None:
+        reseeded = found & ~np.isin(np.arange(len(Q)), np.asarray(associated_tuples)[:,0])
+    else:
+        reseeded = np.zeros(len(Q), dtype=bool)
+    tracks['position'][reseeded] = np.nan
+    tracks['last_seen'][reseeded] = np.nan
+    tracks['velocity'][reseeded] = np.nan
+    
+    # Velocities are only measured on keypoints seen before, positions are updated for all valid keypoints
+    update_velocity = valid & np.isfinite(tracks['last_seen'])
+    elapsed = np.where(update_velocity, frame - np.nan_to_num(tracks['last_seen']), 1)
+    velocity_kpts = np.where(update_velocity[...,np.newaxis], (Q - tracks['position']) / elapsed[...,np.newaxis], np.nan)
+    measured = update_velocity.any(axis=1)
+    velocity = np.full_like(tracks['velocity'], np.nan)
+    velocity[measured] = np.nanmedian(velocity_kpts[measured], axis=1)
+    velocity = np.where(np.isnan(tracks['velocity']), velocity, tracks['velocity'] + smoothing * (velocity - tracks['velocity']))
+    tracks['velocity'] = np.where(measured[:,np.newaxis], velocity, tracks['velocity'])
+    tracks['position'] = np.where(valid[...,np.newaxis], Q, tracks['position'])
+    tracks['last_seen'] = np.where(valid, frame, tracks['last_seen'])
+
+    # Quality metrics
+    gap_ended = found & (tracks['current_gap'] > 0)
+    tracks['gaps'] += gap_ended
+    tracks['longest_gap'] = np.maximum(tracks['longest_gap'], np.where(gap_ended, tracks['current_gap'], 0))
+    tracks['current_gap'] = np.where(found, 0, tracks['current_gap'] + 1)
+    tracks['matched'] += found
+    tracks['lost'] += ~found
+    kpt_distance = np.linalg.norm(Q - Q_pred, axis=-1) # mean distance between keypoints, in meters
+    compared = np.isfinite(kpt_distance)
+    distance = np.where(compared, kpt_distance, 0).sum(axis=1) / np.maximum(compared.sum(axis=1), 1)
+    tracks['distance_sum'] += np.where(found & ~reseeded & compared.any(axis=1), distance, 0)
+
+    return tracks
+
+
+def track_metrics(tracks, persons_kept):
+    '''
+    Summarize track quality for the persons kept after triangulation.
+
+    INPUTS:
+    - tracks: dict, see init_tracks
+    - persons_kept: indices of the persons kept
+
+    OUTPUT:
+    - metrics: list of dicts with matched_ratio, gaps, longest_gap, mean_distance
+    '''
+
+    metrics = []
+    for n in persons_kept:
+        # gaps still open at the end of the sequence count as gaps too
+        gaps = tracks['gaps'][n] + (tracks['current_gap'][n] > 0)
+        longest_gap = max(tracks['longest_gap'][n], tracks['current_gap'][n])
+        nb_frames = tracks['matched'][n] + tracks['lost'][n]
+        metrics.append({'matched_ratio': tracks['matched'][n] / nb_frames if nb_frames > 0 else 0,
+                        'gaps': int(gaps),
+                        'longest_gap': int(longest_gap),
+                        'mean_distance': tracks['distance_sum'][n] / tracks['matched'][n] if tracks['matched'][n] > 0 else np.nan})
+    
+    return metrics
+
+
 def make_trc(config_dict, Q, keypoints_names, f_range, id_person=-1):
     '''
     Make Opensim compatible trc file from a dataframe with 3D coordinates
@@ -230,9 +548,8 @@ def make_trc(config_dict, Q, keypoints_names, f_range, id_person=-1):
     pose3d_dir = os.path.join(project_dir, 'pose-3d')
 
     # Get frame_rate
-    video_dir = os.path.join(project_dir, 'videos')
     vid_img_extension = config_dict['pose']['vid_img_extension']
-    video_files = glob.glob(os.path.join(video_dir, '*'+vid_img_extension))
+    video_files = find_video_files(project_dir, vid_img_extension)
     frame_rate = config_dict.get('project').get('frame_rate')
     if frame_rate == 'auto': 
         try:
@@ -247,29 +564,19 @@ def make_trc(config_dict, Q, keypoints_names, f_range, id_person=-1):
     trc_f = f'{seq_name}_{f_range[0]}-{f_range[1]}.trc'
 
     #Header
-    DataRate = CameraRate = OrigDataRate = frame_rate
-    NumFrames = len(Q)
-    NumMarkers = len(keypoints_names)
-    header_trc = ['PathFileType\t4\t(X/Y/Z)\t' + trc_f, 
-            'DataRate\tCameraRate\tNumFrames\tNumMarkers\tUnits\tOrigDataRate\tOrigDataStartFrame\tOrigNumFrames', 
-            '\t'.join(map(str,[DataRate, CameraRate, NumFrames, NumMarkers, 'm', OrigDataRate, f_range[0], f_range[1]])),
-            'Frame#\tTime\t' + '\t\t\t'.join(keypoints_names) + '\t\t',
-            '\t\t'+'\t'.join([f'X{i+1}\tY{i+1}\tZ{i+1}' for i in range(len(keypoints_names))])]
+    header_trc = trc_header(trc_f, keypoints_names, frame_rate, len(Q), orig_data_start_frame=f_range[0], orig_num_frames=f_range[1])
     
     # Zup to Yup coordinate system
     Q = zup2yup(Q)
     
-    #Add Frame# and Time columns
-    Q.index = np.array(range(f_range[0], f_range[1]))
-    Q.insert(0, 't', Q.index/ frame_rate)
-    # Q = Q.fillna(' ')
+    #Frame# and Time columns
+    frames = np.arange(f_range[0], f_range[1])
+    times = frames / frame_rate
 
     #Write file
     if not os.path.exists(pose3d_dir): os.mkdir(pose3d_dir)
     trc_path = os.path.realpath(os.path.join(pose3d_dir, trc_f))
-    with open(trc_path, 'w') as trc_o:
-        [trc_o.write(line+'\n') for line in header_trc]
-        Q.to_csv(trc_o, sep='\t', index=True, header=None, lineterminator='\n')
+    write_trc(trc_path, header_trc, frames, times, Q.to_numpy())
 
     return trc_path
 
@@ -311,7 +618,7 @@ def retrieve_right_trc_order(trc_paths):
     return trc_id
 
 
-def recap_triangulate(config_dict, error, nb_cams_excluded, keypoints_names, cam_excluded_count, interp_frames, non_interp_frames, trc_path):
+def recap_triangulate(config_dict, error, nb_cams_excluded, keypoints_names, cam_excluded_count, interp_frames, non_interp_frames, trc_path, cache_stats=None, tracking_metrics=None, warm_start_stats=None):
     '''
     Print a message giving statistics on reprojection errors (in pixel and in m)
     as well as the number of cameras that had to be excluded to reach threshold 
@@ -322,6 +629,9 @@ def recap_triangulate(config_dict, error, nb_cams_excluded, keypoints_names, cam
     - error: dataframe 
     - nb_cams_excluded: dataframe
     - keypoints_names: list of strings
+    - cache_stats: dict with 'hits' and 'misses' counts, or None if the cache was not used
+    - tracking_metrics: list of dicts per person (see track_metrics), or None if tracking was not used
+    - warm_start_stats: dict with 'tried' and 'accepted' counts, or None if previous-frame camera subsets were not used
 
     OUTPUT:
     - Message in console
@@ -337,7 +647,6 @@ def recap_triangulate(config_dict, error, nb_cams_excluded, keypoints_names, cam
     calib_file = glob.glob(os.path.join(calib_dir, '*.toml'))[0] # lastly created calibration file
     calib = toml.load(calib_file)
     cam_names = np.array([calib[c].get('name') for c in list(calib.keys())])
-    cam_names = cam_names[list(cam_excluded_count[0].keys())]
     error_threshold_triangulation = config_dict.get('triangulation').get('reproj_error_threshold_triangulation')
     likelihood_threshold = config_dict.get('triangulation').get('likelihood_threshold_triangulation')
     show_interp_indices = config_dict.get('triangulation').get('show_interp_indices')
@@ -387,7 +696,7 @@ def recap_triangulate(config_dict, error, nb_cams_excluded, keypoints_names, cam
             logging.info(f'Gaps were interpolated with {interpolation_kind} method if smaller than {interp_gap_smaller_than} frames. Larger gaps were filled with {["the last valid value" if fill_large_gaps_with == "last_value" else "zeros" if fill_large_gaps_with == "zeros" else "NaNs"][0]}.') 
         logging.info(f'In average, {mean_cam_excluded} cameras had to be excluded to reach these thresholds.')
         
-        cam_excluded_count[n] = {i: v for i, v in zip(cam_names, cam_excluded_count[n].values())}
+        cam_excluded_count[n] = {cam_names[i]: v for i, v in cam_excluded_count[n].items()}
         cam_excluded_count[n] = {k: v for k, v in sorted(cam_excluded_count[n].items(), key=lambda item: item[1])[::-1]}
         str_cam_excluded_count = ''
         for i, (k, v) in enumerate(cam_excluded_count[n].items()):
@@ -398,16 +707,31 @@ def recap_triangulate(config_dict, error, nb_cams_excluded, keypoints_names, cam
             else:
                 str_cam_excluded_count += f'Camera {k}: {int(np.round(v*100))}%, '
         logging.info(str_cam_excluded_count)
+        if tracking_metrics is not None:
+            m = tracking_metrics[n]
+            logging.info(f'Constant-velocity tracking: person matched in {int(np.round(m["matched_ratio"]*100))}% of the frames, with {m["gaps"]} gaps (longest: {m["longest_gap"]} frames). Mean distance to the predicted position: {np.around(m["mean_distance"], decimals=3)} m.')
         logging.info(f'\n3D coordinates are stored at {trc_path[n]}.')
         
     logging.info('\n\n')
     if make_c3d:
         logging.info('All trc files have been converted to c3d.')
     logging.info(f'Limb swapping was {"handled" if handle_LR_swap else "not handled"}.')
+    if config_dict.get('triangulation').get('method', 'exhaustive') == 'robust':
+        logging.info('Outlier cameras were found with iteratively reweighted least squares instead of testing all camera combinations.')
     logging.info(f'Lens distortions were {"taken into account" if undistort_points else "not taken into account"}.')
-
-
-def triangulation_from_best_cameras(config_dict, coords_2D_kpt, coords_2D_kpt_swapped, projection_matrices, calib_params):
+    if cache_stats is not None:
+        nb_cached_frames = cache_stats['hits'] + cache_stats['misses']
+        hit_rate = int(np.round(cache_stats['hits'] / nb_cached_frames * 100)) if nb_cached_frames > 0 else 0
+        logging.info(f'Triangulation cache: {cache_stats["hits"]} frames reused, {cache_stats["misses"]} frames recomputed ({hit_rate}% hit rate).')
+    if warm_start_stats is not None:
+        accepted_rate = int(np.round(warm_start_stats['accepted'] / warm_start_stats['tried'] * 100)) if warm_start_stats['tried'] > 0 else 0
+        logging.info(f'Cameras excluded in the previous frame were tried first {warm_start_stats["tried"]} times, and accepted {warm_start_stats["accepted"]} times ({accepted_rate}%).')
+    peak_memory = peak_memory_mb()
+    if peak_memory is not None:
+        logging.info(f'Peak memory usage: {peak_memory:.0f} MB.')
+
+
+def triangulation_from_best_cameras(config_dict, coords_2D_kpt, coords_2D_kpt_swapped, projection_matrices, calib_params, cams_off_guess=None, warm_start_stats=None):
     '''
     Triangulates 2D keypoint coordinates. If reprojection error is above threshold,
     tries swapping left and right sides. If still above, removes a camera until error
@@ -419,12 +743,17 @@ def triangulation_from_best_cameras(config_dict, coords_2D_kpt, coords_2D_kpt_sw
     If error too big, take off one more camera.
         If then below threshold, retain result.
         If better but still too big, take off one more camera.
+    If cameras need to be excluded and cams_off_guess is given (e.g. cameras excluded 
+    in the previous frame), this subset is tried before the others, and kept if its error is below threshold.
     
     INPUTS:
     - a Config.toml file
     - coords_2D_kpt: (x,y,likelihood) * ncams array
     - coords_2D_kpt_swapped: (x,y,likelihood) * ncams array  with left/right swap
     - projection_matrices: list of arrays
+    - calib_params: dict, see retrieve_calib_params
+    - cams_off_guess: list of indices of cameras to exclude in the first guess, or None
+    - warm_start_stats: dict with 'tried' and 'accepted' counts, updated in place, or None
 
     OUTPUTS:
     - Q: array of triangulated point (x,y,z,1.)
@@ -438,17 +767,34 @@ def triangulation_from_best_cameras(config_dict, coords_2D_kpt, coords_2D_kpt_sw
     handle_LR_swap = config_dict.get('triangulation').get('handle_LR_swap')
 
     undistort_points = config_dict.get('triangulation').get('undistort_points')
-    if undistort_points:
-        calib_params_K = calib_params['K']
-        calib_params_dist = calib_params['dist']
-        calib_params_R = calib_params['R']
-        calib_params_T = calib_params['T']
 
     # Initialize
     x_files, y_files, likelihood_files = coords_2D_kpt
     x_files_swapped, y_files_swapped, likelihood_files_swapped = coords_2D_kpt_swapped
     n_cams = len(x_files)
     error_min = np.inf 
+
+    def triangulate_guess():
+        # Triangulation with the cameras excluded in the previous frame, if it is valid and below threshold
+        likelihood_files_guess = likelihood_files.copy()
+        likelihood_files_guess[np.array(cams_off_guess, dtype=int)] = np.nan
+        cams_kept_guess = np.flatnonzero(~np.isnan(likelihood_files_guess) & (likelihood_files_guess != 0.))
+        if len(cams_kept_guess) < min_cameras_for_triangulation:
+            return None
+        if warm_start_stats is not None:
+            warm_start_stats['tried'] += 1
+        projection_matrices_guess = [projection_matrices[i] for i in cams_kept_guess]
+        Q_guess = weighted_triangulation(projection_matrices_guess, x_files[cams_kept_guess], y_files[cams_kept_guess], likelihood_files[cams_kept_guess])
+        if undistort_points:
+            x_calc_guess, y_calc_guess = project_points(Q_guess, calib_params)[cams_kept_guess].T
+        else:
+            x_calc_guess, y_calc_guess = reprojection(projection_matrices_guess, Q_guess)
+        error_guess = np.mean([euclidean_distance((x_files[c], y_files[c]), (x_calc_guess[i], y_calc_guess[i])) for i, c in enumerate(cams_kept_guess)])
+        if not error_guess <= error_threshold_triangulation:
+            return None
+        if warm_start_stats is not None:
+            warm_start_stats['accepted'] += 1
+        return Q_guess[:-1], error_guess, n_cams - len(cams_kept_guess), np.setdiff1d(np.arange(n_cams), cams_kept_guess)
     
     nb_cams_off = 0 # cameras will be taken-off until reprojection error is under threshold
     # print('\n')
@@ -457,11 +803,6 @@ def triangulation_from_best_cameras(config_dict, coords_2D_kpt, coords_2D_kpt_sw
         # Create subsets with "nb_cams_off" cameras excluded
         id_cams_off = np.array(list(it.combinations(range(n_cams), nb_cams_off)))
         
-        if undistort_points:
-            calib_params_K_filt = [calib_params_K]*len(id_cams_off)
-            calib_params_dist_filt = [calib_params_dist]*len(id_cams_off)
-            calib_params_R_filt = [calib_params_R]*len(id_cams_off)
-            calib_params_T_filt = [calib_params_T]*len(id_cams_off)
         projection_matrices_filt = [projection_matrices]*len(id_cams_off)
 
         x_files_filt = np.vstack([x_files.copy()]*len(id_cams_off))
@@ -489,11 +830,7 @@ def triangulation_from_best_cameras(config_dict, coords_2D_kpt, coords_2D_kpt_sw
         id_cams_off_tot = id_cams_off_tot_new
         
         # print('still in loop')
-        if undistort_points:
-            calib_params_K_filt = [ [ c[i] for i in range(n_cams) if not np.isnan(likelihood_files_filt[j][i]) and not likelihood_files_filt[j][i]==0. ] for j, c in enumerate(calib_params_K_filt) ]
-            calib_params_dist_filt = [ [ c[i] for i in range(n_cams) if not np.isnan(likelihood_files_filt[j][i]) and not likelihood_files_filt[j][i]==0. ] for j, c in enumerate(calib_params_dist_filt) ]
-            calib_params_R_filt = [ [ c[i] for i in range(n_cams) if not np.isnan(likelihood_files_filt[j][i]) and not likelihood_files_filt[j][i]==0. ] for j, c in enumerate(calib_params_R_filt) ]
-            calib_params_T_filt = [ [ c[i] for i in range(n_cams) if not np.isnan(likelihood_files_filt[j][i]) and not likelihood_files_filt[j][i]==0. ] for j, c in enumerate(calib_params_T_filt) ]
+        cams_kept_filt = [np.flatnonzero(~np.isnan(l) & (l != 0.)) for l in likelihood_files_filt] # indices of the cameras used in each subset
         projection_matrices_filt = [ [ p[i] for i in range(n_cams) if not np.isnan(likelihood_files_filt[j][i]) and not likelihood_files_filt[j][i]==0. ] for j, p in enumerate(projection_matrices_filt) ]
         
         # print('\nnb_cams_off', repr(nb_cams_off), 'nb_cams_excluded', repr(nb_cams_excluded_filt))
@@ -517,10 +854,9 @@ def triangulation_from_best_cameras(config_dict, coords_2D_kpt, coords_2D_kpt_sw
         
         # Reprojection
         if undistort_points:
-            coords_2D_kpt_calc_filt = [np.array([cv2.projectPoints(np.array(Q_filt[i][:-1]), calib_params_R_filt[i][j], calib_params_T_filt[i][j], calib_params_K_filt[i][j], calib_params_dist_filt[i][j])[0].ravel() 
-                                        for j in range(n_cams-nb_cams_excluded_filt[i])]) 
-                                        for i in range(len(id_cams_off))]
-            coords_2D_kpt_calc_filt = [[coords_2D_kpt_calc_filt[i][:,0], coords_2D_kpt_calc_filt[i][:,1]] for i in range(len(id_cams_off))]
+            # all subsets are projected on all cameras at once, then only the cameras of each subset are kept
+            coords_2D_kpt_calc_all = project_points(np.array(Q_filt), calib_params) # cams * subsets * 2
+            coords_2D_kpt_calc_filt = [[coords_2D_kpt_calc_all[cams_kept_filt[i],i,0], coords_2D_kpt_calc_all[cams_kept_filt[i],i,1]] for i in range(len(id_cams_off))]
         else:
             coords_2D_kpt_calc_filt = [reprojection(projection_matrices_filt[i], Q_filt[i]) for i in range(len(id_cams_off))]
         coords_2D_kpt_calc_filt = np.array(coords_2D_kpt_calc_filt, dtype=object)
@@ -579,12 +915,8 @@ def triangulation_from_best_cameras(config_dict, coords_2D_kpt, coords_2D_kpt_sw
                 
                 # Reprojection
                 if undistort_points:
-                    coords_2D_kpt_calc_off_swap = [np.array([[cv2.projectPoints(np.array(Q_filt_off_swap[id_off][id_swapped][:-1]), calib_params_R_filt[id_off][j], calib_params_T_filt[id_off][j], calib_params_K_filt[id_off][j], calib_params_dist_filt[id_off][j])[0].ravel() 
-                                                    for j in range(n_cams-nb_cams_off_tot)] 
-                                                    for id_swapped in range(len(id_cams_swapped))])
-                                                    for id_off in range(len(id_cams_off))]
-                    coords_2D_kpt_calc_off_swap = np.array([[[coords_2D_kpt_calc_off_swap[id_off][id_swapped,:,0], coords_2D_kpt_calc_off_swap[id_off][id_swapped,:,1]] 
-                                                    for id_swapped in range(len(id_cams_swapped))] 
+                    coords_2D_kpt_calc_all = project_points(Q_filt_off_swap, calib_params) # cams * subsets * swaps * 2
+                    coords_2D_kpt_calc_off_swap = np.array([coords_2D_kpt_calc_all[cams_kept_filt[id_off][:n_cams-nb_cams_off_tot],id_off].transpose(1,2,0) # swaps * 2 * cams
                                                     for id_off in range(len(id_cams_off))])
                 else:
                     coords_2D_kpt_calc_off_swap = [np.array([reprojection(projection_matrices_filt[id_off], Q_filt_off_swap[id_off][id_swapped]) 
@@ -626,6 +958,12 @@ def triangulation_from_best_cameras(config_dict, coords_2D_kpt, coords_2D_kpt_sw
                 Q = Q_best
         
         # print(error_min)
+
+        # If all cameras did not do it, try the cameras excluded in the previous frame before searching further
+        if nb_cams_off == 0 and error_min > error_threshold_triangulation and cams_off_guess is not None and 0 < len(cams_off_guess) < n_cams:
+            guess = triangulate_guess()
+            if guess is not None:
+                return guess
         
         nb_cams_off += 1
     
@@ -651,6 +989,94 @@ def triangulation_from_best_cameras(config_dict, coords_2D_kpt, coords_2D_kpt_sw
     return Q, error_min, nb_cams_excluded, id_excluded_cams
 
 
+def robust_triangulation(config_dict, coords_2D_kpt, coords_2D_kpt_swapped, projection_matrices, max_iter=10, tol=1e-6):
+    '''
+    Triangulates 2D keypoint coordinates with iteratively reweighted least squares.
+    Instead of trying all subsets of cameras, cameras are progressively down-weighted 
+    according to their reprojection error (Cauchy loss, scaled with the error threshold),
+    starting from the likelihood-weighted DLT. Cost grows linearly with the number of cameras.
+
+    1. Triangulates with all cameras, weighted by likelihood
+    2. Reweights each camera by its reprojection residual and triangulates again, until convergence
+    3. Cameras with a residual above threshold are outliers. 
+    If handle_LR_swap, outlier cameras are tried again with left and right sides swapped.
+    4. Triangulates with inliers only
+    
+    INPUTS:
+    - a Config.toml file
+    - coords_2D_kpt: (x,y,likelihood) * ncams array
+    - coords_2D_kpt_swapped: (x,y,likelihood) * ncams array  with left/right swap
+    - projection_matrices: list of arrays
+    - max_iter: int. Maximum number of reweighting iterations
+    - tol: float. Convergence threshold on the 3D point displacement
+
+    OUTPUTS:
+    - Q: array of triangulated point (x,y,z)
+    - error_min: float
+    - nb_cams_excluded: int
+    - id_excluded_cams: array of indices of the cameras not used
+    '''
+
+    # Read config_dict
+    error_threshold_triangulation = config_dict.get('triangulation').get('reproj_error_threshold_triangulation')
+    min_cameras_for_triangulation = config_dict.get('triangulation').get('min_cameras_for_triangulation')
+    handle_LR_swap = config_dict.get('triangulation').get('handle_LR_swap')
+
+    P = np.array(projection_matrices, dtype=float) # cams * 3 * 4
+    x, y, likelihood = np.array(coords_2D_kpt, dtype=float)
+    n_cams = len(x)
+
+    def dlt(x, y, weights):
+        # likelihood-weighted direct linear transform, all cameras at once
+        A = np.concatenate(((P[:,0] - x[:,None]*P[:,2]) * weights[:,None], (P[:,1] - y[:,None]*P[:,2]) * weights[:,None]))
+        Vt = np.linalg.svd(A)[2]
+        return Vt[-1] / Vt[-1][3]
+
+    def residuals(Q, x, y):
+        q_calc = P @ Q
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.sqrt((q_calc[:,0]/q_calc[:,2] - x)**2 + (q_calc[:,1]/q_calc[:,2] - y)**2)
+
+    failed = (np.array([np.nan, np.nan, np.nan]), np.nan, n_cams, np.arange(n_cams))
+    valid = np.isfinite(x) & np.isfinite(y) & np.isfinite(likelihood) & (likelihood > 0)
+    if np.count_nonzero(valid) < max(min_cameras_for_triangulation, 2):
+        return failed
+    x, y, likelihood = np.where(valid, x, 0.), np.where(valid, y, 0.), np.where(valid, likelihood, 0.)
+
+    # Likelihood-weighted seed, then iteratively reweighted least squares
+    Q = dlt(x, y, likelihood)
+    for _ in range(max_iter):
+        res = np.where(valid, residuals(Q, x, y), 0.)
+        robust_weights = 1 / (1 + (res / error_threshold_triangulation)**2)
+        Q_new = dlt(x, y, likelihood * np.sqrt(robust_weights))
+        converged = np.linalg.norm(Q_new[:3] - Q[:3]) < tol
+        Q = Q_new
+        if converged:
+            break
+    res = residuals(Q, x, y)
+    inliers = valid & (res <= error_threshold_triangulation)
+
+    # Outliers may have their left and right sides swapped
+    if handle_LR_swap and (valid & ~inliers).any():
+        x_swapped, y_swapped, likelihood_swapped = np.array(coords_2D_kpt_swapped, dtype=float)
+        res_swapped = residuals(Q, x_swapped, y_swapped)
+        swapped = valid & ~inliers & (res_swapped <= error_threshold_triangulation) & np.isfinite(likelihood_swapped) & (likelihood_swapped > 0)
+        x, y, likelihood = np.where(swapped, x_swapped, x), np.where(swapped, y_swapped, y), np.where(swapped, likelihood_swapped, likelihood)
+        inliers = inliers | swapped
+
+    if np.count_nonzero(inliers) < max(min_cameras_for_triangulation, 2):
+        return failed
+
+    # Final triangulation with inliers only
+    Q = dlt(x, y, likelihood * inliers)
+    error_min = np.mean(residuals(Q, x, y)[inliers])
+    if not error_min <= error_threshold_triangulation:
+        return failed
+    id_excluded_cams = np.flatnonzero(~inliers)
+
+    return Q[:3], error_min, len(id_excluded_cams), id_excluded_cams
+
+
 def extract_files_frame_f(json_tracked_files_f, keypoints_ids, nb_persons_to_detect):
     '''
     Extract data from json files for frame f, 
@@ -737,7 +1163,16 @@ def triangulate_all(config_dict):
     fill_large_gaps_with = config_dict.get('triangulation').get('fill_large_gaps_with')
     show_interp_indices = config_dict.get('triangulation').get('show_interp_indices')
     undistort_points = config_dict.get('triangulation').get('undistort_points')
+    use_undistortion_lut = config_dict.get('triangulation').get('undistortion_lut', False)
+    triangulation_method = config_dict.get('triangulation').get('method', 'exhaustive')
+    warm_start_cameras = config_dict.get('triangulation').get('warm_start_cameras', False) and triangulation_method != 'robust'
     make_c3d = config_dict.get('triangulation').get('make_c3d')
+    use_cache = config_dict.get('triangulation').get('use_cache', False)
+    cache_max_size_mb = config_dict.get('triangulation').get('cache_max_size_mb', 500)
+    use_float32 = config_dict.get('triangulation').get('use_float32', False)
+    reid_max_distance = config_dict.get('triangulation').get('reid_max_distance', None)
+    constant_velocity_tracking = config_dict.get('triangulation').get('constant_velocity_tracking', False)
+    tracking_max_gap = config_dict.get('triangulation').get('tracking_max_gap', 10)
     
     try:
         calib_dir = [os.path.join(session_dir, c) for c in os.listdir(session_dir) if os.path.isdir(os.path.join(session_dir, c)) and  'calib' in c.lower()][0]
@@ -750,10 +1185,12 @@ def triangulate_all(config_dict):
     pose_dir = os.path.join(project_dir, 'pose')
     poseSync_dir = os.path.join(project_dir, 'pose-sync')
     poseTracked_dir = os.path.join(project_dir, 'pose-associated')
+    cache_dir = os.path.join(project_dir, 'triangulation-cache')
     
     # Projection matrix from toml calibration file
     P = computeP(calib_file, undistort=undistort_points)
     calib_params = retrieve_calib_params(calib_file)
+    undistortion_luts = undistortion_lut(calib_params) if undistort_points and use_undistortion_lut else None
         
     # Retrieve keypoints from model
     try: # from skeletons.py
@@ -776,6 +1213,17 @@ def triangulate_all(config_dict):
     keypoints_names_swapped = [keypoint_name.replace('R', 'L') if keypoint_name.startswith('R') else keypoint_name.replace('L', 'R') if keypoint_name.startswith('L') else keypoint_name for keypoint_name in keypoints_names]
     keypoints_names_swapped = [keypoint_name_swapped.replace('right', 'left') if keypoint_name_swapped.startswith('right') else keypoint_name_swapped.replace('left', 'right') if keypoint_name_swapped.startswith('left') else keypoint_name_swapped for keypoint_name_swapped in keypoints_names_swapped]
     keypoints_idx_swapped = [keypoints_names.index(keypoint_name_swapped) for keypoint_name_swapped in keypoints_names_swapped] # find index of new keypoint_name
+
+    # Frames are only triangulated again if their 2D coordinates, the triangulation parameters, or the calibration changed
+    if use_cache:
+        settings_hash = triangulation_settings_hash(config_dict, calib_file, keypoints_ids)
+        cache_stats = {'hits': 0, 'misses': 0}
+    else:
+        cache_stats = None
+
+    # Cameras excluded in the previous frame, for each person and keypoint, are tried first
+    cams_off_prev = None
+    warm_start_stats = {'tried': 0, 'accepted': 0} if warm_start_cameras else None
     
     # 2d-pose files selection
     try:
@@ -786,6 +1234,7 @@ def triangulate_all(config_dict):
     pose_listdirs_names = sort_stringlist_by_last_number(pose_listdirs_names)
     json_dirs_names = [k for k in pose_listdirs_names if 'json' in k]
     n_cams = len(json_dirs_names)
+    sync_offsets = {}
     try: 
         json_files_names = [fnmatch.filter(os.listdir(os.path.join(poseTracked_dir, js_dir)), '*.json') for js_dir in json_dirs_names]
         pose_dir = poseTracked_dir
@@ -796,12 +1245,14 @@ def triangulate_all(config_dict):
         except:
             try:
                 json_files_names = [fnmatch.filter(os.listdir(os.path.join(pose_dir, js_dir)), '*.json') for js_dir in json_dirs_names]
+                sync_offsets = read_sync_offsets(project_dir) # offsets from the synchronization manifest, if any
             except:
                 raise Exception(f'No json files found in {pose_dir}, {poseSync_dir}, nor {poseTracked_dir} subdirectories. Make sure you run Pose2Sim.poseEstimation() first.')
     json_files_names = [sort_stringlist_by_last_number(js) for js in json_files_names]    
+    frame_files = [frame_json_files(json_files_names[c], sync_offsets.get(json_dirs_names[c], 0)) for c in range(n_cams)]
 
     # frame range selection
-    f_range = [[0,max([len(j) for j in json_files_names])] if frame_range==[] else frame_range][0]
+    f_range = [[0,max([len(j) for j in frame_files])] if frame_range==[] else frame_range][0]
     frame_nb = f_range[1] - f_range[0]
     
     # Check that camera number is consistent between calibration file and pose folders
@@ -812,142 +1263,178 @@ def triangulate_all(config_dict):
     
     # Triangulation
     if multi_person:
-        nb_persons_to_detect = max(max(count_persons_in_json(os.path.join(pose_dir, json_dirs_names[c], json_fname)) for json_fname in json_files_names[c]) for c in range(n_cams))
+        nb_persons_to_detect = max(max(count_persons_in_json(os.path.join(pose_dir, json_dirs_names[c], json_fname)) for json_fname in frame_files[c].values()) for c in range(n_cams))
     else:
         nb_persons_to_detect = 1
 
+    # Results are written in preallocated arrays: frames * persons * keypoints (* 3 or * n_cams)
+    dtype = np.float32 if use_float32 else np.float64
+    Q_tot = np.full((frame_nb, nb_persons_to_detect, keypoints_nb, 3), np.nan, dtype=dtype)
+    error_tot = np.full((frame_nb, nb_persons_to_detect, keypoints_nb), np.nan, dtype=dtype)
+    nb_cams_excluded_tot = np.full((frame_nb, nb_persons_to_detect, keypoints_nb), np.nan, dtype=dtype)
+    excluded_cams_tot = np.zeros((frame_nb, nb_persons_to_detect, keypoints_nb, n_cams), dtype=bool)
+
     Q = [[[np.nan]*3]*keypoints_nb for n in range(nb_persons_to_detect)]
     Q_old = [[[np.nan]*3]*keypoints_nb for n in range(nb_persons_to_detect)]
     error = [[] for n in range(nb_persons_to_detect)]
     nb_cams_excluded = [[] for n in range(nb_persons_to_detect)]
     id_excluded_cams = [[] for n in range(nb_persons_to_detect)]
-    Q_tot, error_tot, nb_cams_excluded_tot,id_excluded_cams_tot = [], [], [], []
+    reid_buffers = {}
+    tracks = init_tracks(nb_persons_to_detect, keypoints_nb) if multi_person and constant_velocity_tracking else None
     for f in tqdm(range(*f_range)):
         # print(f'\nFrame {f}:')        
         # Get x,y,likelihood values from files
-        json_files_names_f = [[j for j in json_files_names[c] if int(re.split(r'(\d+)',j)[-2])==f] for c in range(n_cams)]
-        json_files_names_f = [j for j_list in json_files_names_f for j in (j_list or ['none'])]
+        json_files_names_f = [frame_files[c].get(f, 'none') for c in range(n_cams)]
         json_files_f = [os.path.join(pose_dir, json_dirs_names[c], json_files_names_f[c]) for c in range(n_cams)]
 
         x_files, y_files, likelihood_files = extract_files_frame_f(json_files_f, keypoints_ids, nb_persons_to_detect)
         # [[[list of coordinates] * n_cams ] * nb_persons_to_detect]
         # vs. [[list of coordinates] * n_cams ] 
-        
-        # undistort points
-        if undistort_points:
-            for n in range(nb_persons_to_detect):
-                points = [np.array(tuple(zip(x_files[n][i],y_files[n][i]))).reshape(-1, 1, 2).astype('float32') for i in range(n_cams)]
-                undistorted_points = [cv2.undistortPoints(points[i], calib_params['K'][i], calib_params['dist'][i], None, calib_params['optim_K'][i]) for i in range(n_cams)]
-                x_files[n] =  np.array([[u[i][0][0] for i in range(len(u))] for u in undistorted_points])
-                y_files[n] =  np.array([[u[i][0][1] for i in range(len(u))] for u in undistorted_points])
-                # This is good for slight distortion. For fisheye camera, the model does not work anymore. See there for an example https://github.com/lambdaloop/aniposelib/blob/d03b485c4e178d7cff076e9fe1ac36837db49158/aniposelib/cameras.py#L301
 
-        # Replace likelihood by 0 if under likelihood_threshold
-        with np.errstate(invalid='ignore'):
-            for n in range(nb_persons_to_detect):
-                x_files[n][likelihood_files[n] < likelihood_threshold] = np.nan
-                y_files[n][likelihood_files[n] < likelihood_threshold] = np.nan
-                likelihood_files[n][likelihood_files[n] < likelihood_threshold] = np.nan
-        
         # Q_old = Q except when it has nan, otherwise it takes the Q_old value
         nan_mask = np.isnan(Q)
         Q_old = np.where(nan_mask, Q_old, Q)
-        Q = [[] for n in range(nb_persons_to_detect)]
-        error = [[] for n in range(nb_persons_to_detect)]
-        nb_cams_excluded = [[] for n in range(nb_persons_to_detect)]
-        id_excluded_cams = [[] for n in range(nb_persons_to_detect)]
-        
-        for n in range(nb_persons_to_detect):
-            for keypoint_idx in keypoints_idx:
-            # keypoints_nb = 2
-            # for keypoint_idx in range(2):
-            # Triangulate cameras with min reprojection error
-                # print('\n', keypoints_names[keypoint_idx])
-                coords_2D_kpt = np.array( (x_files[n][:, keypoint_idx], y_files[n][:, keypoint_idx], likelihood_files[n][:, keypoint_idx]) )
-                coords_2D_kpt_swapped = np.array(( x_files[n][:, keypoints_idx_swapped[keypoint_idx]], y_files[n][:, keypoints_idx_swapped[keypoint_idx]], likelihood_files[n][:, keypoints_idx_swapped[keypoint_idx]] ))
-
-                Q_kpt, error_kpt, nb_cams_excluded_kpt, id_excluded_cams_kpt = triangulation_from_best_cameras(config_dict, coords_2D_kpt, coords_2D_kpt_swapped, P, calib_params) # P has been modified if undistort_points=True
-
-                Q[n].append(Q_kpt)
-                error[n].append(error_kpt)
-                nb_cams_excluded[n].append(nb_cams_excluded_kpt)
-                id_excluded_cams[n].append(id_excluded_cams_kpt)
-        
+
+        # Cameras excluded in the previous frame, for each detected person and keypoint:
+        # in multi-person mode, detected persons are first associated to the persons of the previous frame
+        cams_off_guess_f = cams_off_prev
+        if cams_off_prev is not None and multi_person:
+            Q_ref = predict_tracks(tracks, f, tracking_max_gap) if tracks is not None else Q_old
+            personsIDs_old = match_persons_2d(Q_ref, x_files, y_files, likelihood_files, calib_params, likelihood_threshold=likelihood_threshold)
+            cams_off_guess_f = [cams_off_prev[p] if p >= 0 else [None]*keypoints_nb for p in personsIDs_old]
+
+        # Retrieve frame from cache if its inputs did not change
+        cached_frame = None
+        if use_cache:
+            cache_key = frame_cache_key(settings_hash, x_files, y_files, likelihood_files, cams_off_guess=cams_off_guess_f)
+            cached_frame = load_frame_from_cache(cache_dir, cache_key)
+            cache_stats['hits' if cached_frame is not None else 'misses'] += 1
+
+        if cached_frame is not None:
+            Q, error, nb_cams_excluded, id_excluded_cams = cached_frame
+        else:
+            # undistort points
+            if undistort_points:
+                # all persons and keypoints of a camera are undistorted at once
+                x_frame, y_frame = np.array(x_files, dtype=float), np.array(y_files, dtype=float) # persons * cams * keypoints
+                undistort_points_batch(x_frame.swapaxes(0,1), y_frame.swapaxes(0,1), calib_params, luts=undistortion_luts)
+                x_files, y_files = list(x_frame), list(y_frame)
+                # This is good for slight distortion. For fisheye camera, the model does not work anymore. See there for an example https://github.com/lambdaloop/aniposelib/blob/d03b485c4e178d7cff076e9fe1ac36837db49158/aniposelib/cameras.py#L301
+
+            # Replace likelihood by 0 if under likelihood_threshold
+            with np.errstate(invalid='ignore'):
+                for n in range(nb_persons_to_detect):
+                    x_files[n][likelihood_files[n] < likelihood_threshold] = np.nan
+                    y_files[n][likelihood_files[n] < likelihood_threshold] = np.nan
+                    likelihood_files[n][likelihood_files[n] < likelihood_threshold] = np.nan
+            
+            Q = [[] for n in range(nb_persons_to_detect)]
+            error = [[] for n in range(nb_persons_to_detect)]
+            nb_cams_excluded = [[] for n in range(nb_persons_to_detect)]
+            id_excluded_cams = [[] for n in range(nb_persons_to_detect)]
+            
+            for n in range(nb_persons_to_detect):
+                for k, keypoint_idx in enumerate(keypoints_idx):
+                # keypoints_nb = 2
+                # for keypoint_idx in range(2):
+                # Triangulate cameras with min reprojection error
+                    # print('\n', keypoints_names[keypoint_idx])
+                    coords_2D_kpt = np.array( (x_files[n][:, keypoint_idx], y_files[n][:, keypoint_idx], likelihood_files[n][:, keypoint_idx]) )
+                    coords_2D_kpt_swapped = np.array(( x_files[n][:, keypoints_idx_swapped[keypoint_idx]], y_files[n][:, keypoints_idx_swapped[keypoint_idx]], likelihood_files[n][:, keypoints_idx_swapped[keypoint_idx]] ))
+
+                    if triangulation_method == 'robust':
+                        Q_kpt, error_kpt, nb_cams_excluded_kpt, id_excluded_cams_kpt = robust_triangulation(config_dict, coords_2D_kpt, coords_2D_kpt_swapped, P)
+                    else:
+                        cams_off_guess = cams_off_guess_f[n][k] if cams_off_guess_f is not None else None
+                        Q_kpt, error_kpt, nb_cams_excluded_kpt, id_excluded_cams_kpt = triangulation_from_best_cameras(config_dict, coords_2D_kpt, coords_2D_kpt_swapped, P, calib_params, 
+                                                                                        cams_off_guess=cams_off_guess, warm_start_stats=warm_start_stats) # P has been modified if undistort_points=True
+
+                    Q[n].append(Q_kpt)
+                    error[n].append(error_kpt)
+                    nb_cams_excluded[n].append(nb_cams_excluded_kpt)
+                    id_excluded_cams[n].append(id_excluded_cams_kpt)
+
+            if use_cache:
+                save_frame_to_cache(cache_dir, cache_key, Q, error, nb_cams_excluded, id_excluded_cams, n_cams)
+
         if multi_person:
             # reID persons across frames by checking the distance from one frame to another
             # print('Q before ordering ', np.array(Q)[:,:2])
-            if f !=0:
-                Q, personsIDs_sorted, associated_tuples = sort_people(Q_old, Q)
+            if f !=0 or tracks is not None:
+                if tracks is not None:
+                    # match against positions predicted from each person's velocity rather than last positions
+                    Q_pred = predict_tracks(tracks, f, tracking_max_gap)
+                    # the gate uses the closer of the predicted and last observed positions
+                    Q, personsIDs_sorted, associated_tuples = sort_people(Q_pred, Q, max_distance=reid_max_distance, buffers=reid_buffers, Q_kpt_last=tracks['position'])
+                    tracks = update_tracks(tracks, Q, Q_pred, personsIDs_sorted, f, associated_tuples=associated_tuples)
+                else:
+                    Q, personsIDs_sorted, associated_tuples = sort_people(Q_old, Q, max_distance=reid_max_distance, buffers=reid_buffers)
                 # print('Q after ordering ', personsIDs_sorted, associated_tuples, np.array(Q)[:,:2])
                 
                 error_sorted, nb_cams_excluded_sorted, id_excluded_cams_sorted = [], [], []
                 for i in range(len(Q)):
-                    id_in_old =  associated_tuples[:,1][associated_tuples[:,0] == i].tolist()
-                    if len(id_in_old) > 0:
-                        personsIDs_sorted += id_in_old
-                        error_sorted += [error[id_in_old[0]]]
-                        nb_cams_excluded_sorted += [nb_cams_excluded[id_in_old[0]]]
-                        id_excluded_cams_sorted += [id_excluded_cams[id_in_old[0]]]
-                    else:
-                        personsIDs_sorted += [-1]
-                        error_sorted += [error[i]]
-                        nb_cams_excluded_sorted += [nb_cams_excluded[i]]
-                        id_excluded_cams_sorted += [id_excluded_cams[i]]
+                    if personsIDs_sorted[i] >= 0:
+                        error_sorted += [error[personsIDs_sorted[i]]]
+                        nb_cams_excluded_sorted += [nb_cams_excluded[personsIDs_sorted[i]]]
+                        id_excluded_cams_sorted += [id_excluded_cams[personsIDs_sorted[i]]]
+                    else: # person lost in this frame
+                        error_sorted += [[np.nan]*keypoints_nb]
+                        nb_cams_excluded_sorted += [[np.nan]*keypoints_nb]
+                        id_excluded_cams_sorted += [[[]]*keypoints_nb]
                 error, nb_cams_excluded, id_excluded_cams = error_sorted, nb_cams_excluded_sorted, id_excluded_cams_sorted
+
+        # Excluded cameras are kept in the order of the sorted persons
+        if warm_start_cameras:
+            cams_off_prev = id_excluded_cams
         
-        # TODO: if distance > threshold, new person
-        
-        # Add triangulated points, errors and excluded cameras to pandas dataframes
-        Q_tot.append([np.concatenate(Q[n]) for n in range(nb_persons_to_detect)])
-        error_tot.append([error[n] for n in range(nb_persons_to_detect)])
-        nb_cams_excluded_tot.append([nb_cams_excluded[n] for n in range(nb_persons_to_detect)])
-        id_excluded_cams = [[id_excluded_cams[n][k] for k in range(keypoints_nb)] for n in range(nb_persons_to_detect)]
-        id_excluded_cams_tot.append(id_excluded_cams)
-            
-    # fill values for if a person that was not initially detected has entered the frame 
-    Q_tot = [list(tpl) for tpl in zip(*it.zip_longest(*Q_tot, fillvalue=[np.nan]*keypoints_nb*3))]
-    error_tot = [list(tpl) for tpl in zip(*it.zip_longest(*error_tot, fillvalue=[np.nan]*keypoints_nb*3))]
-    nb_cams_excluded_tot = [list(tpl) for tpl in zip(*it.zip_longest(*nb_cams_excluded_tot, fillvalue=[np.nan]*keypoints_nb*3))]
-    id_excluded_cams_tot = [list(tpl) for tpl in zip(*it.zip_longest(*id_excluded_cams_tot, fillvalue=[np.nan]*keypoints_nb*3))]
-
-    # dataframes for each person
-    Q_tot = [pd.DataFrame([Q_tot_f[n] for Q_tot_f in Q_tot]) for n in range(nb_persons_to_detect)]
-    error_tot = [pd.DataFrame([error_tot_f[n] for error_tot_f in error_tot]) for n in range(nb_persons_to_detect)]
-    nb_cams_excluded_tot = [pd.DataFrame([nb_cams_excluded_tot_f[n] for nb_cams_excluded_tot_f in nb_cams_excluded_tot]) for n in range(nb_persons_to_detect)]
-    id_excluded_cams_tot = [pd.DataFrame([id_excluded_cams_tot_f[n] for id_excluded_cams_tot_f in id_excluded_cams_tot]) for n in range(nb_persons_to_detect)]
-    
-    for n in range(nb_persons_to_detect):
-        error_tot[n]['mean'] = error_tot[n].mean(axis = 1)
-        nb_cams_excluded_tot[n]['mean'] = nb_cams_excluded_tot[n].mean(axis = 1)
+        # Add triangulated points, errors and excluded cameras to the preallocated arrays
+        frame_idx = f - f_range[0]
+        Q_tot[frame_idx] = np.array([np.concatenate(Q[n]).reshape(keypoints_nb, 3) for n in range(nb_persons_to_detect)])
+        error_tot[frame_idx] = np.array(error, dtype=float)
+        nb_cams_excluded_tot[frame_idx] = np.array(nb_cams_excluded, dtype=float)
+        for n in range(nb_persons_to_detect):
+            for k in range(keypoints_nb):
+                excluded_cams_tot[frame_idx, n, k, np.array(id_excluded_cams[n][k], dtype=int)] = True
+
+    if use_cache:
+        prune_cache(cache_dir, cache_max_size_mb)
     
     # Delete participants with less than 4 valid triangulated frames
     # for each person, for each keypoint, frames to interpolate
-    zero_nan_frames = [np.where( Q_tot[n].iloc[:,::3].T.eq(0) | ~np.isfinite(Q_tot[n].iloc[:,::3].T) ) for n in range(nb_persons_to_detect)]
-    zero_nan_frames_per_kpt = [[zero_nan_frames[n][1][np.where(zero_nan_frames[n][0]==k)[0]] for k in range(keypoints_nb)] for n in range(nb_persons_to_detect)]
-    non_nan_nb_first_kpt = [frame_nb - len(zero_nan_frames_per_kpt[n][0]) for n in range(nb_persons_to_detect)]
-    deleted_person_id = [n for n in range(len(non_nan_nb_first_kpt)) if non_nan_nb_first_kpt[n]<4]
-
-    Q_tot = [Q_tot[n] for n in range(len(Q_tot)) if n not in deleted_person_id]
-    error_tot = [error_tot[n] for n in range(len(error_tot)) if n not in deleted_person_id]
-    nb_cams_excluded_tot = [nb_cams_excluded_tot[n] for n in range(len(nb_cams_excluded_tot)) if n not in deleted_person_id]
-    id_excluded_cams_tot = [id_excluded_cams_tot[n] for n in range(len(id_excluded_cams_tot)) if n not in deleted_person_id]
-    nb_persons_to_detect = len(Q_tot)
+    zero_nan_mask = (Q_tot[...,0] == 0) | ~np.isfinite(Q_tot[...,0]) # frames * persons * keypoints
+    persons_kept = np.flatnonzero(np.count_nonzero(~zero_nan_mask[:,:,0], axis=0) >= 4)
+    Q_tot, error_tot, nb_cams_excluded_tot = Q_tot[:,persons_kept], error_tot[:,persons_kept], nb_cams_excluded_tot[:,persons_kept]
+    excluded_cams_tot, zero_nan_mask = excluded_cams_tot[:,persons_kept], zero_nan_mask[:,persons_kept]
+    nb_persons_to_detect = len(persons_kept)
 
     if nb_persons_to_detect ==0:
         raise Exception('No persons have been triangulated. Please check your calibration and your synchronization, or the triangulation parameters in Config.toml.')
 
+    tracking_metrics = track_metrics(tracks, persons_kept) if tracks is not None else None
+
     # IDs of excluded cameras
-    # id_excluded_cams_tot = [np.concatenate([id_excluded_cams_tot[f][k] for f in range(frames_nb)]) for k in range(keypoints_nb)]
-    id_excluded_cams_tot = [np.hstack(np.hstack(np.array(id_excluded_cams_tot[n]))) for n in range(nb_persons_to_detect)]
-    cam_excluded_count = [dict(Counter(k)) for k in id_excluded_cams_tot]
-    [cam_excluded_count[n].update((x, y/frame_nb/keypoints_nb) for x, y in cam_excluded_count[n].items()) for n in range(nb_persons_to_detect)]
+    cam_excluded_count = []
+    for n in range(nb_persons_to_detect):
+        cam_excluded_nb = np.bincount(np.nonzero(excluded_cams_tot[:,n])[-1], minlength=n_cams)
+        cam_excluded_count.append({c: cam_excluded_nb[c]/frame_nb/keypoints_nb for c in np.flatnonzero(cam_excluded_nb)})
+
+    # dataframes for each person (the person slices may be copied, depending on their layout and on the pandas version)
+    Q_tot = [pd.DataFrame(Q_tot[:,n].reshape(frame_nb, keypoints_nb*3)) for n in range(nb_persons_to_detect)]
+    error_tot = [pd.DataFrame(error_tot[:,n]) for n in range(nb_persons_to_detect)]
+    nb_cams_excluded_tot = [pd.DataFrame(nb_cams_excluded_tot[:,n]) for n in range(nb_persons_to_detect)]
+    for n in range(nb_persons_to_detect):
+        error_tot[n]['mean'] = error_tot[n].mean(axis = 1)
+        nb_cams_excluded_tot[n]['mean'] = nb_cams_excluded_tot[n].mean(axis = 1)
     
     # Optionally, for each person, for each keypoint, show indices of frames that should be interpolated
     if show_interp_indices:
-        gaps = [[np.where(np.diff(zero_nan_frames_per_kpt[n][k]) > 1)[0] + 1 for k in range(keypoints_nb)] for n in range(nb_persons_to_detect)]
-        sequences = [[np.split(zero_nan_frames_per_kpt[n][k], gaps[n][k]) for k in range(keypoints_nb)] for n in range(nb_persons_to_detect)]
-        interp_frames = [[[f'{seq[0]}:{seq[-1]}' for seq in seq_kpt if len(seq)<=interp_gap_smaller_than and len(seq)>0] for seq_kpt in sequences[n]] for n in range(nb_persons_to_detect)]
-        non_interp_frames = [[[f'{seq[0]}:{seq[-1]}' for seq in seq_kpt if len(seq)>interp_gap_smaller_than] for seq_kpt in sequences[n]] for n in range(nb_persons_to_detect)]
+        interp_frames = [[[] for k in range(keypoints_nb)] for n in range(nb_persons_to_detect)]
+        non_interp_frames = [[[] for k in range(keypoints_nb)] for n in range(nb_persons_to_detect)]
+        cols, starts, stops = find_runs(zero_nan_mask.reshape(frame_nb, -1))
+        for c, start, stop in zip(cols, starts, stops):
+            n, k = divmod(c, keypoints_nb)
+            frames_list = interp_frames if stop-start <= interp_gap_smaller_than else non_interp_frames
+            frames_list[n][k].append(f'{start}:{stop-1}')
     else:
         interp_frames = None
         non_interp_frames = []
@@ -956,7 +1443,7 @@ def triangulate_all(config_dict):
     if interpolation_kind != 'none':
         for n in range(nb_persons_to_detect):
             try:
-                Q_tot[n] = Q_tot[n].apply(interpolate_zeros_nans, axis=0, args = [interp_gap_smaller_than, interpolation_kind])
+                Q_tot[n] = pd.DataFrame(interpolate_zeros_nans(Q_tot[n].to_numpy(), interp_gap_smaller_than, interpolation_kind))
             except:
                 logging.info(f'Interpolation was not possible for person {n}. This means that not enough points are available, which is often due to a bad calibration.')
     # Fill non-interpolated values with last valid one
@@ -990,4 +1477,4 @@ def triangulate_all(config_dict):
 
 
     # Recap message
-    recap_triangulate(config_dict, error_tot, nb_cams_excluded_tot, keypoints_names, cam_excluded_count, interp_frames, non_interp_frames, trc_paths)
+    recap_triangulate(config_dict, error_tot, nb_cams_excluded_tot, keypoints_names, cam_excluded_count, interp_frames, non_interp_frames, trc_paths, cache_stats=cache_stats, tracking_metrics=tracking_metrics, warm_start_stats=warm_start_stats)